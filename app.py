@@ -6,24 +6,28 @@ JSON log format matches:
   extra.unchanged_count    = actual images that stayed
   extra.total_processed    = moved + unchanged (full scan count)
 Run: streamlit run app.py
+Engines, storage and matching live in segregator.py (no Streamlit import);
+this file is the UI on top of it.
 """
 
-import os, shutil, re, tempfile, math, urllib.parse, json, datetime
+import os, json, datetime
 from pathlib import Path
 
 import streamlit as st
-import boto3
-from botocore.client import Config
-from PIL import Image as PILImage
+
+from segregator import (
+    Reporter, make_s3_client, scan_bucket, get_presigned_url, sanitize, find_local,
+    extract_features, classify_features, HASH_RADIUS, session_log, delete_r2_many, PIPELINE_WORKERS,
+    seg_r2_full, seg_r2_ref, seg_local_full, seg_local_ref,
+    preview_folder_by_upload, seg_folder_by_upload, segregation_result,
+    index_prefix, preview_duplicate_clusters, FEATURE_POOL_MIN_ITEMS, last_run_timings,
+    start_metrics, thumbnails, list_folder, cache_stats, clear_cache, indexed_count, search_similar,
+    unfinished_jobs, discard_job, count_metric,
+)
 
 st.set_page_config(page_title="AI Image Segregator", page_icon="🗂️",
                    layout="wide", initial_sidebar_state="expanded")
 
-R2_ENDPOINT   = "https://93.r2.cloudflarestorage.com"
-R2_ACCESS_KEY = "d62481sdgsEDHnbda1361"
-R2_SECRET_KEY = "b22d834fb76c5gserhurdztjzrtjkrztkfyyytc4f9de44f"
-SUPPORTED     = {".jpg",".jpeg",".png",".gif",".webp",".bmp",".tiff",".tif"}
-
 st.markdown("""<style>
 .guide-box{background:#1a2332;border-left:4px solid #4a9eff;padding:.9rem 1.1rem;
            border-radius:4px;margin:.4rem 0 .8rem}
@@ -40,129 +44,101 @@ div[data-testid="metric-container"] [data-testid="stMetricValue"]{color:#58a6ff}
 </style>""", unsafe_allow_html=True)
 
 # ════════════════════════════════════════════════════════════════════════════════
-# JSON SESSION LOGGER
-# Produces this exact structure for every event type:
-#
-#  {
-#    "id":              "2026-02-19T18-02-40-706873_r2_folder_upload",
-#    "timestamp":       "2026-02-19T18:02:40.706873",
-#    "date":            "2026-02-19",
-#    "time":            "18:02:40",
-#    "event_type":      "r2_folder_upload",
-#    "bucket":          "img",
-#    "source_prefix":   "data/",
-#    "output_prefix":   "data/abstract_pattern/",
-#    "mode":            "",
-#    "reference_image": "<uploaded>",
-#    "results": {
-#      "total_processed": 25,         ← images that were moved
-#      "groups": { "abstract_pattern": ["file.jpg", …] },
-#      "moved_count":     25,
-#      "unchanged_count": 0           ← always 0 here; real count in extra
-#    },
-#    "extra": {
-#      "is_placeholder":  false,
-#      "dest_sub":        "abstract_pattern",
-#      "moved":           25,
-#      "unchanged_count": 78,         ← actual images that stayed
-#      "total_processed": 103         ← moved + unchanged
-#    }
-#  }
+# STREAMLIT GLUE — cached singletons and the Reporter the engines draw through
 # ════════════════════════════════════════════════════════════════════════════════
-_SESSION_LOG_FILE = "segregator_session_log.json"
+@st.cache_resource(show_spinner=False)
+def _s3_client():
+    return make_s3_client()
+
+
+@st.cache_resource(show_spinner=False)
+def _metrics_exporters():
+    # SEGREGATOR_METRICS_PORT / SEGREGATOR_METRICS_FILE — started once per server process
+    return start_metrics()
 
 
-def _load_log() -> list:
+def _thumb(s3, bucket, key, width, view, tile=None, error_text="🖼️ *error*"):
+    # the cached tile from thumbnails(), else the presigned original;
+    # counted in segregator_gallery_thumbnails_total
+    if isinstance(tile, bytes):
+        st.image(tile, width=width); count_metric("gallery_thumbnails_total", view=view, status="thumbnail")
+        return
+    url = get_presigned_url(s3, bucket, key, expires=600)
+    if not url:
+        count_metric("gallery_thumbnails_total", view=view, status="no_url")
+        st.markdown("🖼️ *no preview*"); return
     try:
-        with open(_SESSION_LOG_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return []
+        st.image(url, width=width); count_metric("gallery_thumbnails_total", view=view, status="ok")
+    except Exception:
+        count_metric("gallery_thumbnails_total", view=view, status="error")
+        st.markdown(error_text)
 
 
-def _save_log(entries: list) -> None:
-    with open(_SESSION_LOG_FILE, "w", encoding="utf-8") as f:
-        json.dump(entries, f, indent=2, ensure_ascii=False, default=str)
-
-
-def log_session_event(
-    event_type: str,
-    bucket: str = "",
-    source_prefix: str = "",
-    output_prefix: str = "",
-    mode: str = "",
-    summary: dict = None,
-    reference_image: str = "",
-    extra: dict = None,
-) -> None:
-    now = datetime.datetime.now()
-    iso = now.isoformat()
-
-    # ID format: 2026-02-19T18-02-40-706873_event_type
-    entry_id = f"{iso}_{event_type}".replace(":", "-").replace(".", "-")
-
-    # ── results block ─────────────────────────────────────────────────────────
-    # total_processed & moved_count = images actually moved/grouped
-    # unchanged_count = always 0 (real unchanged lives in extra)
-    results: dict = {}
-    if summary:
-        moved_total = sum(len(v) for v in summary.values())
-        results = {
-            "total_processed": moved_total,
-            "groups":          summary,
-            "moved_count":     moved_total,
-            "unchanged_count": 0,
-        }
+def _tiles(s3, bucket, keys, versions=None) -> dict:
+    # thumbnails for one page, fetched in parallel; {} (→ originals) if that fails outright
+    try: return thumbnails(s3, bucket, keys, versions)
+    except Exception: return {}
 
-    # ── extra block: full picture ─────────────────────────────────────────────
-    # Callers must pass:
-    #   moved           = int (same as moved_count)
-    #   unchanged_count = int (images that stayed)
-    #   total_processed = moved + unchanged  (full scan size)
-    # Plus any event-specific keys (is_placeholder, dest_sub, etc.)
-    _extra = dict(extra) if extra else {}
-
-    entry = {
-        "id":              entry_id,
-        "timestamp":       iso,
-        "date":            now.strftime("%Y-%m-%d"),
-        "time":            now.strftime("%H:%M:%S"),
-        "event_type":      event_type,
-        "bucket":          bucket,
-        "source_prefix":   source_prefix,
-        "output_prefix":   output_prefix,
-        "mode":            mode,
-        "reference_image": reference_image,
-        "results":         results,
-        "extra":           _extra,
-    }
-
-    # auto-saved to segregator_session_log.json on every call
-    log = _load_log()
-    log.append(entry)
-    _save_log(log)
+
+def _gal_tree(s3, bucket, expanded) -> list:
+    # visible gallery rows, depth first: (folder_path, depth, listing or None).
+    # One delimiter listing per expanded folder; a collapsed folder has a
+    # listing (and a count) only once it has been listed before.
+    root = list_folder(s3, bucket, "")
+    rows = [("(root)", 0, root)] if root["images"] else []
+    def _walk(listing, depth):
+        for f in listing["folders"]:
+            sub = list_folder(s3, bucket, f, cached_only=f not in expanded)
+            rows.append((f, depth, sub))
+            if f in expanded and sub is not None: _walk(sub, depth + 1)
+    _walk(root, 0)
+    return rows
+
+
+def _gal_count(listing) -> str:
+    return f"{len(listing['images'])}{'+' if listing['truncated'] else ''}"
+
+
+class StreamlitReporter(Reporter):
+    def __init__(self, bar=None):
+        self.bar = bar
+
+    def progress(self, frac, text=""):
+        if self.bar is not None: self.bar.progress(frac, text=text)
+
+    def write(self, msg):   st.write(msg)
+    def info(self, msg):    st.info(msg)
+    def success(self, msg): st.success(msg)
+    def warning(self, msg): st.warning(msg)
+    def error(self, msg):   st.error(msg)
+
+
+@st.cache_data(max_entries=1, show_spinner=False)
+def _log_export(version) -> str:
+    # the full log as one JSON array — read again only when the log changed
+    return json.dumps(session_log.all(), indent=2, ensure_ascii=False, default=str)
 
 
 def _render_log_sidebar():
     st.divider()
     st.subheader("📋 Session Log")
-    log = _load_log()
-    if not log:
+    n_events = session_log.count()
+    if not n_events:
         st.caption("No events logged yet.")
         return
 
-    st.caption(f"{len(log)} event(s) recorded")
+    st.caption(f"{n_events} event(s) recorded")
 
     st.download_button(
         label="⬇️ Download Full Log (JSON)",
-        data=json.dumps(log, indent=2, ensure_ascii=False, default=str),
+        data=_log_export(session_log.version()),
         file_name=f"segregator_log_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
         mime="application/json",
         use_container_width=True,
     )
 
-    with st.expander("📄 Latest 5 events"):
-        for ev in reversed(log[-5:]):
+    def _show(events):
+        for ev in reversed(events):
             r   = ev.get("results", {})
             ext = ev.get("extra", {})
             st.markdown(
@@ -175,224 +151,63 @@ def _render_log_sidebar():
             )
             st.divider()
 
+    with st.expander("📄 Latest 5 events"):
+        _show(session_log.latest(5))
+
+    with st.expander("🔎 Filter events"):
+        _fd = st.text_input("Date (YYYY-MM-DD)", key="log_f_date")
+        _fb = st.text_input("Bucket", key="log_f_bucket")
+        _fe = st.selectbox("Event type", ["", "r2_full", "r2_reference", "local_full",
+                                          "local_reference", "r2_folder_upload"], key="log_f_type")
+        if _fd or _fb or _fe:
+            _hits = session_log.query(date=_fd.strip(), bucket=_fb.strip(), event_type=_fe, limit=20)
+            st.caption(f"Newest {len(_hits)} match(es)")
+            _show(_hits)
+
     if st.button("🗑️ Clear Log", key="clear_log_btn"):
-        _save_log([])
+        session_log.clear()
         st.success("Log cleared.")
         st.rerun()
 
 
-# ════════════════════════════════════════════════════════════════════════════════
-# R2 CLIENT
-# ════════════════════════════════════════════════════════════════════════════════
-@st.cache_resource(show_spinner=False)
-def _s3_client():
-    return boto3.client(
-        "s3",
-        endpoint_url=R2_ENDPOINT,
-        aws_access_key_id=R2_ACCESS_KEY,
-        aws_secret_access_key=R2_SECRET_KEY,
-        config=Config(signature_version="s3v4",
-                      retries={"max_attempts": 5, "mode": "adaptive"}),
-        region_name="auto",
-    )
+def _render_timings_sidebar():
+    _t = last_run_timings()
+    if not _t:      # nothing run since the app started → newest logged run with timings
+        _ev = next((e for e in reversed(session_log.latest(20)) if e.get("extra", {}).get("timings")), None)
+        if _ev is None: return
+        _t = {"engine": _ev["event_type"], "finished": _ev["timestamp"], **_ev["extra"]["timings"]}
+    with st.expander("⏱️ Last run timings"):
+        st.caption(f"`{_t['engine']}` · {_t['finished'][:19].replace('T', ' ')} · "
+                   f"{_t['images']} image(s) in {_t['wall_s']:.1f}s  \n"
+                   "Stage times add up across parallel workers, so they can exceed the wall time.")
+        _sum = sum(v["total_s"] for v in _t["stages"].values()) or 1
+        for _name, _v in _t["stages"].items():
+            _bits = [f"{_v['total_s']:.2f}s", f"{_v['calls']} call(s)"]
+            if _v.get("per_image_ms") is not None: _bits.append(f"{_v['per_image_ms']:.1f} ms/image")
+            if _v.get("bytes"):   _bits.append(f"{_v['bytes']/1e6:.1f} MB")
+            if _v.get("retries"): _bits.append(f"{_v['retries']} retr{'y' if _v['retries'] == 1 else 'ies'}")
+            if _v.get("errors"):  _bits.append(f"❌ {_v['errors']}")
+            st.markdown(f"**{_name}** · " + " · ".join(_bits))
+            st.progress(min(1.0, _v["total_s"] / _sum))
+        if _t.get("pipeline"):
+            st.caption("Per image: " + " · ".join(f"{k} {v['per_image_ms']:.1f} ms"
+                                                  for k, v in _t["pipeline"].items() if v.get("per_image_ms") is not None))
+        if _t.get("slowest"):
+            st.markdown("**🐢 Slowest images**")
+            for _r in _t["slowest"]:
+                _top = max(_r["stages"].items(), key=lambda kv: kv[1], default=None)
+                st.caption(f"`{_r['key']}` — {_r['total_ms']:.0f} ms"
+                           + (f" · mostly {_top[0]} ({_top[1]:.0f} ms)" if _top else ""))
+
 
 def fetch_buckets(s3) -> list:
+    if s3 is None: return []
     try:
         return sorted(b["Name"] for b in s3.list_buckets().get("Buckets", []))
     except Exception as e:
         st.sidebar.error(f"Cannot list buckets: {e}")
         return []
 
-def scan_bucket(s3, bucket: str, prefix: str = "", max_keys: int = 0):
-    def _fetch(pfx):
-        keys, folders = [], set()
-        try:
-            pager = s3.get_paginator("list_objects_v2")
-            for page in pager.paginate(Bucket=bucket, Prefix=pfx,
-                                       PaginationConfig={"PageSize": 1000}):
-                for obj in page.get("Contents", []):
-                    k = obj["Key"]
-                    keys.append(k)
-                    rel = k[len(pfx):]
-                    if "/" in rel:
-                        folders.add(pfx + rel.split("/")[0] + "/")
-                if max_keys and len(keys) >= max_keys:
-                    break
-        except Exception as e:
-            st.error(f"Scan error: {e}")
-        return keys, folders
-
-    pfx = prefix.strip().lstrip("/")
-    all_keys, folders = _fetch(pfx)
-    if not all_keys and pfx and not pfx.endswith("/"):
-        all_keys, folders = _fetch(pfx + "/")
-
-    img_keys = [k for k in all_keys if Path(k).suffix.lower() in SUPPORTED]
-    return img_keys, all_keys, sorted(folders)
-
-# ════════════════════════════════════════════════════════════════════════════════
-# IMAGE CLASSIFICATION
-# ════════════════════════════════════════════════════════════════════════════════
-def _avg_hsv(img):
-    px = list(img.convert("RGB").resize((60,60),PILImage.LANCZOS).convert("HSV").getdata())
-    n  = len(px)
-    return sum(p[0] for p in px)/n*360/255, sum(p[1] for p in px)/n/255, sum(p[2] for p in px)/n/255
-
-def _edge(img):
-    px = list(img.convert("L").resize((80,80),PILImage.LANCZOS).getdata())
-    m  = sum(px)/len(px)
-    return math.sqrt(sum((p-m)**2 for p in px)/len(px))
-
-def _perceptual_hash(img, hash_size=8):
-    img = img.convert("L").resize((hash_size + 1, hash_size), PILImage.LANCZOS)
-    px = list(img.getdata())
-    diff = [px[i] < px[i+1] for i in range(len(px)-1)]
-    return sum(2**i for i, b in enumerate(diff) if b)
-
-def _hamming_distance(h1, h2):
-    return bin(h1 ^ h2).count('1')
-
-PLACEHOLDER_TEXTS = [
-    'NO IMAGE', 'COMING SOON', 'NO MASTER PLAN', 'NO FLOOR PLAN',
-    'NOT AVAILABLE', 'IMAGE NOT FOUND', 'NO PHOTO', 'PHOTO NOT AVAILABLE',
-    'IMAGE COMING SOON', 'NO PICTURE', 'PLACEHOLDER', 'N/A',
-    'NO IMAGE FOUND', 'IMAGE UNAVAILABLE', 'NO MASTERPLAN', 'NO FLOORPLAN',
-    'COMING SOON!', 'STAY TUNED', 'UPLOADING SOON', 'WILL BE UPDATED',
-    'NOT YET AVAILABLE', 'IMAGE PENDING', 'NO IMAGE AVAILABLE',
-]
-
-def _detect_placeholder_text(img) -> bool:
-    rgb = img.convert("RGB").resize((120, 120))
-    px  = list(rgb.getdata())
-    n   = len(px)
-
-    avg_r = sum(p[0] for p in px) / n
-    avg_g = sum(p[1] for p in px) / n
-    avg_b = sum(p[2] for p in px) / n
-    is_light_bg = avg_r > 190 and avg_g > 190 and avg_b > 190
-    is_grey_bg  = (abs(avg_r - avg_g) < 25 and abs(avg_g - avg_b) < 25 and avg_r > 150)
-    is_plain_bg = is_light_bg or is_grey_bg
-
-    colour_counts: dict = {}
-    for p in px:
-        b = (p[0] // 20 * 20, p[1] // 20 * 20, p[2] // 20 * 20)
-        colour_counts[b] = colour_counts.get(b, 0) + 1
-    top_count      = max(colour_counts.values())
-    dominant_ratio = top_count / n
-    S1 = dominant_ratio > 0.50
-
-    grey_px    = list(img.convert("L").resize((80, 80), PILImage.LANCZOS).getdata())
-    mean_g     = sum(grey_px) / len(grey_px)
-    edge_score = math.sqrt(sum((p - mean_g) ** 2 for p in grey_px) / len(grey_px))
-
-    S2 = edge_score < 14
-    S3 = is_plain_bg and (10 <= edge_score <= 40)
-
-    bw_px       = list(img.convert("L").resize((100, 100), PILImage.LANCZOS).getdata())
-    light_px    = sum(1 for v in bw_px if v > 220)
-    dark_px     = sum(1 for v in bw_px if v < 60)
-    total_bw    = len(bw_px)
-    light_ratio = light_px / total_bw
-    dark_ratio  = dark_px  / total_bw
-    S4 = is_plain_bg and light_ratio > 0.55 and 0.01 <= dark_ratio <= 0.35
-
-    if sum([S1, S2, S3, S4]) >= 2:
-        return True
-
-    try:
-        import pytesseract
-        text = pytesseract.image_to_string(img).upper()
-        if any(ph in text for ph in PLACEHOLDER_TEXTS):
-            return True
-    except Exception:
-        pass
-
-    return False
-
-
-def _pixel_similarity(img_a: PILImage.Image, img_b: PILImage.Image, size: int = 32) -> float:
-    a = list(img_a.convert("L").resize((size, size), PILImage.LANCZOS).getdata())
-    b = list(img_b.convert("L").resize((size, size), PILImage.LANCZOS).getdata())
-    n = len(a)
-    return 1.0 - (sum(abs(a[i] - b[i]) for i in range(n)) / (255 * n))
-
-
-def classify_image(path: str) -> dict:
-    try: img = PILImage.open(path).convert("RGB")
-    except Exception as e: return {"category":"Unclassified","subcategory":"Unknown","tags":[],"description":str(e)}
-    w,h=img.size; ratio=w/h if h else 1
-    hue,sat,val=_avg_hsv(img); edge=_edge(img)
-    H=lambda lo,hi: lo<=hue<hi
-    is_green=H(70,160); is_blue=H(190,260); is_red=H(0,20) or H(340,360)
-    is_brown=H(20,40) and sat<0.5; is_grey=sat<0.12
-    bright=val>0.55; dark=val<0.35; colorful=sat>0.40
-    portrait=ratio<0.80; landscape=ratio>1.35; square=0.80<=ratio<=1.35
-    complex_=edge>38; simple=edge<20
-    cat,sub,tags="Abstract","Pattern",["pattern","texture"]
-    if   is_green and bright and landscape:                   cat,sub,tags="Nature","Forest",["green","trees","outdoor"]
-    elif is_blue  and bright and landscape and val>0.6:       cat,sub,tags="Nature","Sky",["blue","sky","outdoor"]
-    elif is_blue  and landscape and sat>0.3:                  cat,sub,tags="Nature","Beach",["water","blue","outdoor"]
-    elif is_green and landscape:                              cat,sub,tags="Nature","Landscape",["green","nature","outdoor"]
-    elif portrait and complex_ and not dark:                  cat,sub,tags="People","Portrait",["person","portrait","face"]
-    elif square   and complex_ and sat<0.3 and bright:        cat,sub,tags="People","Portrait",["person","monochrome"]
-    elif (is_red or is_brown) and complex_ and square:        cat,sub,tags="Food","Meal",["food","plate","colorful"]
-    elif colorful and complex_ and square and not is_blue:    cat,sub,tags="Food","Dish",["food","colorful"]
-    elif is_brown and complex_ and landscape:                 cat,sub,tags="Animals","Wildlife",["animal","brown"]
-    elif is_green and complex_ and square:                    cat,sub,tags="Animals","Wildlife",["animal","nature"]
-    elif is_grey  and complex_ and portrait:                  cat,sub,tags="Architecture","Building",["building","urban"]
-    elif is_grey  and complex_ and landscape:                 cat,sub,tags="Architecture","Cityscape",["city","urban"]
-    elif bright   and complex_ and portrait:                  cat,sub,tags="Architecture","Structure",["building","outdoor"]
-    elif is_grey  and landscape and simple:                   cat,sub,tags="Vehicles","Car",["vehicle","grey"]
-    elif dark     and landscape and complex_:                 cat,sub,tags="Vehicles","Transport",["vehicle","dark"]
-    elif dark     and complex_  and is_blue:                  cat,sub,tags="Technology","Electronics",["tech","screen"]
-    elif is_grey  and simple    and landscape:                cat,sub,tags="Technology","Device",["device","minimal"]
-    elif colorful and complex_  and not bright:               cat,sub,tags="Art","Painting",["art","colorful"]
-    elif colorful and simple:                                 cat,sub,tags="Art","Abstract",["art","abstract"]
-    elif is_green and landscape and complex_:                 cat,sub,tags="Sports","Outdoor",["sports","field"]
-    elif simple:                                              cat,sub,tags="Abstract","Minimal",["minimal","pattern"]
-    return {"category":cat,"subcategory":sub,"tags":tags,
-            "description":f"{'Bright' if bright else 'Dark'}, {'colorful' if colorful else 'muted'} {sub.lower()}."}
-
-# ════════════════════════════════════════════════════════════════════════════════
-# HELPERS
-# ════════════════════════════════════════════════════════════════════════════════
-def sanitize(n): return re.sub(r'[\\/:*?"<>|\x00-\x1f]','_',n).strip() or "Unknown"
-
-def get_group(info,mode):
-    if mode=="category":    return sanitize(info.get("category","Unclassified"))
-    if mode=="subcategory": return sanitize(info.get("category","Unk"))+"/"+sanitize(info.get("subcategory","Unk"))
-    tags=info.get("tags",[]); return sanitize(tags[0]) if tags else "Untagged"
-
-def r2_key_from_input(url_or_key,bucket):
-    if not url_or_key.startswith("http"): return url_or_key.strip().lstrip("/")
-    path=urllib.parse.urlparse(url_or_key).path.lstrip("/")
-    if bucket and path.startswith(bucket+"/"): path=path[len(bucket)+1:]
-    return path
-
-def safe_dest_key(s3,bucket,folder,filename,idx):
-    dk=f"{folder}/{filename}"
-    try: s3.head_object(Bucket=bucket,Key=dk); stem,ext=Path(filename).stem,Path(filename).suffix; dk=f"{folder}/{stem}_{idx}{ext}"
-    except: pass
-    return dk
-
-def upload_r2(s3,bucket,local,dest_key):
-    ct={".jpg":"image/jpeg",".jpeg":"image/jpeg",".png":"image/png",".gif":"image/gif",
-        ".webp":"image/webp",".bmp":"image/bmp",".tiff":"image/tiff",".tif":"image/tiff"
-        }.get(Path(local).suffix.lower(),"application/octet-stream")
-    s3.upload_file(local,bucket,dest_key,ExtraArgs={"ContentType":ct})
-
-def safe_local_copy(src,dest_dir,idx):
-    os.makedirs(dest_dir,exist_ok=True); name=os.path.basename(src); dest=os.path.join(dest_dir,name)
-    if os.path.exists(dest):
-        stem,ext=Path(name).stem,Path(name).suffix; dest=os.path.join(dest_dir,f"{stem}_{idx}{ext}")
-    shutil.copy2(src,dest)
-
-def find_local(folder):
-    paths=[]
-    for root,_,files in os.walk(folder):
-        for f in files:
-            if Path(f).suffix.lower() in SUPPORTED: paths.append(os.path.join(root,f))
-    return sorted(paths)
 
 def show_summary(summary):
     st.divider(); st.subheader("📊 Results")
@@ -406,159 +221,6 @@ def show_summary(summary):
         with st.expander(f"📁 **{group}** — {len(files)} image(s)"):
             for f in files: st.write(f"• {f}")
 
-# ════════════════════════════════════════════════════════════════════════════════
-# SEGREGATION ENGINES — each calls log_session_event with correct extra fields
-# ════════════════════════════════════════════════════════════════════════════════
-def seg_r2_full(s3,bucket,prefix,out_prefix,mode,bar):
-    img_keys,_,_=scan_bucket(s3,bucket,prefix)
-    if not img_keys:
-        st.error("❌ No images found. Use the **Bucket Scanner** above — click ⚡ Quick Scan to see all keys.")
-        return {}
-    total=len(img_keys); summary={}; failed=0
-    st.success(f"✅ Found **{total}** images — processing now…")
-    with tempfile.TemporaryDirectory() as tmp:
-        for i,key in enumerate(img_keys,1):
-            name=Path(key).name; bar.progress(i/total,text=f"[{i}/{total}] {name}")
-            local=os.path.join(tmp,f"{i}_{name}")
-            try: s3.download_file(bucket,key,local)
-            except Exception as e: st.warning(f"⚠️ Download `{key}`: {e}"); failed+=1; continue
-            info=classify_image(local); group=get_group(info,mode)
-            folder=f"{out_prefix.rstrip('/')}/{group}"
-            dk=safe_dest_key(s3,bucket,folder,name,i)
-            try:
-                upload_r2(s3,bucket,local,dk)
-                st.write(f"✅ `{name}` → 📁 **{group}** `({info['category']} / {info['subcategory']})`")
-                summary.setdefault(group,[]).append(name)
-            except Exception as e: st.error(f"❌ Upload `{name}`: {e}"); failed+=1
-    bar.progress(1.0,text="Complete!")
-    moved_n = sum(len(v) for v in summary.values())
-    log_session_event(
-        "r2_full", bucket=bucket, source_prefix=prefix,
-        output_prefix=out_prefix, mode=mode, summary=summary,
-        extra={
-            "moved":           moved_n,
-            "unchanged_count": 0,
-            "total_processed": total,
-            "failed":          failed,
-        }
-    )
-    return summary
-
-def seg_r2_ref(s3,bucket,ref_input,prefix,out_prefix,bar):
-    ref_tmp=None
-    try:
-        ref_key=r2_key_from_input(ref_input,bucket); suffix=Path(ref_key).suffix or ".jpg"
-        f=tempfile.NamedTemporaryFile(suffix=suffix,delete=False); f.close(); ref_tmp=f.name
-        s3.download_file(bucket,ref_key,ref_tmp); ref_info=classify_image(ref_tmp)
-    except Exception as e: st.error(f"❌ Reference failed: {e}"); return {}
-    finally:
-        if ref_tmp and os.path.exists(ref_tmp): os.remove(ref_tmp)
-    ref_cat=ref_info["category"].lower(); ref_sub=ref_info["subcategory"].lower()
-    ref_tags={t.lower() for t in ref_info.get("tags",[])}
-    group_nm=sanitize(f"{ref_cat}_{ref_sub}") or "Similar"
-    st.info(f"Reference → **{ref_cat} / {ref_sub}**  |  tags: `{', '.join(ref_tags)}`")
-    img_keys,_,_=scan_bucket(s3,bucket,prefix)
-    if not img_keys: st.error("❌ No images found."); return {}
-    total=len(img_keys); summary={}
-    with tempfile.TemporaryDirectory() as tmp:
-        for i,key in enumerate(img_keys,1):
-            name=Path(key).name; bar.progress(i/total,text=f"[{i}/{total}] {name}")
-            local=os.path.join(tmp,f"{i}_{name}")
-            try: s3.download_file(bucket,key,local)
-            except Exception as e: st.warning(f"⚠️ {e}"); continue
-            info=classify_image(local); cat=info["category"].lower(); sub=info["subcategory"].lower()
-            tags={t.lower() for t in info.get("tags",[])}
-            similar=(cat==ref_cat) or (sub==ref_sub) or bool(tags&ref_tags)
-            folder=group_nm if similar else "Other"
-            dk=safe_dest_key(s3,bucket,f"{out_prefix.rstrip('/')}/{folder}",name,i)
-            label="✅ SIMILAR" if similar else "➡️ Other"
-            try:
-                upload_r2(s3,bucket,local,dk); st.write(f"{label} `{name}` → `{folder}/`")
-                summary.setdefault(folder,[]).append(name)
-            except Exception as e: st.error(f"❌ `{name}`: {e}")
-    bar.progress(1.0,text="Complete!")
-    moved_n     = len(summary.get(group_nm, []))
-    unchanged_n = len(summary.get("Other",   []))
-    log_session_event(
-        "r2_reference", bucket=bucket, source_prefix=prefix,
-        output_prefix=out_prefix, reference_image=ref_input, summary=summary,
-        extra={
-            "ref_category":    ref_cat,
-            "ref_subcategory": ref_sub,
-            "moved":           moved_n,
-            "unchanged_count": unchanged_n,
-            "total_processed": total,
-        }
-    )
-    return summary
-
-def seg_local_full(source,output,mode,bar):
-    images=find_local(source)
-    if not images: st.error(f"❌ No images in `{source}`"); return {}
-    total=len(images); summary={}
-    for i,path in enumerate(images,1):
-        name=os.path.basename(path); bar.progress(i/total,text=f"[{i}/{total}] {name}")
-        info=classify_image(path); group=get_group(info,mode)
-        dest_dir=os.path.join(output,group.replace("/",os.sep))
-        try:
-            safe_local_copy(path,dest_dir,i); st.write(f"✅ `{name}` → **{group}/**")
-            summary.setdefault(group,[]).append(name)
-        except Exception as e: st.error(f"❌ `{name}`: {e}")
-    bar.progress(1.0,text="Complete!")
-    moved_n = sum(len(v) for v in summary.values())
-    log_session_event(
-        "local_full", source_prefix=source, output_prefix=output,
-        mode=mode, summary=summary,
-        extra={
-            "moved":           moved_n,
-            "unchanged_count": total - moved_n,
-            "total_processed": total,
-        }
-    )
-    return summary
-
-def seg_local_ref(s3,bucket,ref_input,source,output,bar):
-    ref_tmp=None
-    try:
-        if os.path.isfile(ref_input): ref_info=classify_image(ref_input)
-        else:
-            ref_key=r2_key_from_input(ref_input,bucket); suffix=Path(ref_key).suffix or ".jpg"
-            f=tempfile.NamedTemporaryFile(suffix=suffix,delete=False); f.close(); ref_tmp=f.name
-            s3.download_file(bucket,ref_key,ref_tmp); ref_info=classify_image(ref_tmp)
-    except Exception as e: st.error(f"❌ Reference failed: {e}"); return {}
-    finally:
-        if ref_tmp and os.path.exists(ref_tmp): os.remove(ref_tmp)
-    ref_cat=ref_info["category"].lower(); ref_sub=ref_info["subcategory"].lower()
-    ref_tags={t.lower() for t in ref_info.get("tags",[])}
-    group_nm=sanitize(f"{ref_cat}_{ref_sub}") or "Similar"
-    st.info(f"Reference → **{ref_cat}/{ref_sub}**")
-    images=find_local(source)
-    if not images: st.error(f"❌ No images in `{source}`"); return {}
-    total=len(images); summary={}
-    for i,path in enumerate(images,1):
-        name=os.path.basename(path); bar.progress(i/total,text=f"[{i}/{total}] {name}")
-        info=classify_image(path); cat=info["category"].lower(); sub=info["subcategory"].lower()
-        tags={t.lower() for t in info.get("tags",[])}
-        similar=(cat==ref_cat) or (sub==ref_sub) or bool(tags&ref_tags)
-        folder=group_nm if similar else "Other"; label="✅ SIMILAR" if similar else "➡️ Other"
-        try:
-            safe_local_copy(path,os.path.join(output,folder),i)
-            st.write(f"{label} `{name}`"); summary.setdefault(folder,[]).append(name)
-        except Exception as e: st.error(f"❌ `{name}`: {e}")
-    bar.progress(1.0,text="Complete!")
-    moved_n     = len(summary.get(group_nm, []))
-    unchanged_n = len(summary.get("Other",   []))
-    log_session_event(
-        "local_reference", source_prefix=source, output_prefix=output,
-        reference_image=ref_input, summary=summary,
-        extra={
-            "moved":           moved_n,
-            "unchanged_count": unchanged_n,
-            "total_processed": total,
-        }
-    )
-    return summary
-
 
 # ════════════════════════════════════════════════════════════════════════════════
 #  UI — HEADER
@@ -566,7 +228,15 @@ def seg_local_ref(s3,bucket,ref_input,source,output,bar):
 st.title("🗂️ AI Image Segregator")
 st.caption("Cloudflare R2  ·  Pillow AI  ·  Auto-Bucket Detection  ·  JSON Session Logging")
 
-s3 = _s3_client()
+try:
+    s3 = _s3_client()
+except RuntimeError as e:       # no R2 credentials — the local tabs still work
+    s3 = None
+    st.sidebar.error(f"☁️ {e}")
+try:
+    _metrics_exporters()
+except OSError as e:            # port taken, file not writable
+    st.sidebar.warning(f"📈 Metrics not exported: {e}")
 
 # ════════════════════════════════════════════════════════════════════════════════
 #  SIDEBAR
@@ -611,6 +281,59 @@ with st.sidebar:
         }[x],
     )
     st.divider()
+    with st.expander("⚡ Pipeline workers"):
+        st.caption("Parallel workers per stage for the R2 engines.")
+        pipeline_workers = {
+            stage: st.number_input(label, min_value=1, max_value=64,
+                                   value=PIPELINE_WORKERS[stage], key=f"pw_{stage}")
+            for stage, label in [("download", "⬇️ Download"),
+                                 ("extract",  "🧠 Feature extraction"),
+                                 ("write",    "⬆️ Write")]
+        }
+        pipeline_workers["processes"] = st.number_input(
+            "🧮 Extraction processes", min_value=0, max_value=64,
+            value=PIPELINE_WORKERS["processes"], key="pw_processes",
+            help=f"CPU cores for decoding and features. 0 = in-thread only. "
+                 f"Jobs under {FEATURE_POOL_MIN_ITEMS} images skip a cold pool.")
+        pipeline_workers["slowest"] = st.number_input(
+            "🐢 Record slowest N images", min_value=0, max_value=100,
+            value=PIPELINE_WORKERS["slowest"], key="pw_slowest",
+            help="Keep the N slowest images of every run, with their own per-stage times, "
+                 "in ⏱️ Last run timings and the session log.")
+    with st.expander("🧠 Feature cache"):
+        _fc = cache_stats("features")
+        st.caption(f"{_fc['entries']} image(s) · {_fc['bytes']/1e6:.1f} / {_fc['max_bytes']/1e6:.0f} MB  \n"
+                   "Unchanged objects (same ETag) are never downloaded or analysed twice.")
+        if st.button("🗑️ Clear feature cache", key="clear_fc_btn", use_container_width=True):
+            clear_cache("features")
+            st.rerun()
+    with st.expander("🖼️ Thumbnail cache"):
+        _tc = cache_stats("thumbnails")
+        st.caption(f"{_tc['entries']} tile(s) · {_tc['bytes']/1e6:.1f} / {_tc['max_bytes']/1e6:.0f} MB {_tc['format']}  \n"
+                   "Gallery tiles are made once per image version and served from disk.")
+        if st.button("🗑️ Clear thumbnail cache", key="clear_tc_btn", use_container_width=True):
+            clear_cache("thumbnails")
+            st.rerun()
+    with st.expander("📂 Listing cache"):
+        _lc = cache_stats("listings")
+        st.caption(f"{_lc['entries']} listing(s) · {_lc['keys']:,} key(s) · {_lc['dirs']} folder(s) · kept {_lc['ttl']:.0f}s  \n"
+                   "Moves, uploads and deletes made here update it. Changed the bucket elsewhere? Refresh.")
+        if st.button("🔄 Force refresh listings", key="refresh_lc_btn", use_container_width=True):
+            clear_cache("listings")
+            st.session_state["_scan_result"] = None
+            st.rerun()
+    _render_timings_sidebar()
+    _jobs = unfinished_jobs()
+    if _jobs:
+        with st.expander(f"🧾 Interrupted jobs ({len(_jobs)})"):
+            st.caption("Run the same job again to resume — finished images are not transferred twice.")
+            for _j in _jobs:
+                _when = datetime.datetime.fromtimestamp(_j["updated"]).strftime("%Y-%m-%d %H:%M")
+                _st   = " · ".join(f"{n} {k}" for k, n in sorted(_j["states"].items())) or "nothing done yet"
+                st.markdown(f"**{_j['kind']}** `{_j['bucket']}` — {_j['label']}  \n{_st} · last activity {_when}")
+                if st.button("🗑️ Discard", key=f"discard_{_j['job']}", use_container_width=True):
+                    discard_job(_j["job"])
+                    st.rerun()
     st.caption("Supported: JPG PNG GIF WEBP BMP TIFF")
 
     with st.expander("ℹ️ How new buckets work"):
@@ -661,7 +384,7 @@ else:
     if scan_btn or quick_btn:
         pfx = "" if quick_btn else scan_pfx
         with st.spinner(f"Scanning `{bucket}` …"):
-            result = scan_bucket(s3, bucket, pfx)
+            result = scan_bucket(s3, bucket, pfx, report=StreamlitReporter())
         st.session_state["_scan_result"] = result
         st.session_state["_scan_pfx"]    = pfx
 
@@ -706,7 +429,7 @@ else:
                         _rs = Path(_upl.name).suffix or ".jpg"
                         if st.button(f"🚀 Sort {len(fkeys)} images", key=f"scan_sort_{folder}", type="primary"):
                             _b = st.progress(0.0, text="Sorting…")
-                            _r = seg_folder_by_upload(s3, bucket, folder, _rb, _rs, _b)
+                            _r = seg_folder_by_upload(s3, bucket, folder, _rb, _rs, StreamlitReporter(_b), workers=pipeline_workers)
                             if _r:
                                 st.success(f"✅ {len(_r.get('moved',[]))} moved · {len(_r.get('unchanged',[]))} stayed")
 
@@ -718,11 +441,9 @@ else:
                         st.warning(f"⚠️ Delete ALL {len(fkeys)} images in `{display}`?")
                         _da, _db = st.columns(2)
                         if _da.button("✅ Yes", key=f"scan_delyes_{folder}", type="primary"):
-                            _deleted = 0
-                            for _k in fkeys:
-                                try: s3.delete_object(Bucket=bucket, Key=_k); _deleted += 1
-                                except: pass
-                            st.success(f"✅ Deleted {_deleted} images")
+                            _deleted, _derrs = delete_r2_many(s3, bucket, fkeys)
+                            st.success(f"✅ Deleted {len(_deleted)} images")
+                            for _k, _de in list(_derrs.items())[:20]: st.error(f"Failed `{_k}`: {_de}")
                             st.session_state[f"scan_del_confirm_{folder}"] = False
                             del st.session_state["_scan_result"]
                             st.rerun()
@@ -775,6 +496,8 @@ with tab_r1:
     op1   = c2.text_input("Output Prefix  (sorted results go here)", placeholder="sorted/", key="op1")
     if bucket:
         st.info(f"📦 Bucket: **`{bucket}`**  |  📂 Source: **`{pfx1 or '(entire bucket)'}`**  |  📤 Output: **`{op1 or '?'}`**")
+    inc1  = st.checkbox("⏩ Only new or changed images", key="inc1",
+                        help="Skip images this same sort (source, output, grouping mode) already placed.")
     if st.button("🚀 Start R2 Segregation", key="b1", type="primary"):
         errs=[]
         if not connected: errs.append("R2 not connected.")
@@ -783,7 +506,7 @@ with tab_r1:
         for e in errs: st.error(e)
         if not errs:
             bar=st.progress(0.0,text="Starting…")
-            summary=seg_r2_full(s3,bucket,pfx1,op1,mode,bar)
+            summary=seg_r2_full(s3,bucket,pfx1,op1,mode,StreamlitReporter(bar),pipeline_workers,inc1)
             if summary: show_summary(summary)
 
 with tab_r2:
@@ -794,6 +517,8 @@ with tab_r2:
     c1,c2=st.columns(2)
     pfx2 =c1.text_input("Source Prefix", value=_auto_pfx, placeholder="masterImgs/  or blank", key="pfx2")
     op2  =c2.text_input("Output Prefix", placeholder="sorted/", key="op2")
+    inc2 =st.checkbox("⏩ Only new or changed images", key="inc2",
+                      help="Skip images this same sort (source, output, reference class) already placed.")
     if st.button("🔍 Find & Segregate", key="b2", type="primary"):
         errs=[]
         if not connected: errs.append("R2 not connected.")
@@ -803,7 +528,7 @@ with tab_r2:
         for e in errs: st.error(e)
         if not errs:
             bar=st.progress(0.0,text="Fetching reference…")
-            summary=seg_r2_ref(s3,bucket,ref2,pfx2,op2,bar)
+            summary=seg_r2_ref(s3,bucket,ref2,pfx2,op2,StreamlitReporter(bar),pipeline_workers,inc2)
             if summary: show_summary(summary)
 
 with tab_l1:
@@ -827,7 +552,7 @@ with tab_l1:
         for e in errs: st.error(e)
         if not errs:
             bar=st.progress(0.0,text="Starting…")
-            summary=seg_local_full(src3,out3,mode,bar)
+            summary=seg_local_full(src3,out3,mode,StreamlitReporter(bar),pipeline_workers)
             if summary: show_summary(summary)
 
 with tab_l2:
@@ -852,279 +577,13 @@ with tab_l2:
         for e in errs: st.error(e)
         if not errs:
             bar=st.progress(0.0,text="Starting…")
-            summary=seg_local_ref(s3,bucket,ref4,src4,out4,bar)
+            summary=seg_local_ref(s3,bucket,ref4,src4,out4,StreamlitReporter(bar),pipeline_workers)
             if summary: show_summary(summary)
 
 
 # ════════════════════════════════════════════════════════════════════════════════
 #  IMAGE GALLERY helpers
 # ════════════════════════════════════════════════════════════════════════════════
-def get_presigned_url(s3, bucket: str, key: str, expires: int = 600) -> str:
-    try:
-        return s3.generate_presigned_url(
-            "get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=expires)
-    except Exception:
-        return ""
-
-_HASH_THRESHOLD_PLACEHOLDER = 12
-_HASH_THRESHOLD_REAL        = 8
-_PIXEL_THRESHOLD_PLACEHOLDER= 0.82
-_PIXEL_THRESHOLD_REAL       = 0.88
-
-
-# ════════════════════════════════════════════════════════════════════════════════
-# PHASE 1: preview_folder_by_upload — scan only, nothing moved
-# ════════════════════════════════════════════════════════════════════════════════
-def preview_folder_by_upload(s3, bucket: str, folder_prefix: str,
-                              ref_bytes: bytes, ref_suffix: str, bar) -> dict:
-    with tempfile.NamedTemporaryFile(suffix=ref_suffix, delete=False) as tf:
-        tf.write(ref_bytes); tf.flush(); ref_path = tf.name
-    try:
-        ref_img            = PILImage.open(ref_path).convert("RGB")
-        ref_info           = classify_image(ref_path)
-        ref_hash           = _perceptual_hash(ref_img)
-        ref_is_placeholder = _detect_placeholder_text(ref_img)
-    finally:
-        os.remove(ref_path)
-
-    ref_cat = ref_info["category"].lower().strip()
-    ref_sub = ref_info["subcategory"].lower().strip()
-
-    if ref_is_placeholder:
-        dest_sub        = "no_image"
-        hash_threshold  = _HASH_THRESHOLD_PLACEHOLDER
-        pixel_threshold = _PIXEL_THRESHOLD_PLACEHOLDER
-    else:
-        dest_sub        = sanitize(f"{ref_cat}_{ref_sub}")
-        hash_threshold  = _HASH_THRESHOLD_REAL
-        pixel_threshold = _PIXEL_THRESHOLD_REAL
-
-    base_pfx = folder_prefix.rstrip("/") + "/" if folder_prefix else ""
-    new_pfx  = base_pfx + dest_sub + "/"
-
-    all_img, _, _ = scan_bucket(s3, bucket, folder_prefix, max_keys=0)
-    direct_keys = [
-        k for k in all_img
-        if "/" not in (k[len(base_pfx):] if base_pfx and k.startswith(base_pfx) else k)
-        and (k[len(base_pfx):] if base_pfx and k.startswith(base_pfx) else k)
-    ]
-
-    if not direct_keys:
-        return {}
-
-    total = len(direct_keys)
-    to_move, to_stay = [], []
-
-    with tempfile.TemporaryDirectory() as tmp:
-        for i, key in enumerate(direct_keys, 1):
-            name = Path(key).name
-            bar.progress(i / total, text=f"Analysing [{i}/{total}] {name}")
-            local = os.path.join(tmp, f"{i}_{name}")
-            try:
-                s3.download_file(bucket, key, local)
-            except Exception as e:
-                st.warning(f"⚠️ Download `{key}`: {e}"); continue
-            try:
-                img             = PILImage.open(local).convert("RGB")
-                img_hash        = _perceptual_hash(img)
-                hash_dist       = _hamming_distance(ref_hash, img_hash)
-                pixel_sim       = _pixel_similarity(ref_img, img)
-                img_placeholder = _detect_placeholder_text(img) if ref_is_placeholder else False
-            except Exception:
-                hash_dist = 999; pixel_sim = 0.0; img_placeholder = False
-
-            if ref_is_placeholder:
-                is_similar = hash_dist <= hash_threshold or pixel_sim >= pixel_threshold or img_placeholder
-                reason = ("placeholder_visual" if img_placeholder else
-                          "hash_match" if hash_dist <= hash_threshold else "pixel_match")
-            else:
-                is_similar = hash_dist <= hash_threshold or pixel_sim >= pixel_threshold
-                reason = "hash_match" if hash_dist <= hash_threshold else "pixel_match"
-
-            rec = {"key": key, "filename": name,
-                   "hash_dist": hash_dist, "pixel_sim": round(pixel_sim, 4)}
-            if is_similar:
-                rec["reason"] = reason; to_move.append(rec)
-            else:
-                to_stay.append(rec)
-
-    bar.progress(1.0, text="Analysis complete!")
-    return {
-        "folder":          folder_prefix or "(root)",
-        "dest_folder":     new_pfx,
-        "reference_type":  "placeholder" if ref_is_placeholder else "real",
-        "reference_class": dest_sub,
-        "total_scanned":   total,
-        "to_move_count":   len(to_move),
-        "to_stay_count":   len(to_stay),
-        "to_move":         to_move,
-        "to_stay":         to_stay,
-    }
-
-
-# ════════════════════════════════════════════════════════════════════════════════
-# PHASE 2: seg_folder_by_upload — execute move (uses preview_data if supplied)
-# ════════════════════════════════════════════════════════════════════════════════
-def seg_folder_by_upload(s3, bucket: str, folder_prefix: str,
-                         ref_bytes: bytes, ref_suffix: str, bar,
-                         preview_data: dict = None) -> dict:
-
-    # ── LEGACY path (no preview_data) ────────────────────────────────────────
-    if preview_data is None:
-        with tempfile.NamedTemporaryFile(suffix=ref_suffix, delete=False) as tf:
-            tf.write(ref_bytes); tf.flush(); ref_path = tf.name
-        try:
-            ref_img            = PILImage.open(ref_path).convert("RGB")
-            ref_info           = classify_image(ref_path)
-            ref_hash           = _perceptual_hash(ref_img)
-            ref_is_placeholder = _detect_placeholder_text(ref_img)
-        finally:
-            os.remove(ref_path)
-
-        ref_cat  = ref_info["category"].lower().strip()
-        ref_sub  = ref_info["subcategory"].lower().strip()
-        ref_tags = {t.lower() for t in ref_info.get("tags", [])}
-
-        if ref_is_placeholder:
-            dest_sub        = "no_image"
-            hash_threshold  = _HASH_THRESHOLD_PLACEHOLDER
-            pixel_threshold = _PIXEL_THRESHOLD_PLACEHOLDER
-            st.info(f"📎 Reference detected as **placeholder**\n\n"
-                    f"✅ Matches → `{folder_prefix.rstrip('/')}/{dest_sub}/`\n\n"
-                    f"➡️ All OTHER images stay exactly where they are.")
-        else:
-            dest_sub        = sanitize(f"{ref_cat}_{ref_sub}")
-            hash_threshold  = _HASH_THRESHOLD_REAL
-            pixel_threshold = _PIXEL_THRESHOLD_REAL
-            st.info(f"📎 Reference → **{ref_info['category']} / {ref_info['subcategory']}**\n\n"
-                    f"✅ Similar → `{folder_prefix.rstrip('/')}/{dest_sub}/`\n\n"
-                    f"➡️ All OTHER images stay exactly where they are.")
-
-        base_pfx = folder_prefix.rstrip("/") + "/" if folder_prefix else ""
-        new_pfx  = base_pfx + dest_sub + "/"
-
-        all_img, _, _ = scan_bucket(s3, bucket, folder_prefix, max_keys=0)
-        direct_keys = [
-            k for k in all_img
-            if "/" not in (k[len(base_pfx):] if base_pfx and k.startswith(base_pfx) else k)
-            and (k[len(base_pfx):] if base_pfx and k.startswith(base_pfx) else k)
-        ]
-
-        if not direct_keys:
-            st.error("❌ No direct images found in this folder.")
-            return {}
-
-        total = len(direct_keys)
-        st.info(f"Scanning **{total}** images in `{folder_prefix or '(root)'}`…")
-        result = {"moved": [], "unchanged": []}
-
-        with tempfile.TemporaryDirectory() as tmp:
-            for i, key in enumerate(direct_keys, 1):
-                name = Path(key).name
-                bar.progress(i / total, text=f"[{i}/{total}] {name}")
-                local = os.path.join(tmp, f"{i}_{name}")
-                try:
-                    s3.download_file(bucket, key, local)
-                except Exception as e:
-                    st.warning(f"⚠️ Download `{key}`: {e}"); continue
-                try:
-                    img             = PILImage.open(local).convert("RGB")
-                    img_hash        = _perceptual_hash(img)
-                    hash_dist       = _hamming_distance(ref_hash, img_hash)
-                    pixel_sim       = _pixel_similarity(ref_img, img)
-                    img_placeholder = _detect_placeholder_text(img) if ref_is_placeholder else False
-                except Exception:
-                    hash_dist = 999; pixel_sim = 0.0; img_placeholder = False
-
-                if ref_is_placeholder:
-                    is_similar = (hash_dist <= hash_threshold or
-                                  pixel_sim >= pixel_threshold or img_placeholder)
-                else:
-                    is_similar = (hash_dist <= hash_threshold or pixel_sim >= pixel_threshold)
-
-                if is_similar:
-                    dest_key = safe_dest_key(s3, bucket, new_pfx.rstrip("/"), name, i)
-                    try:
-                        upload_r2(s3, bucket, local, dest_key)
-                        s3.delete_object(Bucket=bucket, Key=key)
-                        label = ("🚫 PLACEHOLDER" if ref_is_placeholder and img_placeholder
-                                 else "🔁 SIMILAR-PLACEHOLDER" if ref_is_placeholder
-                                 else "✅ MOVED")
-                        st.write(f"{label}  `{name}` → `{new_pfx}`")
-                        result["moved"].append(name)
-                    except Exception as e:
-                        st.error(f"❌ Move failed `{name}`: {e}")
-                else:
-                    st.write(f"➡️ STAYS  `{name}`  (hash dist: {hash_dist} | pixel sim: {pixel_sim:.2f})")
-                    result["unchanged"].append(name)
-
-        bar.progress(1.0, text="Complete!")
-        moved_n     = len(result.get("moved", []))
-        unchanged_n = len(result.get("unchanged", []))
-        log_session_event(
-            "r2_folder_upload", bucket=bucket, source_prefix=folder_prefix,
-            output_prefix=new_pfx, reference_image="<uploaded>",
-            summary={dest_sub: result.get("moved", [])},
-            extra={
-                "is_placeholder":  ref_is_placeholder,
-                "dest_sub":        dest_sub,
-                "moved":           moved_n,
-                "unchanged_count": unchanged_n,
-                "total_processed": moved_n + unchanged_n,
-            }
-        )
-        return result
-
-    # ── PHASE 2: execute from preview_data ───────────────────────────────────
-    keys_to_move = [rec["key"] for rec in preview_data.get("to_move", [])]
-    new_pfx      = preview_data["dest_folder"]
-    dest_sub     = preview_data["reference_class"]
-
-    if not keys_to_move:
-        st.warning("No images to move based on preview.")
-        return {"moved": [], "unchanged": []}
-
-    total  = len(keys_to_move)
-    result = {"moved": [], "unchanged": []}
-    st.info(f"Moving **{total}** matched images → `{new_pfx}`")
-
-    with tempfile.TemporaryDirectory() as tmp:
-        for i, key in enumerate(keys_to_move, 1):
-            name = Path(key).name
-            bar.progress(i / total, text=f"Moving [{i}/{total}] {name}")
-            local = os.path.join(tmp, f"{i}_{name}")
-            try:
-                s3.download_file(bucket, key, local)
-            except Exception as e:
-                st.warning(f"⚠️ Download `{key}`: {e}"); continue
-            dk = safe_dest_key(s3, bucket, new_pfx.rstrip("/"), name, i)
-            try:
-                upload_r2(s3, bucket, local, dk)
-                s3.delete_object(Bucket=bucket, Key=key)
-                st.write(f"✅ MOVED  `{name}` → `{new_pfx}`")
-                result["moved"].append(name)
-            except Exception as e:
-                st.error(f"❌ Move failed `{name}`: {e}")
-
-    result["unchanged"] = [rec["filename"] for rec in preview_data.get("to_stay", [])]
-    bar.progress(1.0, text="Segregation complete!")
-
-    moved_n     = len(result.get("moved", []))
-    unchanged_n = len(result.get("unchanged", []))
-    log_session_event(
-        "r2_folder_upload", bucket=bucket,
-        source_prefix=preview_data.get("folder", ""),
-        output_prefix=new_pfx, reference_image="<uploaded>",
-        summary={dest_sub: result.get("moved", [])},
-        extra={
-            "is_placeholder":  preview_data.get("reference_type") == "placeholder",
-            "dest_sub":        dest_sub,
-            "moved":           moved_n,
-            "unchanged_count": unchanged_n,
-            "total_processed": preview_data.get("total_scanned", 0),
-        }
-    )
-    return result
 
 
 # ════════════════════════════════════════════════════════════════════════════════
@@ -1171,7 +630,7 @@ if bucket:
 
     for path_pfx, path_label, path_icon in PREDEFINED_PATHS:
         with st.expander(f"{path_icon} {path_label} — `{path_pfx}`"):
-            _img_in_path, _, _ = scan_bucket(s3, bucket, path_pfx, max_keys=0)
+            _img_in_path, _, _ = scan_bucket(s3, bucket, path_pfx, max_keys=0, report=StreamlitReporter())
             _base = path_pfx.rstrip("/") + "/"
             _direct_in_path = [
                 k for k in _img_in_path
@@ -1195,14 +654,9 @@ if bucket:
                 _ref_b = _up.read()
                 _ref_s = Path(_up.name).suffix or ".jpg"
 
-                with tempfile.NamedTemporaryFile(suffix=_ref_s, delete=False) as _tf:
-                    _tf.write(_ref_b); _tf.flush(); _tf_path = _tf.name
-                try:
-                    _prev_info        = classify_image(_tf_path)
-                    _prev_img         = PILImage.open(_tf_path).convert("RGB")
-                    _prev_placeholder = _detect_placeholder_text(_prev_img)
-                finally:
-                    os.remove(_tf_path)
+                _prev_feat        = extract_features(_ref_b, placeholder=True)
+                _prev_info        = classify_features(_prev_feat)
+                _prev_placeholder = _prev_feat["placeholder"]
 
                 if _prev_placeholder:
                     _dest_sub   = "no_image"
@@ -1221,7 +675,7 @@ if bucket:
                 if st.button(f"🔍 Find Similar Images — {path_label}  ({len(_direct_in_path)} unsorted)",
                              key=f"pred_prev_btn_{path_pfx}"):
                     _pb = st.progress(0.0, text="Analysing images…")
-                    _pv = preview_folder_by_upload(s3, bucket, path_pfx, _ref_b, _ref_s, _pb)
+                    _pv = preview_folder_by_upload(s3, bucket, path_pfx, _ref_b, _ref_s, StreamlitReporter(_pb), pipeline_workers)
                     st.session_state[_prev_state_key] = _pv if _pv else None
                     if not _pv:
                         st.error("❌ No images found in this folder.")
@@ -1266,38 +720,16 @@ if bucket:
                             key=f"pred_sort_{path_pfx}", type="primary",
                         ):
                             _bar = st.progress(0.0, text="Moving images…")
-                            _res = seg_folder_by_upload(s3, bucket, path_pfx, _ref_b, _ref_s, _bar, preview_data=_stored_pv)
+                            _res = seg_folder_by_upload(s3, bucket, path_pfx, _ref_b, _ref_s, StreamlitReporter(_bar),
+                                                        preview_data=_stored_pv, workers=pipeline_workers)
                             if _res:
-                                _moved_n = len(_res.get("moved", []))
-                                _unch_n  = len(_res.get("unchanged", []))
                                 # build result JSON for download
-                                _seg_json = {
-                                    "event":           "segregation_complete",
-                                    "timestamp":       datetime.datetime.now().isoformat(),
-                                    "bucket":          bucket,
-                                    "source_folder":   path_pfx,
-                                    "dest_folder":     _stored_pv.get("dest_folder"),
-                                    "reference_type":  _stored_pv.get("reference_type"),
-                                    "reference_class": _stored_pv.get("reference_class"),
-                                    "moved_count":     _moved_n,
-                                    "unchanged_count": _unch_n,
-                                    "total_scanned":   _stored_pv.get("total_scanned", 0),
-                                    "moved_files": [
-                                        {"r2_key": _stored_pv["dest_folder"] + fn, "filename": fn}
-                                        for fn in _res.get("moved", [])
-                                    ],
-                                    "unchanged_files": [
-                                        {"r2_key": path_pfx + fn, "filename": fn}
-                                        for fn in _res.get("unchanged", [])
-                                    ],
-                                }
+                                _seg_json = segregation_result(bucket, path_pfx, _stored_pv, _res)
                                 st.session_state[f"pred_seg_result_{path_pfx}"] = _seg_json
                                 st.session_state[f"pred_seg_moved_keys_{path_pfx}"] = [
                                     _stored_pv["dest_folder"] + fn for fn in _res.get("moved", [])
                                 ]
                                 st.session_state[_prev_state_key] = None
-                                if "gal_all_folders" in st.session_state:
-                                    del st.session_state["gal_all_folders"]
                                 st.rerun()
                     else:
                         st.info("ℹ️ No similar images found — nothing to segregate.")
@@ -1330,20 +762,16 @@ if bucket:
                         _dca, _dcb = st.columns(2)
                         if _dca.button("✅ Yes, delete all moved files", key=f"pred_seg_delyes_{path_pfx}", type="primary"):
                             _moved_keys_to_del = st.session_state.get(f"pred_seg_moved_keys_{path_pfx}", [])
-                            _del_ok = 0
                             _dbar2 = st.progress(0.0, text="Deleting…")
-                            for _di, _dk in enumerate(_moved_keys_to_del, 1):
-                                _dbar2.progress(_di / max(len(_moved_keys_to_del), 1),
-                                               text=f"Deleting {_di}/{len(_moved_keys_to_del)}")
-                                try: s3.delete_object(Bucket=bucket, Key=_dk); _del_ok += 1
-                                except: pass
+                            _del_ok, _del_errs = delete_r2_many(
+                                s3, bucket, _moved_keys_to_del,
+                                progress=lambda d, t: _dbar2.progress(d / t, text=f"Deleting {d}/{t}"))
                             _dbar2.empty()
-                            st.success(f"✅ Deleted {_del_ok} files.")
+                            st.success(f"✅ Deleted {len(_del_ok)} files.")
+                            for _k, _de in list(_del_errs.items())[:20]: st.error(f"Failed `{_k}`: {_de}")
                             st.session_state[f"pred_seg_result_{path_pfx}"]      = None
                             st.session_state[f"pred_seg_moved_keys_{path_pfx}"]  = []
                             st.session_state[f"pred_seg_del_confirm_{path_pfx}"] = False
-                            if "gal_all_folders" in st.session_state:
-                                del st.session_state["gal_all_folders"]
                             st.rerun()
                         if _dcb.button("❌ Cancel", key=f"pred_seg_delno_{path_pfx}"):
                             st.session_state[f"pred_seg_del_confirm_{path_pfx}"] = False
@@ -1362,11 +790,9 @@ if bucket:
                 st.warning(f"⚠️ Delete ALL {len(_img_in_path)} images in `{path_pfx}`?")
                 _da, _db = st.columns(2)
                 if _da.button("✅ Yes, delete all", key=f"pred_delyes_{path_pfx}", type="primary"):
-                    _deleted = 0
-                    for _k in _img_in_path:
-                        try: s3.delete_object(Bucket=bucket, Key=_k); _deleted += 1
-                        except: pass
-                    st.success(f"✅ Deleted {_deleted} images")
+                    _deleted, _derrs = delete_r2_many(s3, bucket, _img_in_path)
+                    st.success(f"✅ Deleted {len(_deleted)} images")
+                    for _k, _de in list(_derrs.items())[:20]: st.error(f"Failed `{_k}`: {_de}")
                     st.session_state[f"pred_del_confirm_{path_pfx}"] = False
                     st.rerun()
                 if _db.button("❌ Cancel", key=f"pred_delno_{path_pfx}"):
@@ -1376,12 +802,72 @@ if bucket:
             if st.button(f"👁️ View Images in `{path_pfx}`", key=f"pred_view_{path_pfx}"):
                 st.session_state["gal_folder"] = path_pfx
                 st.session_state["gal_keys"]   = _img_in_path
+                st.session_state["gal_versions"] = {}       # unknown here — one HEAD per tile finds them
                 st.rerun()
 
     st.divider()
 
+    # ── Similar-image search over the hash index ─────────────────────────────
+    with st.expander(f"🔎 Search similar images — {indexed_count(bucket)} indexed in `{bucket}`"):
+        st.caption("Finds near-duplicates of an uploaded image among every indexed image in the bucket. "
+                   "Images are indexed whenever an engine analyses them, or with 🧮 Index below.")
+        _sx1, _sx2 = st.columns([3, 1])
+        _idx_pfx = _sx1.text_input("Prefix to index / search (blank = whole bucket)", key="hidx_pfx")
+        if _sx2.button("🧮 Index", key="hidx_btn", use_container_width=True):
+            _ib = st.progress(0.0, text="Indexing…")
+            st.success(f"✅ Indexed {index_prefix(s3, bucket, _idx_pfx, StreamlitReporter(_ib), pipeline_workers)} image(s)")
+
+        _s_up  = st.file_uploader("Image to search for", type=["jpg","jpeg","png","gif","webp","bmp","tiff"],
+                                  key="hidx_up")
+        _s_rad = st.slider("Max hash distance", 0, 20, HASH_RADIUS, key="hidx_rad")
+        if _s_up is not None and st.button("🔎 Search", key="hidx_search", type="primary"):
+            _s_hash = extract_features(_s_up.read())["hash"]
+            st.session_state["hidx_hits"] = search_similar(bucket, _s_hash, _s_rad,
+                                                            prefix=_idx_pfx.strip().lstrip("/"))
+        _hits = st.session_state.get("hidx_hits")
+        if _hits is not None:
+            st.markdown(f"**{len(_hits)}** match(es)" + (" — showing nearest 48" if len(_hits) > 48 else ""))
+            _htiles = _tiles(s3, bucket, [_hk for _hk, _ in _hits[:48]])
+            for _rs in range(0, min(len(_hits), 48), 6):
+                for _col, (_hk, _hd) in zip(st.columns(6), _hits[_rs:_rs + 6]):
+                    with _col:
+                        _thumb(s3, bucket, _hk, 140, "similar", _htiles.get(_hk))
+                        st.markdown(f'<div class="gal-img-name" title="{_hk}">{Path(_hk).name} · d={_hd}</div>',
+                                    unsafe_allow_html=True)
+
+
+    # ── Near-duplicate clusters across a prefix ──────────────────────────────
+    with st.expander("🧬 Near-duplicate clusters"):
+        st.caption("Groups every image under a prefix into clusters of near-duplicates — no reference needed. "
+                   "Each cluster suggests one image to keep (highest resolution, then largest file). Nothing is moved.")
+        _dc1, _dc2 = st.columns([3, 1])
+        _dup_pfx = _dc1.text_input("Prefix to cluster (blank = whole bucket)", value=_auto_pfx, key="dup_pfx")
+        if _dc2.button("🧬 Find Clusters", key="dup_btn", type="primary", use_container_width=True):
+            _db_bar = st.progress(0.0, text="Scanning…")
+            st.session_state["dup_preview"] = preview_duplicate_clusters(
+                s3, bucket, _dup_pfx.strip().lstrip("/"), StreamlitReporter(_db_bar), pipeline_workers)
+        _dup_pv = st.session_state.get("dup_preview")
+        if _dup_pv is not None:
+            if not _dup_pv:
+                st.warning("No images found under that prefix.")
+            else:
+                _dm1, _dm2, _dm3 = st.columns(3)
+                _dm1.metric("Scanned",    _dup_pv["total_scanned"])
+                _dm2.metric("Clusters",   _dup_pv["cluster_count"])
+                _dm3.metric("Duplicates", _dup_pv["duplicate_count"])
+                with st.expander(f"📄 JSON Preview — {_dup_pv['cluster_count']} cluster(s)", expanded=False):
+                    st.json(_dup_pv)
+                st.download_button(
+                    label="⬇️ Download Clusters JSON",
+                    data=json.dumps(_dup_pv, indent=2, ensure_ascii=False, default=str),
+                    file_name=f"duplicates_{_dup_pv['folder'].replace('/','_')}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
+                    mime="application/json", key="dup_dl",
+                )
+
+    st.divider()
+
 # ── Session state init ───────────────────────────────────────────────────────
-for _k, _v in [("gal_folder", None), ("gal_keys", []), ("gal_upref_open", None)]:
+for _k, _v in [("gal_folder", None), ("gal_keys", []), ("gal_upref_open", None), ("gal_expanded", set())]:
     if _k not in st.session_state:
         st.session_state[_k] = _v
 
@@ -1392,36 +878,50 @@ else:
     gal_col1.markdown("#### Step 1 — Choose a folder to browse or sort")
     refresh_gal = gal_col2.button("🔄 Refresh Folders", key="gal_refresh", use_container_width=True)
 
-    if refresh_gal or "gal_all_folders" not in st.session_state:
+    # folders are listed one level at a time (Delimiter="/") and only when
+    # expanded, so a bucket with millions of keys opens with a single request
+    if refresh_gal: clear_cache("listings", bucket)
+    gal_expanded: set = st.session_state["gal_expanded"]
+    try:
         with st.spinner("Loading folder list…"):
-            _gal_imgs, _, _ = scan_bucket(s3, bucket, "", max_keys=5000)
-            _fmap: dict = {}
-            for k in _gal_imgs:
-                parts  = k.split("/")
-                folder = "/".join(parts[:-1]) + "/" if len(parts) > 1 else "(root)"
-                _fmap[folder] = _fmap.get(folder, 0) + 1
-            st.session_state["gal_all_folders"] = _fmap
-
-    folder_map_gal: dict = st.session_state.get("gal_all_folders", {})
+            gal_rows = _gal_tree(s3, bucket, gal_expanded)
+    except Exception as e:
+        st.error(f"Scan error: {e}")
+        gal_rows = []
 
-    if not folder_map_gal:
+    if not gal_rows:
         st.warning("No images found in this bucket.")
     else:
-        for folder_path, img_count in sorted(folder_map_gal.items()):
-            fa, fb, fc, fd = st.columns([4, 1, 2, 1])
-            display = folder_path if folder_path != "(root)" else "📦 (root)"
-            fa.markdown(f'<div class="gal-folder-bar">📁 <span>{display}</span> — {img_count} image(s)</div>',
-                        unsafe_allow_html=True)
+        for folder_path, depth, listing in gal_rows:
+            ft, fa, fb, fc, fd = st.columns([0.4, 4, 1, 2, 1])
+            if folder_path == "(root)":
+                display = "📦 (root)"
+            else:
+                display = folder_path
+                if (listing is None or listing["folders"]) and ft.button("▼" if folder_path in gal_expanded else "▶", key=f"gal_tree_{folder_path}"):
+                    gal_expanded.symmetric_difference_update({folder_path})
+                    st.rerun()
+            img_count = _gal_count(listing) if listing else "?"
+            if listing is None:
+                counts = "expand to count"
+            else:
+                counts = f"{img_count} image(s)" + (f" · {len(listing['folders'])} folder(s)" if listing["folders"] else "")
+            name = display if folder_path == "(root)" else folder_path.rstrip("/").rsplit("/", 1)[-1] + "/"
+            fa.markdown(f'<div class="gal-folder-bar" style="margin-left:{depth * 1.5}em" title="{display}">'
+                        f'📁 <span>{name}</span> — {counts}</div>', unsafe_allow_html=True)
 
             if fb.button("📂 Open", key=f"gal_open_{folder_path}", use_container_width=True):
                 with st.spinner(f"Loading `{folder_path}`…"):
                     pfx_use = "" if folder_path == "(root)" else folder_path
-                    _fkeys, _, _ = scan_bucket(s3, bucket, pfx_use, max_keys=2000)
-                    pfx_str = pfx_use.rstrip("/") + "/" if pfx_use else ""
-                    direct  = [k for k in _fkeys
-                                if (k[len(pfx_str):] if pfx_str and k.startswith(pfx_str) else k).find("/") == -1]
+                    _fl = list_folder(s3, bucket, pfx_use)
+                    _fkeys, _fver = _fl["images"], _fl["versions"]
+                    if not _fkeys:      # no direct images: show the sub-folders' images, as before
+                        _meta = {}
+                        _fkeys, _, _ = scan_bucket(s3, bucket, pfx_use, max_keys=2000, meta=_meta)
+                        _fver = {k: m["version"] for k, m in _meta.items()}
+                    st.session_state["gal_versions"]   = _fver
                     st.session_state["gal_folder"]     = folder_path
-                    st.session_state["gal_keys"]       = direct if direct else _fkeys
+                    st.session_state["gal_keys"]       = _fkeys
                     st.session_state["gal_upref_open"] = None
 
             btn_label = "✅ Close" if st.session_state["gal_upref_open"] == folder_path else "⬆️ Upload & Sort"
@@ -1434,19 +934,15 @@ else:
                 st.session_state[f"gal_del_confirm_{folder_path}"] = True
 
             if st.session_state.get(f"gal_del_confirm_{folder_path}"):
-                st.warning(f"⚠️ Delete ALL {img_count} images in `{display}`?")
+                st.warning(f"⚠️ Delete ALL images in `{display}` and its sub-folders?")
                 _da, _db = st.columns(2)
                 if _da.button("✅ Yes", key=f"gal_delyes_{folder_path}", type="primary"):
                     pfx_use = "" if folder_path == "(root)" else folder_path
-                    _all_keys, _, _ = scan_bucket(s3, bucket, pfx_use, max_keys=5000)
-                    _deleted = 0
-                    for _k in _all_keys:
-                        try: s3.delete_object(Bucket=bucket, Key=_k); _deleted += 1
-                        except: pass
-                    st.success(f"✅ Deleted {_deleted} images")
+                    _all_keys, _, _ = scan_bucket(s3, bucket, pfx_use, max_keys=5000, report=StreamlitReporter())
+                    _deleted, _derrs = delete_r2_many(s3, bucket, _all_keys)
+                    st.success(f"✅ Deleted {len(_deleted)} images")
+                    for _k, _de in list(_derrs.items())[:20]: st.error(f"Failed `{_k}`: {_de}")
                     st.session_state[f"gal_del_confirm_{folder_path}"] = False
-                    if "gal_all_folders" in st.session_state:
-                        del st.session_state["gal_all_folders"]
                     st.rerun()
                 if _db.button("❌ Cancel", key=f"gal_delno_{folder_path}"):
                     st.session_state[f"gal_del_confirm_{folder_path}"] = False
@@ -1455,6 +951,7 @@ else:
             # ── Upload & Sort Panel ──────────────────────────────────────────
             if st.session_state["gal_upref_open"] == folder_path:
                 pfx_use = "" if folder_path == "(root)" else folder_path
+                if listing is None: img_count = _gal_count(list_folder(s3, bucket, pfx_use))
                 st.markdown(f"""<div class="ref-upload-box">
 <h5>⬆️ Upload Reference — <code>{display}</code></h5>
 <p>Step 1: Upload → click <b>🔍 Find Similar Images</b> to preview JSON.</p>
@@ -1474,14 +971,9 @@ else:
                     prev_col, info_col = st.columns([1, 2])
                     prev_col.image(ref_bytes, caption="Your reference", width=200)
 
-                    with tempfile.NamedTemporaryFile(suffix=ref_suffix, delete=False) as _tf:
-                        _tf.write(ref_bytes); _tf.flush(); _tf_path = _tf.name
-                    try:
-                        _prev             = classify_image(_tf_path)
-                        _prev_img         = PILImage.open(_tf_path).convert("RGB")
-                        _prev_placeholder = _detect_placeholder_text(_prev_img)
-                    finally:
-                        os.remove(_tf_path)
+                    _prev_feat        = extract_features(ref_bytes, placeholder=True)
+                    _prev             = classify_features(_prev_feat)
+                    _prev_placeholder = _prev_feat["placeholder"]
 
                     if _prev_placeholder:
                         _new_sub    = "no_image"
@@ -1498,7 +990,7 @@ else:
                     if st.button(f"🔍 Find Similar Images  ({img_count} images in folder)",
                                  key=f"gal_prev_btn_{folder_path}"):
                         _pb = st.progress(0.0, text="Analysing images…")
-                        _pv = preview_folder_by_upload(s3, bucket, pfx_use, ref_bytes, ref_suffix, _pb)
+                        _pv = preview_folder_by_upload(s3, bucket, pfx_use, ref_bytes, ref_suffix, StreamlitReporter(_pb), pipeline_workers)
                         st.session_state[_gal_prev_key] = _pv if _pv else None
                         if not _pv:
                             st.error("❌ No images found in this folder.")
@@ -1544,37 +1036,17 @@ else:
                             ):
                                 run_bar = st.progress(0.0, text="Moving images…")
                                 res = seg_folder_by_upload(s3, bucket, pfx_use, ref_bytes, ref_suffix,
-                                                           run_bar, preview_data=_gal_stored_pv)
+                                                           StreamlitReporter(run_bar), preview_data=_gal_stored_pv,
+                                                           workers=pipeline_workers)
                                 if res:
-                                    moved_n     = len(res.get("moved", []))
-                                    unchanged_n = len(res.get("unchanged", []))
-                                    _gal_seg_json = {
-                                        "event":           "segregation_complete",
-                                        "timestamp":       datetime.datetime.now().isoformat(),
-                                        "bucket":          bucket,
-                                        "source_folder":   folder_path,
-                                        "dest_folder":     _gal_stored_pv.get("dest_folder"),
-                                        "reference_type":  _gal_stored_pv.get("reference_type"),
-                                        "reference_class": _gal_stored_pv.get("reference_class"),
-                                        "moved_count":     moved_n,
-                                        "unchanged_count": unchanged_n,
-                                        "total_scanned":   _gal_stored_pv.get("total_scanned", 0),
-                                        "moved_files": [
-                                            {"r2_key": _gal_stored_pv["dest_folder"] + fn, "filename": fn}
-                                            for fn in res.get("moved", [])
-                                        ],
-                                        "unchanged_files": [
-                                            {"r2_key": (pfx_use.rstrip("/") + "/" if pfx_use else "") + fn, "filename": fn}
-                                            for fn in res.get("unchanged", [])
-                                        ],
-                                    }
+                                    _gal_seg_json = segregation_result(
+                                        bucket, folder_path, _gal_stored_pv, res,
+                                        key_prefix=pfx_use.rstrip("/") + "/" if pfx_use else "")
                                     st.session_state[f"gal_seg_result_{folder_path}"] = _gal_seg_json
                                     st.session_state[f"gal_seg_moved_keys_{folder_path}"] = [
                                         _gal_stored_pv["dest_folder"] + fn for fn in res.get("moved", [])
                                     ]
                                     st.session_state[_gal_prev_key]   = None
-                                    if "gal_all_folders" in st.session_state:
-                                        del st.session_state["gal_all_folders"]
                                     st.session_state["gal_upref_open"] = None
                                     st.rerun()
                         else:
@@ -1608,20 +1080,16 @@ else:
                         _gdca, _gdcb = st.columns(2)
                         if _gdca.button("✅ Yes, delete", key=f"gal_seg_delyes_{folder_path}", type="primary"):
                             _gal_moved_del = st.session_state.get(f"gal_seg_moved_keys_{folder_path}", [])
-                            _gdel_ok = 0
                             _gdbar = st.progress(0.0, text="Deleting…")
-                            for _gdi, _gdk in enumerate(_gal_moved_del, 1):
-                                _gdbar.progress(_gdi / max(len(_gal_moved_del), 1),
-                                               text=f"Deleting {_gdi}/{len(_gal_moved_del)}")
-                                try: s3.delete_object(Bucket=bucket, Key=_gdk); _gdel_ok += 1
-                                except: pass
+                            _gdel_ok, _gdel_errs = delete_r2_many(
+                                s3, bucket, _gal_moved_del,
+                                progress=lambda d, t: _gdbar.progress(d / t, text=f"Deleting {d}/{t}"))
                             _gdbar.empty()
-                            st.success(f"✅ Deleted {_gdel_ok} files.")
+                            st.success(f"✅ Deleted {len(_gdel_ok)} files.")
+                            for _k, _de in list(_gdel_errs.items())[:20]: st.error(f"Failed `{_k}`: {_de}")
                             st.session_state[f"gal_seg_result_{folder_path}"]      = None
                             st.session_state[f"gal_seg_moved_keys_{folder_path}"]  = []
                             st.session_state[f"gal_seg_del_confirm_{folder_path}"] = False
-                            if "gal_all_folders" in st.session_state:
-                                del st.session_state["gal_all_folders"]
                             st.rerun()
                         if _gdcb.button("❌ Cancel", key=f"gal_seg_delno_{folder_path}"):
                             st.session_state[f"gal_seg_del_confirm_{folder_path}"] = False
@@ -1647,18 +1115,14 @@ else:
 
             def _render_thumb_grid(keys, section_tag, ncols=5, thumb_w=160):
                 if not keys: st.info("No images in this group."); return
+                _ktiles = _tiles(s3, bucket, keys)
                 for _rs in range(0, len(keys), ncols):
                     _row_keys = keys[_rs: _rs + ncols]
                     _cols = st.columns(ncols)
                     for _col, _rk in zip(_cols, _row_keys):
                         _fname = Path(_rk).name
                         with _col:
-                            _url = get_presigned_url(s3, bucket, _rk, expires=600)
-                            if _url:
-                                try: st.image(_url, width=thumb_w)
-                                except: st.markdown("🖼️ *error*")
-                            else:
-                                st.markdown("🖼️ *no preview*")
+                            _thumb(s3, bucket, _rk, thumb_w, "sort_results", _ktiles.get(_rk))
                             st.markdown(f'<div class="gal-img-name" title="{_rk}">{_fname}</div>',
                                         unsafe_allow_html=True)
                             _chk = st.checkbox("🗑️ Select",
@@ -1685,18 +1149,16 @@ else:
                 if _ba.button(f"🗑️ Delete {len(_sel)} selected", key="sort_del_btn",
                               type="primary", use_container_width=True):
                     _dbar = st.progress(0.0, text="Deleting…")
-                    _ok = 0
-                    for _di, _dk in enumerate(_sel_list, 1):
-                        _dbar.progress(_di / len(_sel_list), text=f"Deleting {_di}/{len(_sel_list)}")
-                        try: s3.delete_object(Bucket=bucket, Key=_dk); _ok += 1
-                        except Exception as _de: st.error(f"Failed `{_dk}`: {_de}")
+                    _ok, _derrs = delete_r2_many(
+                        s3, bucket, _sel_list,
+                        progress=lambda d, t: _dbar.progress(d / t, text=f"Deleting {d}/{t}"))
+                    for _dk, _de in _derrs.items(): st.error(f"Failed `{_dk}`: {_de}")
                     _dbar.empty()
-                    st.success(f"✅ Deleted {_ok} / {len(_sel_list)} images.")
-                    st.session_state["sort_result"]["moved_keys"]  = [k for k in _mv_keys if k not in _sel]
-                    st.session_state["sort_result"]["stayed_keys"] = [k for k in _st_keys if k not in _sel]
+                    st.success(f"✅ Deleted {len(_ok)} / {len(_sel_list)} images.")
+                    _gone = set(_ok)
+                    st.session_state["sort_result"]["moved_keys"]  = [k for k in _mv_keys if k not in _gone]
+                    st.session_state["sort_result"]["stayed_keys"] = [k for k in _st_keys if k not in _gone]
                     st.session_state["sort_del_sel"] = set()
-                    if "gal_all_folders" in st.session_state:
-                        del st.session_state["gal_all_folders"]
                     st.rerun()
                 if _bb.button("⬜ Deselect All", key="sort_desel_btn", use_container_width=True):
                     st.session_state["sort_del_sel"] = set()
@@ -1738,18 +1200,15 @@ else:
                                            max_value=page_count, value=1, key="gal_page") - 1
 
             page_keys = active_keys[page_num * PAGE_SIZE: (page_num + 1) * PAGE_SIZE]
+            with st.spinner("Loading thumbnails…"):
+                page_tiles = _tiles(s3, bucket, page_keys, st.session_state.get("gal_versions"))
             for row_start in range(0, len(page_keys), cols_per_row):
                 row_keys = page_keys[row_start: row_start + cols_per_row]
                 cols     = st.columns(cols_per_row)
                 for col, key in zip(cols, row_keys):
                     filename = Path(key).name
                     with col:
-                        url = get_presigned_url(s3, bucket, key, expires=600)
-                        if url:
-                            try: st.image(url, width=thumb_size)
-                            except: st.markdown("🖼️ *preview error*")
-                        else:
-                            st.markdown("🖼️ *no preview*")
+                        _thumb(s3, bucket, key, thumb_size, "gallery", page_tiles.get(key), "🖼️ *preview error*")
                         if show_names:
                             st.markdown(f'<div class="gal-img-name" title="{key}">{filename}</div>',
                                         unsafe_allow_html=True)
@@ -0,0 +1,387 @@
+"""
+bench.py — reproducible throughput benchmark for the AI Image Segregator.
+
+Builds a deterministic synthetic corpus (photos in several sizes, "NO IMAGE"
+placeholder cards, near-duplicates, animated GIFs, large TIFFs), runs every
+feature function and every engine on it, and writes images/sec, p50/p99
+latency (per image, and per pipeline stage for the engines) and peak RSS to
+JSON. Engines run on segregator.FakeStorage, so no network is involved;
+--latency / --bandwidth / --error-rate model one.
+
+  python bench.py                               # full corpus → bench_results.json
+  python bench.py --scale 0.25 -o quick.json    # smaller corpus
+  python bench.py --baseline baseline.json      # compare; exit 1 on a regression
+
+Everything runs inside a fresh temp directory, so the feature cache, hash
+index, journal and session log of the real app are never touched.
+"""
+
+import os, io, sys, json, time, math, random, hashlib, tempfile, platform, threading, argparse, datetime, contextlib
+from pathlib import Path
+
+from PIL import Image, ImageDraw, ImageFilter, ImageFont, ImageEnhance
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import resource
+except ImportError:         # Windows
+    resource = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import segregator as sg
+
+# ════════════════════════════════════════════════════════════════════════════════
+# SYNTHETIC CORPUS — same seed + scale → byte-identical images on one
+# Pillow/libjpeg build. corpus_digest() fingerprints it, so a comparison
+# against a baseline built from a different corpus is flagged.
+# ════════════════════════════════════════════════════════════════════════════════
+PHOTO_SIZES = [("small", (640, 480), 30), ("medium", (1920, 1080), 20), ("large", (4000, 3000), 6)]
+PALETTES    = {                 # scene → (top colour, bottom colour) ranges the classifier reacts to
+    "forest": ((20, 90, 30),   (60, 140, 60)),
+    "sky":    ((90, 150, 230), (200, 220, 250)),
+    "beach":  ((80, 160, 220), (220, 200, 150)),
+    "food":   ((150, 60, 20),  (230, 170, 80)),
+    "night":  ((10, 10, 30),   (50, 40, 80)),
+    "studio": ((200, 200, 200), (240, 240, 240)),
+}
+CARD_TEXTS  = ["NO IMAGE", "IMAGE NOT AVAILABLE", "COMING SOON", "NO PHOTO", "NO FLOOR PLAN"]
+
+
+def _font(size):
+    try: return ImageFont.load_default(size=size)
+    except TypeError: return ImageFont.load_default()      # Pillow < 10.1: fixed bitmap font
+
+
+def _photo(rng, size):
+    w, h  = size
+    scene = rng.choice(sorted(PALETTES))
+    top, bottom = PALETTES[scene]
+    small = Image.new("RGB", (160, 120))
+    d     = ImageDraw.Draw(small)
+    for y in range(120):
+        t = y / 119
+        d.line([(0, y), (159, y)], fill=tuple(int(a + (b - a) * t) for a, b in zip(top, bottom)))
+    for _ in range(rng.randint(4, 12)):
+        x0, y0 = rng.randint(-20, 150), rng.randint(-20, 110)
+        x1, y1 = x0 + rng.randint(8, 70), y0 + rng.randint(8, 60)
+        col    = tuple(max(0, min(255, c + rng.randint(-60, 60))) for c in rng.choice([top, bottom]))
+        (d.ellipse if rng.random() < 0.5 else d.rectangle)([x0, y0, x1, y1], fill=col)
+    img = small.resize(size, Image.BICUBIC).filter(ImageFilter.GaussianBlur(max(1, w // 400)))
+    if np is not None:          # sensor-like grain keeps JPEG sizes realistic
+        noise = np.random.default_rng(rng.randint(0, 2**32 - 1)).normal(0, 6, (h, w, 3))
+        img   = Image.fromarray(np.clip(np.asarray(img, np.float32) + noise, 0, 255).astype(np.uint8))
+    return img, scene
+
+
+def _card(rng):
+    w, h = rng.choice([(800, 600), (600, 600), (1200, 800)])
+    bg   = rng.choice([(245, 245, 245), (230, 230, 230), (255, 255, 255), (215, 215, 215)])
+    img  = Image.new("RGB", (w, h), bg)
+    d    = ImageDraw.Draw(img)
+    cx, cy = w // 2, h // 2 - h // 8
+    d.rectangle([cx - w // 10, cy - h // 10, cx + w // 10, cy + h // 10], outline=(150, 150, 150), width=4)
+    d.polygon([(cx - w // 14, cy + h // 14), (cx, cy - h // 20), (cx + w // 14, cy + h // 14)], fill=(170, 170, 170))
+    text = rng.choice(CARD_TEXTS)
+    font = _font(max(18, w // 18))
+    tw   = d.textlength(text, font=font)
+    d.text((cx - tw / 2, cy + h // 6), text, fill=(90, 90, 90), font=font)
+    return img, text
+
+
+def _near_dup(rng, img):
+    # the edits a CMS makes: re-crop a few %, rescale, nudge brightness, re-encode
+    w, h = img.size
+    dx, dy = int(w * rng.uniform(0, 0.04)), int(h * rng.uniform(0, 0.04))
+    out = img.crop((dx, dy, w - dx, h - dy)).resize((int(w * rng.uniform(0.6, 0.95)), int(h * rng.uniform(0.6, 0.95))))
+    return ImageEnhance.Brightness(out).enhance(rng.uniform(0.92, 1.08))
+
+
+def _encode(img, fmt, **kw):
+    buf = io.BytesIO(); img.save(buf, fmt, **kw); return buf.getvalue()
+
+
+def make_corpus(seed: int = 7, scale: float = 1.0) -> list:
+    # → [{"name", "kind", "data"}], in a fixed order
+    rng, out = random.Random(seed), []
+    n = lambda k: max(1, int(round(k * scale)))
+    photos = []
+    for label, size, count in PHOTO_SIZES:
+        for i in range(n(count)):
+            img, scene = _photo(rng, size)
+            photos.append(img)
+            out.append({"name": f"photo_{label}_{i:03d}_{scene}.jpg", "kind": f"photo_{label}",
+                        "data": _encode(img, "JPEG", quality=rng.choice([80, 85, 90]))})
+    for i in range(n(15)):
+        img, text = _card(rng)
+        fmt = rng.choice(["PNG", "JPEG"])
+        out.append({"name": f"placeholder_{i:03d}.{'png' if fmt == 'PNG' else 'jpg'}", "kind": "placeholder",
+                    "data": _encode(img, fmt, **({"quality": 85} if fmt == "JPEG" else {}))})
+    for i in range(n(15)):
+        src = rng.randrange(len(photos))
+        out.append({"name": f"neardup_{i:03d}_of_{src:03d}.jpg", "kind": "near_duplicate",
+                    "data": _encode(_near_dup(rng, photos[src]), "JPEG", quality=rng.choice([60, 75]))})
+    for i in range(n(6)):
+        frames = [_photo(rng, (320, 240))[0].quantize(64) for _ in range(rng.randint(3, 6))]
+        out.append({"name": f"animated_{i:03d}.gif", "kind": "animated_gif",
+                    "data": _encode(frames[0], "GIF", save_all=True, append_images=frames[1:], duration=100, loop=0)})
+    for i in range(n(3)):
+        img, scene = _photo(rng, (4000, 3000))
+        out.append({"name": f"scan_{i:03d}_{scene}.tif", "kind": "large_tiff",
+                    "data": _encode(img, "TIFF", compression=rng.choice([None, "tiff_lzw"]))})
+    return out
+
+
+def corpus_digest(corpus) -> str:
+    h = hashlib.sha1()
+    for c in corpus: h.update(c["name"].encode()); h.update(hashlib.sha1(c["data"]).digest())
+    return h.hexdigest()[:16]
+
+# ════════════════════════════════════════════════════════════════════════════════
+# MEASUREMENT — per-call latencies → p50/p99; peak RSS is sampled from
+# /proc/self/statm while the case runs (ru_maxrss where /proc is missing,
+# which is a process-lifetime peak instead of a per-case one).
+# ════════════════════════════════════════════════════════════════════════════════
+def _pct(xs, q):
+    if not xs: return None
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, max(0, math.ceil(q / 100 * len(xs)) - 1))]
+
+def _lat(xs) -> dict:
+    return {"n": len(xs), "p50_ms": _ms(_pct(xs, 50)), "p99_ms": _ms(_pct(xs, 99)),
+            "mean_ms": _ms(sum(xs) / len(xs)) if xs else None}
+
+def _ms(s):
+    return None if s is None else round(s * 1000, 3)
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f: return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        if resource is None: return 0.0
+        r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return r / 2**20 if sys.platform == "darwin" else r / 1024
+
+
+@contextlib.contextmanager
+def peak_rss(out: dict):
+    stop, peak = threading.Event(), [_rss_mb()]
+    def _sample():
+        while not stop.wait(0.01): peak[0] = max(peak[0], _rss_mb())
+    t = threading.Thread(target=_sample, daemon=True); t.start()
+    try: yield
+    finally:
+        stop.set(); t.join(); out["peak_rss_mb"] = round(max(peak[0], _rss_mb()), 1)
+
+
+@contextlib.contextmanager
+def stage_times(out: dict):
+    # collects run_pipeline stage latencies while the block runs
+    times, lock = {}, threading.Lock()
+    def _ob(stage, seconds):
+        with lock: times.setdefault(stage, []).append(seconds)
+    sg.PIPELINE_OBSERVERS.append(_ob)
+    try: yield
+    finally:
+        sg.PIPELINE_OBSERVERS.remove(_ob)
+        out["stages"] = {k: _lat(v) for k, v in sorted(times.items())}
+
+
+class QuietReporter(sg.Reporter):
+    # counts what the engines report instead of logging it
+    def __init__(self): self.counts = {}
+    def _n(self, kind, *_a, **_k): self.counts[kind] = self.counts.get(kind, 0) + 1
+    def write(self, msg):   self._n("write")
+    def info(self, msg):    self._n("info")
+    def success(self, msg): self._n("success")
+    def warning(self, msg): self._n("warning")
+    def error(self, msg):   self._n("error")
+
+# ════════════════════════════════════════════════════════════════════════════════
+# FEATURE FUNCTIONS — each timed per image, in-process, caches bypassed
+# ════════════════════════════════════════════════════════════════════════════════
+def _decoded(c):
+    return sg._decode(c["data"])[0]
+
+FEATURES = {
+    "decode":               (lambda c: c["data"],    lambda d: sg._decode(d)),
+    "extract_features":     (lambda c: c["data"],    lambda d: sg.extract_features(d)),
+    "extract_placeholder":  (lambda c: c["data"],    lambda d: sg.extract_features(d, placeholder=True)),
+    "classify_image":       (lambda c: c["data"],    lambda d: sg.classify_image(d)),
+    "classify_features":    (lambda c: sg.extract_features(c["data"]), lambda f: sg.classify_features(f)),
+    "detect_placeholder":   (_decoded,               lambda img: sg._detect_placeholder_text(img)),
+}
+
+
+def bench_features(corpus, names=None) -> dict:
+    res = {}
+    for name, (prep, fn) in FEATURES.items():
+        if names and name not in names: continue
+        inputs = [prep(c) for c in corpus]          # preparation is not timed
+        lat, errors, row = [], 0, {}
+        with peak_rss(row):
+            t0 = time.perf_counter()
+            for x in inputs:
+                t = time.perf_counter()
+                try: fn(x)
+                except Exception: errors += 1
+                lat.append(time.perf_counter() - t)
+            wall = time.perf_counter() - t0
+        res[name] = {"images": len(inputs), "seconds": round(wall, 4),
+                     "images_per_s": round(len(inputs) / wall, 2) if wall else None,
+                     "errors": errors, **_lat(lat), **row}
+        print(f"  {name:<22} {res[name]['images_per_s']:>9} img/s   p50 {res[name]['p50_ms']} ms   "
+              f"p99 {res[name]['p99_ms']} ms", file=sys.stderr)
+    batch = [c["data"] for c in corpus]
+    if not names or "extract_features_batch" in names:
+        row = {}
+        with peak_rss(row):
+            t0 = time.perf_counter(); sg.extract_features_batch(batch); wall = time.perf_counter() - t0
+        res["extract_features_batch"] = {"images": len(batch), "seconds": round(wall, 4),
+                                         "images_per_s": round(len(batch) / wall, 2), **row}
+    return res
+
+# ════════════════════════════════════════════════════════════════════════════════
+# ENGINES — each on its own FakeStorage bucket, so caches start cold for every
+# engine; LocalStorage engines get their own temp directories.
+# ════════════════════════════════════════════════════════════════════════════════
+def _fake(corpus, args, bucket, prefix="in/"):
+    fs = sg.FakeStorage(latency=args.latency, jitter=args.latency / 2, bandwidth=args.bandwidth,
+                        error_rate=args.error_rate, max_attempts=args.max_attempts, seed=args.seed)
+    for c in corpus: fs.add(bucket, prefix + c["name"], c["data"])
+    return fs
+
+
+def bench_engines(corpus, args, names=None) -> dict:
+    workers = {"processes": args.processes}
+    ref     = next(c for c in corpus if c["kind"] == "placeholder")
+    photo   = next(c for c in corpus if c["kind"].startswith("photo"))
+    n       = len(corpus)
+
+    def _full(fs, b):       return sg.seg_r2_full(fs, b, "in/", "out", "category", rep, workers)
+    def _ref(fs, b):
+        fs.add(b, "ref/" + photo["name"], photo["data"])
+        return sg.seg_r2_ref(fs, b, "ref/" + photo["name"], "in/", "out", rep, workers)
+    def _preview(fs, b):    return sg.preview_folder_by_upload(fs, b, "in/", ref["data"], ".png", rep, workers)
+    def _execute(fs, b):
+        pv = sg.preview_folder_by_upload(fs, b, "in/", ref["data"], ".png", QuietReporter(), workers)
+        return (lambda: sg.seg_folder_by_upload(fs, b, "in/", b"", "", rep, preview_data=pv, workers=workers))
+    def _upload(fs, b):     return sg.seg_folder_by_upload(fs, b, "in/", ref["data"], ".png", rep, workers=workers)
+    def _index(fs, b):      return sg.index_prefix(fs, b, "in/", rep, workers)
+    def _clusters(fs, b):   return sg.preview_duplicate_clusters(fs, b, "in/", rep, workers)
+
+    engines = {"seg_r2_full": _full, "seg_r2_ref": _ref, "preview_folder_by_upload": _preview,
+               "seg_folder_by_upload_execute": _execute, "seg_folder_by_upload_legacy": _upload,
+               "index_prefix": _index, "preview_duplicate_clusters": _clusters, "seg_local_full": None}
+    res = {}
+    for name, run in engines.items():
+        if names and name not in names: continue
+        rep, row = QuietReporter(), {}
+        if name == "seg_local_full":
+            src = tempfile.mkdtemp(prefix="src_", dir="."); out = tempfile.mkdtemp(prefix="out_", dir=".")
+            for c in corpus:
+                with open(os.path.join(src, c["name"]), "wb") as f: f.write(c["data"])
+            fs, call = None, (lambda: sg.seg_local_full(src, out, "category", rep, workers))
+        else:
+            bucket = f"bench-{name}"
+            fs = _fake(corpus, args, bucket)
+            call = (lambda fs=fs, b=bucket, run=run: run(fs, b))
+            if name == "seg_folder_by_upload_execute": call = call()    # preview is setup, not timed
+        before = fs.stats() if fs is not None else {}
+        with stage_times(row), peak_rss(row):
+            t0 = time.perf_counter(); call(); wall = time.perf_counter() - t0
+        res[name] = {"images": n, "seconds": round(wall, 4), "images_per_s": round(n / wall, 2),
+                     "reported": rep.counts, **row}
+        if fs is not None:
+            res[name]["storage"] = {op: {k: v - before.get(op, {}).get(k, 0) for k, v in st.items()}
+                                    for op, st in fs.stats().items()}
+        print(f"  {name:<30} {res[name]['images_per_s']:>8} img/s   {wall:7.2f} s   "
+              f"peak {row['peak_rss_mb']} MB", file=sys.stderr)
+    return res
+
+# ════════════════════════════════════════════════════════════════════════════════
+# BASELINE — images/sec lower or p99 higher than the baseline by more than
+# --tolerance is a regression
+# ════════════════════════════════════════════════════════════════════════════════
+def compare(cur: dict, base: dict, tolerance: float) -> list:
+    # → [(section, name, metric, baseline, current, change)] for every regression
+    if cur["meta"]["corpus_digest"] != base.get("meta", {}).get("corpus_digest"):
+        print("⚠️  baseline was built from a different corpus — numbers are not comparable", file=sys.stderr)
+    bad = []
+    for section in ("features", "engines"):
+        for name, row in cur.get(section, {}).items():
+            old = base.get(section, {}).get(name)
+            if not old: continue
+            for metric, worse in (("images_per_s", lambda o, c: c < o * (1 - tolerance)),
+                                  ("p99_ms",       lambda o, c: c > o * (1 + tolerance))):
+                o, c = old.get(metric), row.get(metric)
+                if o and c is not None:
+                    change = (c - o) / o
+                    print(f"  {section[:-1]:<8} {name:<30} {metric:<13} {o:>10} → {c:<10} {change:+7.1%}"
+                          f"{'  ❌' if worse(o, c) else ''}", file=sys.stderr)
+                    if worse(o, c): bad.append((section, name, metric, o, c, round(change, 4)))
+    return bad
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(prog="bench", description="AI Image Segregator throughput benchmark")
+    ap.add_argument("-o", "--out", default="bench_results.json")
+    ap.add_argument("--seed", type=int, default=7)
+    ap.add_argument("--scale", type=float, default=1.0, help="corpus size multiplier")
+    ap.add_argument("--only", default="", help="comma list of feature/engine names to run")
+    ap.add_argument("--skip-features", action="store_true")
+    ap.add_argument("--skip-engines", action="store_true")
+    ap.add_argument("--processes", type=int, default=0, help="feature pool size for the engines (0 = in-thread)")
+    ap.add_argument("--latency", type=float, default=0.0, help="seconds per storage request")
+    ap.add_argument("--bandwidth", type=float, default=0, help="storage bytes/second, 0 = unlimited")
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--max-attempts", type=int, default=3)
+    ap.add_argument("--baseline", default="", help="results JSON to compare against")
+    ap.add_argument("--tolerance", type=float, default=0.15)
+    a = ap.parse_args(argv)
+    names = {x.strip() for x in a.only.split(",") if x.strip()} or None
+    out   = os.path.abspath(a.out)
+    base  = os.path.abspath(a.baseline) if a.baseline else ""
+
+    print(f"Building corpus (seed {a.seed}, scale {a.scale})…", file=sys.stderr)
+    t0 = time.perf_counter(); corpus = make_corpus(a.seed, a.scale)
+    kinds = {}
+    for c in corpus: kinds[c["kind"]] = kinds.get(c["kind"], 0) + 1
+    print(f"  {len(corpus)} images, {sum(len(c['data']) for c in corpus) / 2**20:.1f} MB "
+          f"in {time.perf_counter() - t0:.1f} s — {kinds}", file=sys.stderr)
+
+    results = {"meta": {
+        "timestamp": datetime.datetime.now().isoformat(), "python": platform.python_version(),
+        "platform": platform.platform(), "cpu_count": os.cpu_count(), "pillow": Image.__version__,
+        "numpy": np.__version__ if np is not None else None, "seed": a.seed, "scale": a.scale,
+        "corpus_digest": corpus_digest(corpus), "decode_target_px": sg.DECODE_TARGET_PX,
+        "storage": {"latency": a.latency, "bandwidth": a.bandwidth, "error_rate": a.error_rate,
+                    "max_attempts": a.max_attempts}, "processes": a.processes},
+        "corpus": {"images": len(corpus), "bytes": sum(len(c["data"]) for c in corpus), "kinds": kinds}}
+
+    work = tempfile.mkdtemp(prefix="segregator_bench_")
+    cwd  = os.getcwd(); os.chdir(work)          # caches, journal and log land here
+    try:
+        if not a.skip_features:
+            print("Feature functions:", file=sys.stderr)
+            results["features"] = bench_features(corpus, names)
+        if not a.skip_engines:
+            print("Engines (FakeStorage):", file=sys.stderr)
+            results["engines"] = bench_engines(corpus, a, names)
+    finally:
+        os.chdir(cwd)
+
+    with open(out, "w", encoding="utf-8") as f: json.dump(results, f, indent=2)
+    print(f"Results → {out}  (scratch: {work})", file=sys.stderr)
+    if base:
+        with open(base, "r", encoding="utf-8") as f: bad = compare(results, json.load(f), a.tolerance)
+        if bad:
+            print(f"❌ {len(bad)} regression(s) beyond {a.tolerance:.0%}", file=sys.stderr); return 1
+        print("✅ no regressions", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
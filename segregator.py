@@ -0,0 +1,3528 @@
+"""
+segregator.py — engines, storage and matching for the AI Image Segregator,
+with no Streamlit import. app.py is the UI on top of this module; cron jobs
+and batch workers import it directly or run the CLI:
+
+  python segregator.py scan           --bucket B [--prefix P]
+  python segregator.py preview        --bucket B --prefix P --ref ref.jpg [-o preview.json]
+  python segregator.py execute        --bucket B --preview preview.json [-o result.json]
+  python segregator.py full-segregate --bucket B [--prefix P] --out-prefix sorted/ [--mode category] [--incremental]
+
+Engines report progress and messages through a Reporter (see below) instead
+of drawing anything themselves, and reach storage through a Storage backend
+(R2/S3, a local directory, or an in-memory fake for benchmarks).
+
+R2 credentials come from R2_ENDPOINT, R2_ACCESS_KEY and R2_SECRET_KEY.
+"""
+
+import os, io, sys, shutil, re, tempfile, math, time, hashlib, urllib.parse, json, datetime, threading, queue, sqlite3, itertools, functools, gzip, glob, contextlib, logging, argparse, contextvars, heapq, inspect, bisect, atexit, collections, weakref
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+from pathlib import Path
+
+from PIL import Image as PILImage
+try:
+    import numpy as np          # vectorised feature math; pure-Python fallback below
+except ImportError:
+    np = None
+try:
+    import fcntl                # session-log file lock (POSIX) …
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt               # … or Windows
+except ImportError:
+    msvcrt = None
+
+R2_ENDPOINT   = os.environ.get("R2_ENDPOINT", "")
+R2_ACCESS_KEY = os.environ.get("R2_ACCESS_KEY", "")
+R2_SECRET_KEY = os.environ.get("R2_SECRET_KEY", "")
+SUPPORTED     = {".jpg",".jpeg",".png",".gif",".webp",".bmp",".tiff",".tif"}
+
+_HASH_THRESHOLD_PLACEHOLDER = 12
+_HASH_THRESHOLD_REAL        = 8
+_PIXEL_THRESHOLD_PLACEHOLDER= 0.82
+_PIXEL_THRESHOLD_REAL       = 0.88
+
+log = logging.getLogger("segregator")
+
+# ════════════════════════════════════════════════════════════════════════════════
+# REPORTER — the only way engines talk to whoever runs them. The base class
+# ignores progress and sends messages to the "segregator" logger; the UI
+# (StreamlitReporter in app.py) and the CLI (ConsoleReporter) override it.
+# Engines call it from the thread that called the engine — never from
+# pipeline workers.
+# ════════════════════════════════════════════════════════════════════════════════
+class Reporter:
+    def progress(self, frac: float, text: str = "") -> None: pass
+    def write(self, msg: str)   -> None: log.info(msg)
+    def info(self, msg: str)    -> None: log.info(msg)
+    def success(self, msg: str) -> None: log.info(msg)
+    def warning(self, msg: str) -> None: log.warning(msg)
+    def error(self, msg: str)   -> None: log.error(msg)
+
+# ════════════════════════════════════════════════════════════════════════════════
+# JSON SESSION LOGGER
+# Produces this exact structure for every event type:
+#
+#  {
+#    "id":              "2026-02-19T18-02-40-706873_r2_folder_upload",
+#    "timestamp":       "2026-02-19T18:02:40.706873",
+#    "date":            "2026-02-19",
+#    "time":            "18:02:40",
+#    "event_type":      "r2_folder_upload",
+#    "bucket":          "img",
+#    "source_prefix":   "data/",
+#    "output_prefix":   "data/abstract_pattern/",
+#    "mode":            "",
+#    "reference_image": "<uploaded>",
+#    "results": {
+#      "total_processed": 25,         ← images that were moved
+#      "groups": { "abstract_pattern": ["file.jpg", …] },
+#      "moved_count":     25,
+#      "unchanged_count": 0           ← always 0 here; real count in extra
+#    },
+#    "extra": {
+#      "is_placeholder":  false,
+#      "dest_sub":        "abstract_pattern",
+#      "moved":           25,
+#      "unchanged_count": 78,         ← actual images that stayed
+#      "total_processed": 103         ← moved + unchanged
+#    }
+#  }
+# ════════════════════════════════════════════════════════════════════════════════
+# Storage: append-only JSONL segments written under a file lock, so
+# concurrent sessions never lose an event and an append costs one line:
+#
+#   segregator_session_log.000001.jsonl.gz   ← rotated, compressed
+#   segregator_session_log.000002.jsonl      ← active segment
+#   segregator_session_log.idx               ← one line per event:
+#       {"seg", "off", "len", "date", "bucket", "event_type"}
+#
+# Readers go through the index — "latest 5" reads the index tail and seeks
+# straight to those five lines. A legacy segregator_session_log.json array
+# is imported once, then renamed to *.json.migrated.
+# ════════════════════════════════════════════════════════════════════════════════
+_SESSION_LOG_FILE    = "segregator_session_log.json"      # legacy JSON-array log
+_SESSION_LOG_BASE    = "segregator_session_log"
+SESSION_LOG_SEGMENT_BYTES = 4 * 1024 * 1024               # active segment size before rotation
+
+
+class SessionLog:
+    def __init__(self, base: str = _SESSION_LOG_BASE, segment_bytes: int = SESSION_LOG_SEGMENT_BYTES):
+        self.base, self.segment_bytes = base, segment_bytes
+        self.index = f"{base}.idx"
+
+    # ── files ────────────────────────────────────────────────────────────────
+    def _seg_path(self, seq: int, gz: bool = False) -> str:
+        return f"{self.base}.{seq:06d}.jsonl" + (".gz" if gz else "")
+
+    def _segments(self) -> list:
+        seqs = set()
+        for p in glob.glob(glob.escape(self.base) + ".[0-9]*.jsonl*"):
+            try: seqs.add(int(Path(p).name[len(Path(self.base).name) + 1:].split(".")[0]))
+            except ValueError: pass
+        return sorted(seqs)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with open(f"{self.base}.lock", "a+b") as fh:
+            if fcntl is not None:
+                fcntl.flock(fh, fcntl.LOCK_EX)
+            elif msvcrt is not None:
+                fh.seek(0)
+                while True:
+                    try: msvcrt.locking(fh.fileno(), msvcrt.LK_LOCK, 1); break
+                    except OSError: continue
+            try:
+                yield
+            finally:
+                if fcntl is not None: fcntl.flock(fh, fcntl.LOCK_UN)
+                elif msvcrt is not None: fh.seek(0); msvcrt.locking(fh.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def _active(self, incoming: int) -> int:
+        # current segment number; gzips it and starts the next one when full
+        segs = self._segments()
+        seq  = segs[-1] if segs else 1
+        path = self._seg_path(seq)
+        if os.path.exists(path) and os.path.getsize(path) + incoming > self.segment_bytes:
+            with open(path, "rb") as src, gzip.open(self._seg_path(seq, gz=True), "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(path); seq += 1
+        elif not os.path.exists(path) and os.path.exists(self._seg_path(seq, gz=True)):
+            seq += 1
+        return seq
+
+    def _migrate(self) -> None:
+        if not os.path.exists(_SESSION_LOG_FILE): return
+        try:
+            with open(_SESSION_LOG_FILE, "r", encoding="utf-8") as f: old = json.load(f)
+        except (json.JSONDecodeError, OSError):
+            old = []
+        for entry in old if isinstance(old, list) else []: self._append(entry)
+        os.replace(_SESSION_LOG_FILE, _SESSION_LOG_FILE + ".migrated")
+
+    # ── write ────────────────────────────────────────────────────────────────
+    def _append(self, entry: dict) -> None:
+        line = (json.dumps(entry, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+        seq  = self._active(len(line))
+        with open(self._seg_path(seq), "ab") as f:
+            off = f.seek(0, os.SEEK_END); f.write(line)
+        ref = {"seg": seq, "off": off, "len": len(line), "date": entry.get("date", ""),
+               "bucket": entry.get("bucket", ""), "event_type": entry.get("event_type", "")}
+        with open(self.index, "a", encoding="utf-8") as f:
+            f.write(json.dumps(ref, ensure_ascii=False) + "\n")
+
+    def append(self, entry: dict) -> None:
+        with self._locked():
+            self._migrate(); self._append(entry)
+
+    def clear(self) -> None:
+        with self._locked():
+            for seq in self._segments():
+                for gz in (False, True):
+                    with contextlib.suppress(FileNotFoundError): os.remove(self._seg_path(seq, gz))
+            with contextlib.suppress(FileNotFoundError): os.remove(self.index)
+
+    # ── read ─────────────────────────────────────────────────────────────────
+    def _refs(self, tail: int = 0) -> list:
+        # index lines, oldest first; tail=N reads only the last N from the end of the file
+        if not os.path.exists(self.index):
+            with self._locked(): self._migrate()
+        try: f = open(self.index, "rb")
+        except FileNotFoundError: return []
+        with f:
+            if tail:
+                size = f.seek(0, os.SEEK_END); buf = b""; pos = size
+                while pos > 0 and buf.count(b"\n") <= tail:
+                    step = min(64 * 1024, pos); pos -= step
+                    f.seek(pos); buf = f.read(step) + buf
+                lines = buf.splitlines()[-tail:]
+            else:
+                lines = f.read().splitlines()
+        return _json_lines(lines)
+
+    def _fetch(self, refs: list) -> list:
+        out, by_seg = {}, {}
+        for n, r in enumerate(refs): by_seg.setdefault(r["seg"], []).append((n, r))
+        for seq, items in by_seg.items():
+            path = self._seg_path(seq)
+            try:
+                f = open(path, "rb") if os.path.exists(path) else gzip.open(self._seg_path(seq, gz=True), "rb")
+            except FileNotFoundError:
+                continue
+            with f:
+                for n, r in sorted(items, key=lambda t: t[1]["off"]):
+                    f.seek(r["off"]); out[n] = json.loads(f.read(r["len"]))
+        return [out[n] for n in sorted(out)]
+
+    def count(self) -> int:
+        try:
+            with open(self.index, "rb") as f: return sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1 << 20), b""))
+        except FileNotFoundError:
+            return len(self._refs())
+
+    def version(self) -> tuple:
+        # changes with every append and clear — a cache key for exports
+        try: st = os.stat(self.index); return st.st_size, st.st_mtime_ns
+        except FileNotFoundError: return 0, 0
+
+    def latest(self, n: int = 5) -> list:
+        return self._fetch(self._refs(tail=n))
+
+    def query(self, date: str = "", bucket: str = "", event_type: str = "", limit: int = 0) -> list:
+        # filters match exactly; empty = any. limit keeps the newest matches.
+        refs = [r for r in self._refs()
+                if (not date or r["date"] == date) and (not bucket or r["bucket"] == bucket)
+                and (not event_type or r["event_type"] == event_type)]
+        return self._fetch(refs[-limit:] if limit else refs)
+
+    def all(self) -> list:
+        # every event, oldest first — the JSON-array format of the download button
+        out = []
+        for seq in self._segments():
+            path = self._seg_path(seq)
+            f = open(path, "rb") if os.path.exists(path) else gzip.open(self._seg_path(seq, gz=True), "rb")
+            with f: out += _json_lines(f)
+        return out
+
+
+def _json_lines(lines) -> list:
+    # readers don't take the lock — skip a line a writer is still appending
+    out = []
+    for ln in lines:
+        try: out.append(json.loads(ln))
+        except ValueError: pass
+    return out
+
+
+session_log = SessionLog()
+
+
+def log_session_event(
+    event_type: str,
+    bucket: str = "",
+    source_prefix: str = "",
+    output_prefix: str = "",
+    mode: str = "",
+    summary: dict = None,
+    reference_image: str = "",
+    extra: dict = None,
+) -> None:
+    now = datetime.datetime.now()
+    iso = now.isoformat()
+
+    # ID format: 2026-02-19T18-02-40-706873_event_type
+    entry_id = f"{iso}_{event_type}".replace(":", "-").replace(".", "-")
+
+    # ── results block ─────────────────────────────────────────────────────────
+    # total_processed & moved_count = images actually moved/grouped
+    # unchanged_count = always 0 (real unchanged lives in extra)
+    results: dict = {}
+    if summary:
+        moved_total = sum(len(v) for v in summary.values())
+        results = {
+            "total_processed": moved_total,
+            "groups":          summary,
+            "moved_count":     moved_total,
+            "unchanged_count": 0,
+        }
+
+    # ── extra block: full picture ─────────────────────────────────────────────
+    # Callers must pass:
+    #   moved           = int (same as moved_count)
+    #   unchanged_count = int (images that stayed)
+    #   total_processed = moved + unchanged  (full scan size)
+    # Plus any event-specific keys (is_placeholder, dest_sub, etc.)
+    _extra = dict(extra) if extra else {}
+
+    entry = {
+        "id":              entry_id,
+        "timestamp":       iso,
+        "date":            now.strftime("%Y-%m-%d"),
+        "time":            now.strftime("%H:%M:%S"),
+        "event_type":      event_type,
+        "bucket":          bucket,
+        "source_prefix":   source_prefix,
+        "output_prefix":   output_prefix,
+        "mode":            mode,
+        "reference_image": reference_image,
+        "results":         results,
+        "extra":           _extra,
+    }
+
+    # appended to the JSONL session log on every call
+    session_log.append(entry)
+
+
+# ════════════════════════════════════════════════════════════════════════════════
+# STAGE TIMINGS — where a run's time went. Every engine runs under one
+# RunProfile (the current one lives in a context variable; run_pipeline,
+# delete_r2_many and move_r2_many carry it onto their worker threads, and the
+# feature pool sends its workers' times back with the records):
+#   listing  head  download  upload  copy  delete   storage calls, bytes, retries
+#   decode   features  ocr                          inside extract_features
+#   pipeline download / extract / write             one call per image
+# summary() is what the engines log under extra["timings"]. workers["slowest"]
+# (or SEGREGATOR_PROFILE_SLOWEST) = N also keeps the N slowest images with
+# their own per-stage split. last_run_timings() is the latest finished engine.
+# ════════════════════════════════════════════════════════════════════════════════
+PROFILE_SLOWEST = int(os.environ.get("SEGREGATOR_PROFILE_SLOWEST", "0"))
+PROFILE_STAGES  = ("listing", "head", "download", "decode", "features", "ocr", "upload", "copy", "delete")
+_OP_STAGE       = {"list": "listing", "get": "download", "put": "upload"}      # Storage op → stage
+
+_profile = contextvars.ContextVar("segregator_profile", default=None)
+_item    = contextvars.ContextVar("segregator_item", default=None)    # key a pipeline worker is on
+_engine  = contextvars.ContextVar("segregator_engine", default="")    # engine the current run belongs to
+
+
+class RunProfile:
+    def __init__(self, slowest: int = 0):
+        self.slowest = max(0, int(slowest or 0))
+        self._t0     = time.perf_counter()
+        self._lock   = threading.Lock()
+        self._stages, self._steps, self._items = {}, {}, {}
+
+    def add(self, stage: str, seconds: float = 0.0, nbytes: int = 0, retries: int = 0,
+            error: bool = False, key=None, calls: int = 1) -> None:
+        with self._lock:
+            s = self._stages.setdefault(stage, {"calls": 0, "seconds": 0.0, "max": 0.0,
+                                                "bytes": 0, "retries": 0, "errors": 0})
+            s["calls"] += calls; s["seconds"] += seconds; s["max"] = max(s["max"], seconds)
+            s["bytes"] += nbytes; s["retries"] += retries; s["errors"] += bool(error)
+            if self.slowest and key is not None and seconds:
+                d = self._items.setdefault(key, {"steps": {}, "stages": {}})["stages"]
+                d[stage] = d.get(stage, 0.0) + seconds
+
+    def step(self, stage: str, seconds: float, key=None) -> None:
+        # one run_pipeline stage call (download / extract / write) for one image
+        with self._lock:
+            s = self._steps.setdefault(stage, {"calls": 0, "seconds": 0.0, "max": 0.0})
+            s["calls"] += 1; s["seconds"] += seconds; s["max"] = max(s["max"], seconds)
+            if self.slowest and key is not None:
+                d = self._items.setdefault(key, {"steps": {}, "stages": {}})["steps"]
+                d[stage] = d.get(stage, 0.0) + seconds
+
+    def totals(self) -> dict:
+        # → {stage: (seconds, calls)}
+        with self._lock: return {k: (v["seconds"], v["calls"]) for k, v in self._stages.items()}
+
+    def summary(self) -> dict:
+        ms = lambda x: round(x * 1000, 3)
+        with self._lock:
+            n   = max((v["calls"] for v in self._steps.values()), default=0)
+            row = lambda v: {"calls": v["calls"], "total_s": round(v["seconds"], 4),
+                             "per_image_ms": ms(v["seconds"] / n) if n else None, "max_ms": ms(v["max"]),
+                             **{k: v[k] for k in ("bytes", "retries", "errors") if k in v}}
+            order = lambda kv: (PROFILE_STAGES.index(kv[0]) if kv[0] in PROFILE_STAGES else len(PROFILE_STAGES), kv[0])
+            out = {"wall_s": round(time.perf_counter() - self._t0, 3), "images": n,
+                   "stages":   {k: row(v) for k, v in sorted(self._stages.items(), key=order)},
+                   "pipeline": {k: row(v) for k, v in self._steps.items()}}
+            if self.slowest:
+                top = heapq.nlargest(self.slowest, self._items.items(), key=lambda kv: sum(kv[1]["steps"].values()))
+                out["slowest"] = [{"key": k, "total_ms": ms(sum(d["steps"].values())),
+                                   "pipeline": {s: ms(v) for s, v in d["steps"].items()},
+                                   "stages":   {s: ms(v) for s, v in d["stages"].items()}} for k, d in top]
+        return out
+
+
+@contextlib.contextmanager
+def profiled(slowest: int = None):
+    # makes a fresh RunProfile current for this block → the profile
+    prof  = RunProfile(PROFILE_SLOWEST if slowest is None else slowest)
+    token = _profile.set(prof)
+    try: yield prof
+    finally: _profile.reset(token)
+
+
+@contextlib.contextmanager
+def _stage(name: str, nbytes: int = 0):
+    # times the block into the current profile, if any → dict; set ["bytes"] once known
+    prof, on, acc = _profile.get(), _metrics().enabled, {"bytes": nbytes}
+    if prof is None and not on:
+        yield acc; return
+    t0, err = time.perf_counter(), False
+    try: yield acc
+    except BaseException: err = True; raise
+    finally:
+        dt = time.perf_counter() - t0
+        if prof is not None: prof.add(name, dt, acc["bytes"], error=err, key=_item.get())
+        if on: _record_stage(name, dt, acc["bytes"], err)
+
+
+def _retried(op: str, n: int = 1) -> None:
+    # a Storage op that needed n extra attempts
+    if not n: return
+    prof = _profile.get()
+    if prof is not None: prof.add(_OP_STAGE.get(op, op), retries=n, calls=0)
+    _metrics().inc("storage_retries_total", n, op=_OP_STAGE.get(op, op))
+
+
+def _in_context(fn):
+    # fn bound to a copy of this thread's context — for work handed to other threads
+    return functools.partial(contextvars.copy_context().run, fn)
+
+
+_last_run = {}
+
+def _timed_engine(fn):
+    # runs the engine under its own RunProfile (one engine called by another
+    # shares its caller's) and keeps the result for last_run_timings()
+    sig = inspect.signature(fn)
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        if _profile.get() is not None: return fn(*args, **kwargs)
+        workers = sig.bind_partial(*args, **kwargs).arguments.get("workers") or {}
+        token, status, t0 = _engine.set(fn.__name__), "error", time.perf_counter()
+        with profiled(workers.get("slowest")) as prof:
+            try:
+                out = fn(*args, **kwargs); status = "ok" if out else "nothing_done"
+                return out
+            finally:
+                _engine.reset(token)
+                _metrics().inc("engine_runs_total", engine=fn.__name__, status=status)
+                _metrics().observe("engine_seconds", time.perf_counter() - t0, engine=fn.__name__)
+                _last_run.clear()
+                _last_run.update(engine=fn.__name__, finished=datetime.datetime.now().isoformat(), **prof.summary())
+    return run
+
+
+def _timings() -> dict:
+    # → {"timings": summary of the current profile}, for an engine's log extra
+    prof = _profile.get()
+    return {"timings": prof.summary()} if prof is not None else {}
+
+
+def last_run_timings() -> dict:
+    return dict(_last_run)
+
+# ════════════════════════════════════════════════════════════════════════════════
+# METRICS — counters, gauges and histograms for long-running deployments, in
+# the Prometheus text format. Off (every call a no-op) until start_metrics():
+#   SEGREGATOR_METRICS_PORT   serve /metrics on SEGREGATOR_METRICS_HOST (127.0.0.1)
+#   SEGREGATOR_METRICS_FILE   rewrite this file every METRICS_FILE_INTERVAL
+#                             seconds and at exit — for node_exporter's textfile
+#                             collector, or a cron job that ships it
+# Stage timings feed it (see _stage), so anything a RunProfile sees is here
+# too, summed over every run. Each metric is declared in METRICS; recording
+# an undeclared one raises KeyError instead of silently dropping it.
+# ════════════════════════════════════════════════════════════════════════════════
+METRICS_PORT          = int(os.environ.get("SEGREGATOR_METRICS_PORT", "0"))
+METRICS_HOST          = os.environ.get("SEGREGATOR_METRICS_HOST", "127.0.0.1")
+METRICS_FILE          = os.environ.get("SEGREGATOR_METRICS_FILE", "")
+METRICS_FILE_INTERVAL = 15
+METRICS_BUCKETS       = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+METRICS = {     # name (exported as segregator_<name>) → (type, help)
+    "engine_runs_total":        ("counter",   "Engine runs by engine and status"),
+    "engine_seconds":           ("histogram", "Wall time of an engine run"),
+    "images_processed_total":   ("counter",   "Images through an engine pipeline by engine and status"),
+    "pipeline_stage_seconds":   ("histogram", "Time per image in each pipeline stage"),
+    "stage_seconds":            ("histogram", "Time per call of each stage (listing, head, download, decode, features, ocr, upload, copy, delete, presign, thumbnail)"),
+    "storage_calls_total":      ("counter",   "Storage calls by operation and status"),
+    "storage_retries_total":    ("counter",   "Retried storage attempts by operation"),
+    "downloaded_bytes_total":   ("counter",   "Object bytes downloaded"),
+    "uploaded_bytes_total":     ("counter",   "Object bytes uploaded"),
+    "ocr_invocations_total":    ("counter",   "Placeholder OCR runs"),
+    "cache_requests_total":     ("counter",   "Cache lookups by cache and result"),
+    "queue_depth":              ("gauge",     "Items waiting in a queue, last seen"),
+    "gallery_thumbnails_total": ("counter",   "Gallery thumbnails rendered by view and status"),
+}
+_STORAGE_STAGES = {"listing", "head", "download", "upload", "copy", "delete", "presign"}
+
+
+def _prom_num(x) -> str:
+    if x == math.inf: return "+Inf"
+    return str(int(x)) if float(x).is_integer() else repr(float(x))
+
+def _prom_labels(labels) -> str:
+    if not labels: return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels) + "}"
+
+
+class Metrics:
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.enabled, self.buckets = False, tuple(buckets)
+        self._lock   = threading.Lock()
+        self._values = {}   # (name, labels) → number; a histogram → [count per bucket…, +Inf count, sum]
+
+    def _key(self, name, kind, labels):
+        if METRICS[name][0] != kind: raise KeyError(f"{name} is a {METRICS[name][0]}, not a {kind}")
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        if not self.enabled: return
+        key = self._key(name, "counter", labels)
+        with self._lock: self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        if not self.enabled: return
+        key = self._key(name, "gauge", labels)
+        with self._lock: self._values[key] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        if not self.enabled: return
+        key = self._key(name, "histogram", labels)
+        i   = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            h = self._values.get(key)
+            if h is None: h = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            h[i] += 1; h[-1] += value
+
+    def render(self) -> str:
+        with self._lock: items = sorted((k, list(v) if isinstance(v, list) else v) for k, v in self._values.items())
+        out, seen = [], set()
+        for (name, labels), v in items:
+            kind, help_ = METRICS[name]; full = f"segregator_{name}"
+            if name not in seen:
+                seen.add(name); out += [f"# HELP {full} {help_}", f"# TYPE {full} {kind}"]
+            if kind != "histogram":
+                out.append(f"{full}{_prom_labels(labels)} {_prom_num(v)}"); continue
+            n = 0
+            for le, c in zip(self.buckets + (math.inf,), v[:-1]):
+                n += c; out.append(f"{full}_bucket{_prom_labels(labels + (('le', _prom_num(le)),))} {n}")
+            out += [f"{full}_sum{_prom_labels(labels)} {_prom_num(v[-1])}", f"{full}_count{_prom_labels(labels)} {n}"]
+        return "\n".join(out) + "\n"
+
+    def write(self, path: str) -> None:
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f: f.write(self.render())
+        os.replace(tmp, path)
+
+    def serve(self, port: int, host: str = METRICS_HOST):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        registry = self
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"): self.send_error(404); return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers(); self.wfile.write(body)
+            def log_message(self, *args): pass
+        srv = ThreadingHTTPServer((host, port), _Handler)
+        threading.Thread(target=srv.serve_forever, daemon=True).start()
+        return srv
+
+
+@functools.lru_cache(maxsize=None)
+def _metrics() -> Metrics:
+    return Metrics()
+
+
+_exporters, _exporters_lock = {}, threading.Lock()
+
+def start_metrics(port: int = None, path: str = None) -> dict:
+    # turns the registry on and starts the exporters asked for (default: the
+    # env settings). Safe to call on every rerun → {"port": …, "file": …} running
+    port = METRICS_PORT if port is None else int(port)
+    path = METRICS_FILE if path is None else path
+    reg  = _metrics()
+    with _exporters_lock:
+        if port and "port" not in _exporters:
+            reg.serve(port); _exporters["port"] = port
+        if path and "file" not in _exporters:
+            def _flush():
+                with contextlib.suppress(OSError): reg.write(path)
+            def _loop():
+                while True: time.sleep(METRICS_FILE_INTERVAL); _flush()
+            threading.Thread(target=_loop, daemon=True).start()
+            atexit.register(_flush)
+            _exporters["file"] = path
+        reg.enabled = reg.enabled or bool(_exporters)
+        return dict(_exporters)
+
+
+def _record_stage(stage: str, seconds: float, nbytes: int = 0, error: bool = False, calls: int = 1) -> None:
+    # one stage call (or `calls` of them, `seconds` each) into the metrics
+    reg = _metrics()
+    for _ in range(calls): reg.observe("stage_seconds", seconds, stage=stage)
+    if stage in _STORAGE_STAGES: reg.inc("storage_calls_total", calls, op=stage, status="error" if error else "ok")
+    if stage == "ocr":                 reg.inc("ocr_invocations_total", calls)
+    if stage == "download" and nbytes: reg.inc("downloaded_bytes_total", nbytes)
+    if stage == "upload" and nbytes:   reg.inc("uploaded_bytes_total", nbytes)
+
+# ════════════════════════════════════════════════════════════════════════════════
+# R2 CLIENT — credentials come from the R2_ENDPOINT, R2_ACCESS_KEY and
+# R2_SECRET_KEY environment variables
+# ════════════════════════════════════════════════════════════════════════════════
+def make_s3_client():
+    if not (R2_ENDPOINT and R2_ACCESS_KEY and R2_SECRET_KEY):
+        raise RuntimeError("R2 credentials missing — set R2_ENDPOINT, R2_ACCESS_KEY and R2_SECRET_KEY")
+    import boto3                                    # imported here so `--help` and
+    from botocore.client import Config              # local-only runs start fast
+    return boto3.client(
+        "s3",
+        endpoint_url=R2_ENDPOINT,
+        aws_access_key_id=R2_ACCESS_KEY,
+        aws_secret_access_key=R2_SECRET_KEY,
+        config=Config(signature_version="s3v4",
+                      retries={"max_attempts": 5, "mode": "adaptive"},
+                      max_pool_connections=64),
+        region_name="auto",
+    )
+
+def object_version(obj: dict) -> str:
+    # ETag when the listing has one, else size + LastModified
+    etag = str(obj.get("ETag") or "").strip('"')
+    return etag or f"{obj.get('Size', '')}-{obj.get('LastModified', '')}"
+
+def _version(meta: dict, key: str) -> str:
+    return meta.get(key, {}).get("version", "")
+
+# ════════════════════════════════════════════════════════════════════════════════
+# STORAGE — the operations every engine needs, behind one interface:
+#   list(bucket, prefix)            → {"Key", "Size", "ETag", "LastModified"} in key order
+#   list_dir(bucket, prefix, max)   → one level: (sub-prefixes, objects, truncated)
+#   get(bucket, key)                → (binary stream, size)
+#   put(bucket, key, src, ctype)    src = path or binary file object
+#   copy(bucket, src_key, dest_key)
+#   delete(bucket, keys)            → {key: error} for the keys that failed (≤ 1000 keys)
+#   head(bucket, key)               → same dict as list, or None if missing
+#   presign(bucket, key, expires)   → URL, "" if the backend has none
+# S3Storage wraps a boto3 client (R2). LocalStorage treats `bucket` as a
+# directory and keys as "/"-separated paths below it. FakeStorage keeps
+# objects in memory and injects per-request latency, bandwidth limits and
+# errors, so throughput and retries can be measured without a network.
+#
+# Engines and helpers keep their (s3, bucket, …) signatures: `s3` may be a
+# boto3 client or any Storage, and storage_for() resolves it.
+# ════════════════════════════════════════════════════════════════════════════════
+class Storage:
+    cache_listings = True       # False: scan_bucket always lists (cheap, or changed behind our back)
+    shard_listings = True       # False: list_sharded walks list() alone (no round trip to hide)
+
+    def list(self, bucket: str, prefix: str = "", start_after: str = ""): raise NotImplementedError
+    def get(self, bucket: str, key: str):                   raise NotImplementedError
+
+    def list_dir(self, bucket: str, prefix: str = "", max_keys: int = 0):
+        # rolled up from a full listing; backends with a delimiter listing override it.
+        # max_keys caps folders + objects returned, truncated=True if more exist
+        folders, objs = {}, []
+        for o in self.list(bucket, prefix):
+            rest = o["Key"][len(prefix):]
+            f = prefix + rest.split("/", 1)[0] + "/" if "/" in rest else None
+            if f in folders: continue
+            if max_keys and len(folders) + len(objs) >= max_keys: return list(folders), objs, True
+            if f: folders[f] = None
+            else: objs.append(o)
+        return list(folders), objs, False
+    def put(self, bucket: str, key: str, src, content_type: str = "application/octet-stream"):
+        raise NotImplementedError
+    def copy(self, bucket: str, src_key: str, dest_key: str): raise NotImplementedError
+    def delete(self, bucket: str, keys) -> dict:            raise NotImplementedError
+    def head(self, bucket: str, key: str):                  raise NotImplementedError
+    def presign(self, bucket: str, key: str, expires: int = 600) -> str: return ""
+
+
+def _retries(resp) -> int:
+    # attempts boto3 retried before this response came back
+    return int((resp or {}).get("ResponseMetadata", {}).get("RetryAttempts", 0) or 0)
+
+
+class S3Storage(Storage):
+    def __init__(self, client):
+        self.client = client
+
+    def list(self, bucket, prefix="", start_after=""):
+        extra = {"StartAfter": start_after} if start_after else {}
+        for page in self.client.get_paginator("list_objects_v2").paginate(
+                Bucket=bucket, Prefix=prefix, PaginationConfig={"PageSize": 1000}, **extra):
+            _retried("list", _retries(page))
+            yield from page.get("Contents", [])
+
+    def list_dir(self, bucket, prefix="", max_keys=0):
+        folders, objs = [], []
+        for page in self.client.get_paginator("list_objects_v2").paginate(
+                Bucket=bucket, Prefix=prefix, Delimiter="/", PaginationConfig={"PageSize": 1000}):
+            _retried("list", _retries(page))
+            folders += [p["Prefix"] for p in page.get("CommonPrefixes", [])]
+            objs    += page.get("Contents", [])
+            if max_keys and len(folders) + len(objs) >= max_keys:
+                # a page holds up to 1000 entries: keep the first max_keys in key order
+                cut  = sorted(folders + [o["Key"] for o in objs])[max_keys - 1]
+                more = len(folders) + len(objs) > max_keys or bool(page.get("IsTruncated"))
+                return [f for f in folders if f <= cut], [o for o in objs if o["Key"] <= cut], more
+        return folders, objs, False
+
+    def get(self, bucket, key):
+        resp = self.client.get_object(Bucket=bucket, Key=key); _retried("get", _retries(resp))
+        return resp["Body"], resp.get("ContentLength", 0)
+
+    def put(self, bucket, key, src, content_type="application/octet-stream"):
+        if isinstance(src, str): self.client.upload_file(src, bucket, key, ExtraArgs={"ContentType": content_type})
+        else: src.seek(0); self.client.upload_fileobj(src, bucket, key, ExtraArgs={"ContentType": content_type})
+
+    def copy(self, bucket, src_key, dest_key):
+        # server-side; ContentType/metadata carried over by MetadataDirective=COPY.
+        # A store without CopyObject answers NotImplemented — raised as such,
+        # every other error (AccessDenied, NoSuchKey, throttling) as it came
+        try: r = self.client.copy_object(Bucket=bucket, Key=dest_key, MetadataDirective="COPY",
+                                         CopySource={"Bucket": bucket, "Key": src_key})
+        except Exception as e:
+            if str(getattr(e, "response", {}).get("Error", {}).get("Code", "")) in ("NotImplemented", "501"):
+                raise NotImplementedError(f"copy: {e}") from e
+            raise
+        _retried("copy", _retries(r))
+
+    def delete(self, bucket, keys):
+        r = self.client.delete_objects(Bucket=bucket, Delete={"Objects": [{"Key": k} for k in keys], "Quiet": True})
+        _retried("delete", _retries(r))
+        return {e["Key"]: f"{e.get('Code','')} {e.get('Message','')}".strip() for e in r.get("Errors", [])}
+
+    def head(self, bucket, key):
+        try: r = self.client.head_object(Bucket=bucket, Key=key)
+        except Exception as e:
+            if str(getattr(e, "response", {}).get("Error", {}).get("Code", "")) in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        _retried("head", _retries(r))
+        return {"Key": key, "Size": r.get("ContentLength", 0), "ETag": r.get("ETag", ""),
+                "LastModified": r.get("LastModified")}
+
+    def presign(self, bucket, key, expires=600):
+        return self.client.generate_presigned_url("get_object", Params={"Bucket": bucket, "Key": key},
+                                                  ExpiresIn=expires)
+
+
+class LocalStorage(Storage):
+    # bucket = a directory; writes land in a temp file first and are renamed
+    # into place, so a half-written copy never shows up under its real name.
+    # mounts={name: directory}: the first key segment picks the directory and
+    # the bucket is only a label — for folders with no common root
+    cache_listings = False
+    shard_listings = False
+    def __init__(self, mounts: dict = None):
+        self.mounts = mounts or {}
+
+    def _path(self, bucket, key):
+        parts = [p for p in key.split("/") if p]
+        if not self.mounts: return os.path.join(bucket, *parts)
+        if not parts or parts[0] not in self.mounts: raise FileNotFoundError(f"no mount for `{key}`")
+        return os.path.join(self.mounts[parts[0]], *parts[1:])
+
+    def _obj(self, bucket, key, st):
+        return {"Key": key, "Size": st.st_size, "ETag": "",
+                "LastModified": datetime.datetime.fromtimestamp(st.st_mtime, datetime.timezone.utc)}
+
+    def list(self, bucket, prefix="", start_after=""):
+        pdir = prefix.rsplit("/", 1)[0] if "/" in prefix else ""
+        if self.mounts and not pdir:
+            for m in sorted(m for m in self.mounts if f"{m}/".startswith(prefix)):
+                yield from self.list(bucket, f"{m}/", start_after)
+            return
+        base, found = self._path(bucket, pdir), []
+        for root, _, files in os.walk(base):
+            for f in files:
+                key = Path(pdir, os.path.relpath(os.path.join(root, f), base)).as_posix()
+                if key.startswith(prefix) and key > start_after and ".segtmp" not in f:
+                    try: found.append(self._obj(bucket, key, os.stat(os.path.join(root, f))))
+                    except OSError: pass        # vanished while listing
+        yield from sorted(found, key=lambda o: o["Key"])
+
+    def list_dir(self, bucket, prefix="", max_keys=0):
+        if prefix and not prefix.endswith("/"): return super().list_dir(bucket, prefix, max_keys)
+        if self.mounts and not prefix:
+            ms = [f"{m}/" for m in sorted(self.mounts)]
+            return (ms[:max_keys], [], len(ms) > max_keys) if max_keys else (ms, [], False)
+        folders, objs = [], []
+        try: entries = sorted(os.scandir(self._path(bucket, prefix)), key=lambda e: e.name)
+        except (FileNotFoundError, NotADirectoryError): return [], [], False
+        for e in entries:
+            if max_keys and len(folders) + len(objs) >= max_keys: return folders, objs, True
+            try:
+                if e.is_dir(): folders.append(f"{prefix}{e.name}/")
+                elif ".segtmp" not in e.name: objs.append(self._obj(bucket, prefix + e.name, e.stat()))
+            except OSError: pass        # vanished while listing
+        return folders, objs, False
+
+    def get(self, bucket, key):
+        path = self._path(bucket, key)
+        return open(path, "rb"), os.path.getsize(path)
+
+    def _write(self, bucket, key, fill):
+        dest = self._path(bucket, key)
+        os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+        tmp = f"{dest}.{threading.get_ident()}.segtmp"
+        try:
+            fill(tmp); os.replace(tmp, dest)
+        except BaseException:
+            with contextlib.suppress(OSError): os.remove(tmp)
+            raise
+
+    def put(self, bucket, key, src, content_type="application/octet-stream"):
+        if isinstance(src, str): self._write(bucket, key, lambda tmp: shutil.copy2(src, tmp))
+        else:
+            def _fill(tmp):
+                src.seek(0)
+                with open(tmp, "wb") as f: shutil.copyfileobj(src, f, 1024 * 1024)
+            self._write(bucket, key, _fill)
+
+    def copy(self, bucket, src_key, dest_key):
+        src = self._path(bucket, src_key)
+        self._write(bucket, dest_key, lambda tmp: shutil.copy2(src, tmp))
+
+    def delete(self, bucket, keys):
+        errors = {}
+        for k in keys:
+            try: os.remove(self._path(bucket, k))
+            except FileNotFoundError: pass     # already gone counts as deleted, as on S3
+            except OSError as e: errors[k] = str(e)
+        return errors
+
+    def head(self, bucket, key):
+        try: return self._obj(bucket, key, os.stat(self._path(bucket, key)))
+        except FileNotFoundError: return None
+
+    def presign(self, bucket, key, expires=600):
+        return Path(os.path.abspath(self._path(bucket, key))).as_uri()
+
+
+class FakeStorageError(Exception):
+    pass
+
+
+class FakeStorage(Storage):
+    """
+    In-memory buckets for benchmarks and offline runs.
+    latency      seconds added to every request (+ uniform jitter)
+    bandwidth    bytes/second for get/put bodies, 0 = unlimited
+    error_rate   chance that one request attempt fails, for ops in fail_ops
+    max_attempts attempts per request before the error surfaces — the same
+                 client-side retry the boto3 client does (exponential backoff)
+    copy         False: copy() is refused as by a store without CopyObject
+    stats()      requests, failed attempts, retries and bytes moved per op
+    """
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, bandwidth: float = 0,
+                 error_rate: float = 0.0, fail_ops=("list", "get", "put", "copy", "delete", "head"),
+                 max_attempts: int = 1, backoff: float = 0.05, seed=None, copy: bool = True):
+        import random
+        self.latency, self.jitter, self.bandwidth = latency, jitter, bandwidth
+        self.error_rate, self.fail_ops = error_rate, set(fail_ops)
+        self.max_attempts, self.backoff = max(1, int(max_attempts)), backoff
+        self.copy_supported = copy
+        self._rng   = random.Random(seed)
+        self._objs  = {}            # (bucket, key) → (bytes, etag, last_modified)
+        self._lock  = threading.Lock()
+        self._stats = {}
+
+    def add(self, bucket: str, key: str, data: bytes) -> None:
+        # seed an object without charging a request
+        with self._lock: self._objs[(bucket, key)] = self._entry(data)
+
+    def stats(self) -> dict:
+        with self._lock: return {op: dict(v) for op, v in self._stats.items()}
+
+    def _entry(self, data):
+        return bytes(data), hashlib.md5(data).hexdigest(), datetime.datetime.now(datetime.timezone.utc)
+
+    def _request(self, op, nbytes=0):
+        for attempt in range(1, self.max_attempts + 1):
+            with self._lock:
+                st = self._stats.setdefault(op, {"requests": 0, "failed": 0, "retries": 0, "bytes": 0})
+                st["requests"] += attempt == 1; st["retries"] += attempt > 1
+                delay = self.latency + (self._rng.uniform(0, self.jitter) if self.jitter else 0)
+                fail  = op in self.fail_ops and self._rng.random() < self.error_rate
+                if fail: st["failed"] += 1
+                else:    st["bytes"] += nbytes
+            if self.bandwidth and not fail: delay += nbytes / self.bandwidth
+            if delay: time.sleep(delay)
+            if attempt > 1: _retried(op)
+            if not fail: return
+            if attempt < self.max_attempts: time.sleep(self.backoff * 2 ** (attempt - 1))
+        raise FakeStorageError(f"injected {op} failure")
+
+    def _must(self, bucket, key):
+        with self._lock: e = self._objs.get((bucket, key))
+        if e is None: raise FakeStorageError(f"NoSuchKey: {key}")
+        return e
+
+    def list(self, bucket, prefix="", start_after=""):
+        with self._lock:
+            objs = sorted((k, e) for (b, k), e in self._objs.items()
+                          if b == bucket and k.startswith(prefix) and k > start_after)
+        for i in range(0, max(1, len(objs)), 1000):         # one request per 1000-key page
+            self._request("list")
+            for k, (data, etag, lm) in objs[i:i + 1000]:
+                yield {"Key": k, "Size": len(data), "ETag": f'"{etag}"', "LastModified": lm}
+
+    def list_dir(self, bucket, prefix="", max_keys=0):
+        # S3 semantics: a sub-prefix is one entry, one request per 1000 entries
+        with self._lock:
+            objs = sorted((k, e) for (b, k), e in self._objs.items() if b == bucket and k.startswith(prefix))
+        entries, seen = [], set()
+        for k, e in objs:
+            rest = k[len(prefix):]
+            if "/" in rest:
+                f = prefix + rest.split("/", 1)[0] + "/"
+                if f not in seen: seen.add(f); entries.append((f, None))
+            else: entries.append((k, e))
+        folders, out = [], []
+        for i in range(0, max(1, len(entries)), 1000):
+            self._request("list")
+            for k, e in entries[i:i + 1000]:
+                if max_keys and len(folders) + len(out) >= max_keys: return folders, out, True
+                if e is None: folders.append(k)
+                else: out.append({"Key": k, "Size": len(e[0]), "ETag": f'"{e[1]}"', "LastModified": e[2]})
+        return folders, out, False
+
+    def get(self, bucket, key):
+        data = self._must(bucket, key)[0]
+        self._request("get", len(data))
+        return io.BytesIO(data), len(data)
+
+    def put(self, bucket, key, src, content_type="application/octet-stream"):
+        if isinstance(src, str):
+            with open(src, "rb") as f: data = f.read()
+        else: src.seek(0); data = src.read()
+        self._request("put", len(data))
+        with self._lock: self._objs[(bucket, key)] = self._entry(data)
+
+    def copy(self, bucket, src_key, dest_key):
+        if not self.copy_supported: raise NotImplementedError("copy")
+        data = self._must(bucket, src_key)[0]
+        self._request("copy")
+        with self._lock: self._objs[(bucket, dest_key)] = self._entry(data)
+
+    def delete(self, bucket, keys):
+        keys = list(keys)
+        try: self._request("delete")
+        except FakeStorageError as e: return {k: str(e) for k in keys}
+        with self._lock:
+            for k in keys: self._objs.pop((bucket, k), None)
+        return {}
+
+    def head(self, bucket, key):
+        self._request("head")
+        with self._lock: e = self._objs.get((bucket, key))
+        return None if e is None else {"Key": key, "Size": len(e[0]), "ETag": f'"{e[1]}"', "LastModified": e[2]}
+
+    def presign(self, bucket, key, expires=600):
+        return f"fake://{bucket}/{urllib.parse.quote(key)}?expires={expires}"
+
+
+def storage_for(s3) -> Storage:
+    # a Storage as is; anything else is taken to be a boto3 S3 client
+    return s3 if isinstance(s3, Storage) else S3Storage(s3)
+
+# ════════════════════════════════════════════════════════════════════════════════
+# SHARDED LISTING — list() pages through a prefix 1000 keys per round trip,
+# one after another. list_sharded() reads that first page itself: a prefix
+# that fits in it, or whose keys are flat or spread over folders of fewer
+# than LIST_SHARD_MIN keys, carries on as the plain paginated list() — a
+# planning round trip per folder would cost more than the pages it hides.
+# Otherwise the rest of the prefix is cut into at most LIST_SHARDS contiguous
+# key ranges: one delimiter listing per level (LIST_SHARD_DEPTH levels, only
+# while there are fewer than LIST_SHARDS folders), then runs of adjacent
+# entries holding about as many folders each. Every range is listed from its
+# StartAfter boundary to the next one, concurrently, and yielded in order.
+# A level with more than LIST_SHARD_PROBE direct entries stays one range.
+# ════════════════════════════════════════════════════════════════════════════════
+LIST_SHARDS      = int(os.environ.get("SEGREGATOR_LIST_SHARDS", "8"))
+LIST_SHARD_DEPTH = 3
+LIST_SHARD_PROBE = 5000
+LIST_SHARD_MIN   = 100
+
+
+def _after(entry, is_dir):
+    # the StartAfter that skips past a key, or past every key under a folder
+    # (nothing real sorts past the last code point)
+    return entry + "\U0010ffff" if is_dir else entry
+
+
+def _shard_plan(store, bucket, prefix, shards, pool):
+    # → [(start_after, end or None)] key ranges covering prefix in key order, at most `shards`
+    units = [(prefix, True)]            # (key or folder, is folder), partitioning the prefix
+    for _ in range(LIST_SHARD_DEPTH):
+        open_ = [k for k, d in units if d]
+        if len(open_) >= shards: break
+        futs   = [pool.submit(_in_context(store.list_dir), bucket, p, LIST_SHARD_PROBE) for p in open_]
+        levels = {p: f.result() for p, f in zip(open_, futs)}
+        nxt, split = [], False
+        for k, d in units:
+            folders, objs, truncated = levels[k] if d else (None, None, True)
+            if truncated: nxt.append((k, d)); continue
+            nxt += [(o["Key"], False) for o in objs] + [(f, True) for f in folders]
+            split = True
+        units = sorted(nxt)
+        if not split: break
+    dirs = [i for i, (_, d) in enumerate(units) if d]
+    n    = min(shards, len(dirs))
+    cuts = [dirs[len(dirs) * j // n] for j in range(1, n)]
+    starts = [""] + [_after(*units[c - 1]) for c in cuts]
+    ends   = [units[c][0] for c in cuts] + [None]
+    return list(zip(starts, ends))
+
+
+def list_sharded(s3, bucket: str, prefix: str = "", shards: int = LIST_SHARDS):
+    # same objects, same order as storage_for(s3).list(bucket, prefix)
+    store = storage_for(s3)
+    it    = store.list(bucket, prefix)
+    if shards <= 1 or not store.shard_listings:
+        yield from it
+        return
+    first = list(itertools.islice(it, 1000))
+    dirs  = collections.Counter(o["Key"][len(prefix):].split("/", 1)[0]
+                                for o in first if "/" in o["Key"][len(prefix):])
+    if len(first) < 1000 or sum(dirs.values()) < LIST_SHARD_MIN * max(1, len(dirs)):
+        yield from first
+        yield from it
+        return
+    it.close()
+    last = first[-1]["Key"]
+    stop = threading.Event()
+
+    def _shard(start_after, end):
+        out = []
+        for o in store.list(bucket, prefix, start_after):
+            if stop.is_set() or (end is not None and o["Key"] >= end): break
+            out.append(o)
+        return out
+
+    pool = ThreadPoolExecutor(max_workers=shards)
+    try:
+        ranges = [(max(sa, last), end) for sa, end in _shard_plan(store, bucket, prefix, shards, pool)
+                  if end is None or end > last]         # the first page already covers up to `last`
+        futs   = [pool.submit(_in_context(_shard), sa, end) for sa, end in ranges]
+        yield from first
+        for f in futs: yield from f.result()
+    finally:
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+# ════════════════════════════════════════════════════════════════════════════════
+# LISTING CACHE — scan_bucket results per (bucket, prefix), kept for
+# LISTING_TTL seconds (SEGREGATOR_LISTING_TTL, 0 = off). A prefix is also
+# served from a complete listing of any parent prefix. Our own writes keep it
+# honest: deletes drop their keys from every entry, copies/uploads drop the
+# entries that would contain the new key. A listing that was running while
+# the bucket was written to is not stored. scan_bucket(refresh=True) and
+# clear() bypass it for changes made outside this process.
+#
+# One-level folder listings (list_folder) live beside them under the same TTL;
+# any write or delete drops every folder entry on the key's path, so parents
+# that show or count the changed folder are listed again.
+# ════════════════════════════════════════════════════════════════════════════════
+LISTING_TTL         = float(os.environ.get("SEGREGATOR_LISTING_TTL", "120"))
+LISTING_MAX_ENTRIES = 64
+LISTING_MAX_DIRS    = 4096
+
+
+class ListingCache:
+    def __init__(self, ttl: float = LISTING_TTL, max_entries: int = LISTING_MAX_ENTRIES):
+        self.ttl, self.max_entries = ttl, max_entries
+        self._entries = {}          # (bucket, prefix) → {"at", "objs": [(key, version, size, lm)], "complete"}
+        self._dirs    = {}          # (bucket, prefix) → {"at", "folders", "objs", "truncated"}, one level
+        self._gen     = {}          # bucket → write generation
+        self._lock    = threading.Lock()
+
+    def generation(self, bucket: str) -> int:
+        with self._lock: return self._gen.get(bucket, 0)
+
+    def get(self, bucket: str, prefix: str, max_keys: int = 0):
+        # → list of (key, version, size, last_modified), or None on a miss
+        if self.ttl <= 0: return None
+        now = time.monotonic()
+        with self._lock:
+            e = self._entries.get((bucket, prefix))
+            if e and now - e["at"] < self.ttl and (e["complete"] or (max_keys and len(e["objs"]) >= max_keys)):
+                self._entries[(bucket, prefix)] = self._entries.pop((bucket, prefix))   # most recent last
+                return list(e["objs"])
+            for (b, p), e in self._entries.items():
+                if b == bucket and e["complete"] and prefix.startswith(p) and now - e["at"] < self.ttl:
+                    return [o for o in e["objs"] if o[0].startswith(prefix)]
+        return None
+
+    def put(self, bucket: str, prefix: str, objs: list, complete: bool, gen: int) -> None:
+        if self.ttl <= 0: return
+        with self._lock:
+            if self._gen.get(bucket, 0) != gen: return      # written to while listing
+            self._entries.pop((bucket, prefix), None)
+            self._entries[(bucket, prefix)] = {"at": time.monotonic(), "objs": objs, "complete": complete}
+            while len(self._entries) > self.max_entries:
+                self._entries.pop(next(iter(self._entries)))
+
+    def get_dir(self, bucket: str, prefix: str):
+        if self.ttl <= 0: return None
+        with self._lock:
+            e = self._dirs.get((bucket, prefix))
+            if e is None or time.monotonic() - e["at"] >= self.ttl: return None
+            self._dirs[(bucket, prefix)] = self._dirs.pop((bucket, prefix))
+            return e
+
+    def put_dir(self, bucket: str, prefix: str, folders: list, objs: list, truncated: bool, gen: int) -> None:
+        if self.ttl <= 0: return
+        with self._lock:
+            if self._gen.get(bucket, 0) != gen: return
+            self._dirs.pop((bucket, prefix), None)
+            self._dirs[(bucket, prefix)] = {"at": time.monotonic(), "folders": folders,
+                                            "objs": objs, "truncated": truncated}
+            while len(self._dirs) > LISTING_MAX_DIRS:
+                self._dirs.pop(next(iter(self._dirs)))
+
+    def _drop_dirs(self, bucket, keys):
+        for bp in [bp for bp in self._dirs if bp[0] == bucket and any(k.startswith(bp[1]) for k in keys)]:
+            del self._dirs[bp]
+
+    def discard(self, bucket: str, keys) -> None:
+        # keys were deleted — patch them out of every entry
+        gone = set(keys)
+        if not gone: return
+        with self._lock:
+            self._gen[bucket] = self._gen.get(bucket, 0) + 1
+            for (b, _), e in self._entries.items():
+                if b == bucket: e["objs"] = [o for o in e["objs"] if o[0] not in gone]
+            self._drop_dirs(bucket, gone)
+
+    def invalidate(self, bucket: str, keys) -> None:
+        # keys were written — drop every entry whose prefix covers one of them
+        keys = list(keys)
+        if not keys: return
+        with self._lock:
+            self._gen[bucket] = self._gen.get(bucket, 0) + 1
+            for bp in [bp for bp in self._entries
+                       if bp[0] == bucket and any(k.startswith(bp[1]) for k in keys)]:
+                del self._entries[bp]
+            self._drop_dirs(bucket, keys)
+
+    def clear(self, bucket: str = None) -> None:
+        with self._lock:
+            for bp in [bp for bp in self._entries if bucket is None or bp[0] == bucket]:
+                del self._entries[bp]
+            for bp in [bp for bp in self._dirs if bucket is None or bp[0] == bucket]:
+                del self._dirs[bp]
+            for b in ([bucket] if bucket else list(self._gen)):
+                self._gen[b] = self._gen.get(b, 0) + 1
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            live = [e for e in self._entries.values() if now - e["at"] < self.ttl]
+            dirs = sum(now - e["at"] < self.ttl for e in self._dirs.values())
+            return {"entries": len(live), "keys": sum(len(e["objs"]) for e in live), "dirs": dirs, "ttl": self.ttl}
+
+
+@functools.lru_cache(maxsize=None)
+def _listing_cache() -> ListingCache:
+    return ListingCache()
+
+
+def scan_bucket(s3, bucket: str, prefix: str = "", max_keys: int = 0, meta: dict = None,
+                report=None, refresh: bool = False):
+    # meta: optional dict, filled with key → {"version", "size", "last_modified"}
+    # for every listed key. refresh=True lists the bucket even on a cache hit.
+    def _list(pfx):
+        store = storage_for(s3); cache = _listing_cache()
+        objs  = None if refresh or not store.cache_listings else cache.get(bucket, pfx, max_keys)
+        if store.cache_listings and not refresh:
+            _metrics().inc("cache_requests_total", cache="listing", result="miss" if objs is None else "hit")
+        if objs is not None: return objs
+        objs, complete, gen = [], True, cache.generation(bucket)
+        try:
+            with _stage("listing"):
+                for o in list_sharded(store, bucket, pfx):
+                    objs.append((o["Key"], object_version(o), o.get("Size", 0), o.get("LastModified")))
+                    if max_keys and len(objs) >= max_keys:
+                        complete = False
+                        break
+        except Exception as e:
+            (report or Reporter()).error(f"Scan error: {e}")
+            return objs
+        if store.cache_listings: cache.put(bucket, pfx, objs, complete, gen)
+        return objs
+
+    def _fetch(pfx):
+        objs = _list(pfx)
+        if max_keys: objs = objs[:max_keys]
+        keys, folders = [], set()
+        for k, version, size, lm in objs:
+            keys.append(k)
+            if meta is not None:
+                meta[k] = {"version": version, "size": size, "last_modified": lm}
+            rel = k[len(pfx):]
+            if "/" in rel:
+                folders.add(pfx + rel.split("/")[0] + "/")
+        return keys, folders
+
+    pfx = prefix.strip().lstrip("/")
+    all_keys, folders = _fetch(pfx)
+    if not all_keys and pfx and not pfx.endswith("/"):
+        all_keys, folders = _fetch(pfx + "/")
+
+    img_keys = [k for k in all_keys if Path(k).suffix.lower() in SUPPORTED]
+    return img_keys, all_keys, sorted(folders)
+
+
+FOLDER_MAX_KEYS = int(os.environ.get("SEGREGATOR_FOLDER_MAX_KEYS", "10000"))
+
+
+def list_folder(s3, bucket: str, prefix: str = "", max_keys: int = FOLDER_MAX_KEYS,
+                refresh: bool = False, cached_only: bool = False):
+    # One level of the bucket below prefix ("" or ending in "/"), listed with a
+    # delimiter so sub-folders cost one entry however many keys they hold:
+    #   {"prefix", "folders": [sub-prefix, …], "images": [key, …],
+    #    "versions": {key: version}, "objects": n, "truncated"}
+    # truncated=True when the level has more than max_keys entries. Served from
+    # the listing cache; cached_only=True returns None instead of listing a
+    # store whose listings are cached (uncached stores are cheap to list).
+    store = storage_for(s3); cache = _listing_cache()
+    e = None if refresh or not store.cache_listings else cache.get_dir(bucket, prefix)
+    if store.cache_listings and not refresh and not cached_only:
+        _metrics().inc("cache_requests_total", cache="folder", result="miss" if e is None else "hit")
+    if e is None:
+        if cached_only and store.cache_listings: return None
+        gen = cache.generation(bucket)
+        with _stage("listing"):
+            folders, objs, truncated = store.list_dir(bucket, prefix, max_keys)
+        objs = [(o["Key"], object_version(o), o.get("Size", 0), o.get("LastModified")) for o in objs]
+        e = {"folders": folders, "objs": objs, "truncated": truncated}
+        if store.cache_listings: cache.put_dir(bucket, prefix, folders, objs, truncated, gen)
+    imgs = [o for o in e["objs"] if Path(o[0]).suffix.lower() in SUPPORTED]
+    return {"prefix": prefix, "folders": list(e["folders"]), "images": [o[0] for o in imgs],
+            "versions": {o[0]: o[1] for o in imgs}, "objects": len(e["objs"]), "truncated": e["truncated"]}
+
+# ════════════════════════════════════════════════════════════════════════════════
+# IMAGE CLASSIFICATION
+#
+# extract_features() is the one place an image gets decoded. It builds every
+# downscaled plane the matchers use exactly once and returns a compact,
+# picklable feature record:
+#
+#   {"width", "height",        ← original size (aspect ratio)
+#    "hue", "sat", "val",      ← 60×60 HSV means
+#    "edge",                   ← 80×80 L std-dev
+#    "hash",                   ← dHash from 9×8 L
+#    "px32",                   ← 32×32 L bytes for pixel similarity
+#    "placeholder"}            ← verdict, or None when not requested
+#
+# The PIL-image helpers (_avg_hsv, _edge, …) stay for one-off callers and
+# share the same plane math.
+#
+# No plane is larger than 120×120, so images are decoded at reduced size:
+# JPEGs through draft() (DCT scaling inside the decoder), other formats with
+# an integer reduce(). DECODE_TARGET_PX is the smallest side kept — set
+# SEGREGATOR_DECODE_PX=0 to always decode at full size. decode_agreement()
+# measures hash / classification agreement against full decoding.
+# ════════════════════════════════════════════════════════════════════════════════
+DECODE_TARGET_PX = int(os.environ.get("SEGREGATOR_DECODE_PX", "240"))
+OCR_DECODE_PX    = 800      # placeholder OCR reads text, so it gets a larger decode
+
+def _planes(img) -> dict:
+    rgb  = img if img.mode == "RGB" else img.convert("RGB")
+    grey = rgb.convert("L")
+    return {
+        "hsv60":  rgb.resize((60, 60), PILImage.LANCZOS).convert("HSV"),
+        "l80":    grey.resize((80, 80), PILImage.LANCZOS),
+        "l9x8":   grey.resize((9, 8), PILImage.LANCZOS),
+        "l32":    grey.resize((32, 32), PILImage.LANCZOS),
+        "l100":   grey.resize((100, 100), PILImage.LANCZOS),
+        "rgb120": rgb.resize((120, 120)),
+    }
+
+def _hsv_stats(hsv):
+    if np is not None:
+        m = np.asarray(hsv, dtype=np.float64).reshape(-1, 3).mean(axis=0)
+        return float(m[0])*360/255, float(m[1])/255, float(m[2])/255
+    px = list(hsv.getdata())
+    n  = len(px)
+    return sum(p[0] for p in px)/n*360/255, sum(p[1] for p in px)/n/255, sum(p[2] for p in px)/n/255
+
+def _edge_score(grey):
+    if np is not None:
+        return float(np.asarray(grey, dtype=np.float64).std())
+    px = list(grey.getdata())
+    m  = sum(px)/len(px)
+    return math.sqrt(sum((p-m)**2 for p in px)/len(px))
+
+def _dhash(grey):
+    if np is not None:
+        px = np.asarray(grey).ravel()
+        return int.from_bytes(np.packbits(px[:-1] < px[1:], bitorder="little").tobytes(), "little")
+    px = list(grey.getdata())
+    diff = [px[i] < px[i+1] for i in range(len(px)-1)]
+    return sum(2**i for i, b in enumerate(diff) if b)
+
+def _avg_hsv(img):
+    return _hsv_stats(img.convert("RGB").resize((60,60),PILImage.LANCZOS).convert("HSV"))
+
+def _edge(img):
+    return _edge_score(img.convert("L").resize((80,80),PILImage.LANCZOS))
+
+def _perceptual_hash(img, hash_size=8):
+    return _dhash(img.convert("L").resize((hash_size + 1, hash_size), PILImage.LANCZOS))
+
+def _hamming_distance(h1, h2):
+    return bin(h1 ^ h2).count('1')
+
+PLACEHOLDER_TEXTS = [
+    'NO IMAGE', 'COMING SOON', 'NO MASTER PLAN', 'NO FLOOR PLAN',
+    'NOT AVAILABLE', 'IMAGE NOT FOUND', 'NO PHOTO', 'PHOTO NOT AVAILABLE',
+    'IMAGE COMING SOON', 'NO PICTURE', 'PLACEHOLDER', 'N/A',
+    'NO IMAGE FOUND', 'IMAGE UNAVAILABLE', 'NO MASTERPLAN', 'NO FLOORPLAN',
+    'COMING SOON!', 'STAY TUNED', 'UPLOADING SOON', 'WILL BE UPDATED',
+    'NOT YET AVAILABLE', 'IMAGE PENDING', 'NO IMAGE AVAILABLE',
+]
+
+def _placeholder_visual(rgb120, l80, l100) -> bool:
+    if np is not None:
+        return bool(_placeholder_visual_np(np.asarray(rgb120)[None], np.asarray(l80)[None],
+                                           np.asarray(l100)[None])[0])
+    px  = list(rgb120.getdata())
+    n   = len(px)
+
+    avg_r = sum(p[0] for p in px) / n
+    avg_g = sum(p[1] for p in px) / n
+    avg_b = sum(p[2] for p in px) / n
+    is_light_bg = avg_r > 190 and avg_g > 190 and avg_b > 190
+    is_grey_bg  = (abs(avg_r - avg_g) < 25 and abs(avg_g - avg_b) < 25 and avg_r > 150)
+    is_plain_bg = is_light_bg or is_grey_bg
+
+    colour_counts: dict = {}
+    for p in px:
+        b = (p[0] // 20 * 20, p[1] // 20 * 20, p[2] // 20 * 20)
+        colour_counts[b] = colour_counts.get(b, 0) + 1
+    top_count      = max(colour_counts.values())
+    dominant_ratio = top_count / n
+    S1 = dominant_ratio > 0.50
+
+    edge_score = _edge_score(l80)
+
+    S2 = edge_score < 14
+    S3 = is_plain_bg and (10 <= edge_score <= 40)
+
+    bw_px       = list(l100.getdata())
+    light_px    = sum(1 for v in bw_px if v > 220)
+    dark_px     = sum(1 for v in bw_px if v < 60)
+    total_bw    = len(bw_px)
+    light_ratio = light_px / total_bw
+    dark_ratio  = dark_px  / total_bw
+    S4 = is_plain_bg and light_ratio > 0.55 and 0.01 <= dark_ratio <= 0.35
+
+    return sum([S1, S2, S3, S4]) >= 2
+
+def _placeholder_visual_np(rgb120, l80, l100):
+    # same four signals as _placeholder_visual, for a stack: rgb120 (N,120,120,3),
+    # l80 (N,80,80), l100 (N,100,100) → bool array (N,)
+    n_img = rgb120.shape[0]
+    px    = rgb120.reshape(n_img, -1, 3).astype(np.int32)
+    avg   = px.mean(axis=1)
+    avg_r, avg_g, avg_b = avg[:, 0], avg[:, 1], avg[:, 2]
+    is_light_bg = (avg_r > 190) & (avg_g > 190) & (avg_b > 190)
+    is_grey_bg  = (np.abs(avg_r - avg_g) < 25) & (np.abs(avg_g - avg_b) < 25) & (avg_r > 150)
+    is_plain_bg = is_light_bg | is_grey_bg
+
+    # 20-wide colour buckets → one code per pixel; 255//20 = 12 → 13 levels
+    codes = (px[..., 0] // 20) * 169 + (px[..., 1] // 20) * 13 + (px[..., 2] // 20)
+    codes = codes + (np.arange(n_img) * 2197)[:, None]
+    top   = np.bincount(codes.ravel(), minlength=n_img * 2197).reshape(n_img, 2197).max(axis=1)
+    S1 = top / px.shape[1] > 0.50
+
+    edge_score = l80.reshape(n_img, -1).astype(np.float64).std(axis=1)
+    S2 = edge_score < 14
+    S3 = is_plain_bg & (edge_score >= 10) & (edge_score <= 40)
+
+    bw          = l100.reshape(n_img, -1)
+    light_ratio = (bw > 220).mean(axis=1)
+    dark_ratio  = (bw < 60).mean(axis=1)
+    S4 = is_plain_bg & (light_ratio > 0.55) & (dark_ratio >= 0.01) & (dark_ratio <= 0.35)
+
+    return (S1.astype(int) + S2 + S3 + S4) >= 2
+
+def _placeholder_ocr(img) -> bool:
+    with _stage("ocr"):
+        try:
+            import pytesseract
+            text = pytesseract.image_to_string(img).upper()
+            return any(ph in text for ph in PLACEHOLDER_TEXTS)
+        except Exception:
+            return False
+
+def _detect_placeholder_text(img) -> bool:
+    p = _planes(img)
+    return _placeholder_visual(p["rgb120"], p["l80"], p["l100"]) or _placeholder_ocr(img)
+
+
+def _plane_similarity(a: bytes, b: bytes) -> float:
+    n = len(a)
+    if np is not None:
+        d = np.abs(np.frombuffer(a, np.uint8).astype(np.int16) - np.frombuffer(b, np.uint8))
+        return 1.0 - float(d.sum()) / (255 * n)
+    return 1.0 - (sum(abs(a[i] - b[i]) for i in range(n)) / (255 * n))
+
+def _pixel_similarity(img_a: PILImage.Image, img_b: PILImage.Image, size: int = 32) -> float:
+    a = img_a.convert("L").resize((size, size), PILImage.LANCZOS).tobytes()
+    b = img_b.convert("L").resize((size, size), PILImage.LANCZOS).tobytes()
+    return _plane_similarity(a, b)
+
+
+def _open_image(src):
+    # src = path, raw bytes, or an already-open PIL image
+    if isinstance(src, PILImage.Image): return src
+    if isinstance(src, (bytes, bytearray)): return PILImage.open(io.BytesIO(src))
+    return PILImage.open(src)
+
+_REDUCE_MODES = {"L", "LA", "La", "RGB", "RGBA", "RGBa", "CMYK", "YCbCr", "I", "F"}   # palette, 1-bit, I;16 convert first
+
+def _decode(src, target: int = DECODE_TARGET_PX):
+    # → (RGB image with both sides ≥ target where possible, original (w, h))
+    img  = _open_image(src)
+    size = img.size
+    if target > 0 and min(size) >= 2 * target:
+        if img.format == "JPEG":
+            img.draft("RGB", (target, target))
+        else:       # reduce in the stored mode, so only the reduced image is converted
+            if img.mode not in _REDUCE_MODES: img = img.convert("RGB")
+            img = img.reduce(min(size) // target)
+    return img.convert("RGB"), size
+
+def _decode_target(placeholder: bool, target=None) -> int:
+    target = DECODE_TARGET_PX if target is None else target
+    return max(target, OCR_DECODE_PX) if placeholder and target else target
+
+def extract_features(src, placeholder: bool = False, target: int = None) -> dict:
+    with _stage("decode"):
+        img, (w, h) = _decode(src, _decode_target(placeholder, target))
+    with _stage("features"):
+        p   = _planes(img)
+        hue, sat, val = _hsv_stats(p["hsv60"])
+        visual = placeholder and _placeholder_visual(p["rgb120"], p["l80"], p["l100"])
+        feat = {
+            "width":       w,
+            "height":      h,
+            "hue":         hue,
+            "sat":         sat,
+            "val":         val,
+            "edge":        _edge_score(p["l80"]),
+            "hash":        _dhash(p["l9x8"]),
+            "px32":        p["l32"].tobytes(),
+            "placeholder": None,
+        }
+    if placeholder:
+        feat["placeholder"] = visual or _placeholder_ocr(img)
+    return feat
+
+def extract_features_batch(srcs, placeholder: bool = False, target: int = None) -> list:
+    # Same records as extract_features, but the plane math runs once over the
+    # whole stack. Items that fail to decode come back as the exception.
+    srcs = list(srcs)
+    if np is None:
+        out = []
+        for src in srcs:
+            try: out.append(extract_features(src, placeholder, target))
+            except Exception as e: out.append(e)
+        return out
+
+    target = _decode_target(placeholder, target)
+    out, imgs, sizes, planes, ok = [None] * len(srcs), [], [], [], []
+    for i, src in enumerate(srcs):
+        try:
+            with _stage("decode"): img, size = _decode(src, target)
+            with _stage("features"): planes.append(_planes(img))
+        except Exception as e:
+            out[i] = e; continue
+        imgs.append(img); sizes.append(size); ok.append(i)
+    if not ok: return out
+
+    stack = lambda name: np.stack([np.asarray(p[name]) for p in planes])
+    n     = len(ok)
+    with _stage("features"):
+        hsv   = stack("hsv60").reshape(n, -1, 3).astype(np.float64).mean(axis=1)
+        l80   = stack("l80")
+        edge  = l80.reshape(n, -1).astype(np.float64).std(axis=1)
+        l98   = stack("l9x8").reshape(n, -1)
+        bits  = np.packbits(l98[:, :-1] < l98[:, 1:], axis=1, bitorder="little")
+        visual = (_placeholder_visual_np(stack("rgb120"), l80, stack("l100"))
+                  if placeholder else None)
+
+    for j, i in enumerate(ok):
+        verdict = None
+        if placeholder:
+            verdict = bool(visual[j]) or _placeholder_ocr(imgs[j])
+        out[i] = {
+            "width":       sizes[j][0],
+            "height":      sizes[j][1],
+            "hue":         float(hsv[j, 0])*360/255,
+            "sat":         float(hsv[j, 1])/255,
+            "val":         float(hsv[j, 2])/255,
+            "edge":        float(edge[j]),
+            "hash":        int.from_bytes(bits[j].tobytes(), "little"),
+            "px32":        planes[j]["l32"].tobytes(),
+            "placeholder": verdict,
+        }
+    return out
+
+
+def classify_features(feat: dict) -> dict:
+    w,h=feat["width"],feat["height"]; ratio=w/h if h else 1
+    hue,sat,val,edge=feat["hue"],feat["sat"],feat["val"],feat["edge"]
+    H=lambda lo,hi: lo<=hue<hi
+    is_green=H(70,160); is_blue=H(190,260); is_red=H(0,20) or H(340,360)
+    is_brown=H(20,40) and sat<0.5; is_grey=sat<0.12
+    bright=val>0.55; dark=val<0.35; colorful=sat>0.40
+    portrait=ratio<0.80; landscape=ratio>1.35; square=0.80<=ratio<=1.35
+    complex_=edge>38; simple=edge<20
+    cat,sub,tags="Abstract","Pattern",["pattern","texture"]
+    if   is_green and bright and landscape:                   cat,sub,tags="Nature","Forest",["green","trees","outdoor"]
+    elif is_blue  and bright and landscape and val>0.6:       cat,sub,tags="Nature","Sky",["blue","sky","outdoor"]
+    elif is_blue  and landscape and sat>0.3:                  cat,sub,tags="Nature","Beach",["water","blue","outdoor"]
+    elif is_green and landscape:                              cat,sub,tags="Nature","Landscape",["green","nature","outdoor"]
+    elif portrait and complex_ and not dark:                  cat,sub,tags="People","Portrait",["person","portrait","face"]
+    elif square   and complex_ and sat<0.3 and bright:        cat,sub,tags="People","Portrait",["person","monochrome"]
+    elif (is_red or is_brown) and complex_ and square:        cat,sub,tags="Food","Meal",["food","plate","colorful"]
+    elif colorful and complex_ and square and not is_blue:    cat,sub,tags="Food","Dish",["food","colorful"]
+    elif is_brown and complex_ and landscape:                 cat,sub,tags="Animals","Wildlife",["animal","brown"]
+    elif is_green and complex_ and square:                    cat,sub,tags="Animals","Wildlife",["animal","nature"]
+    elif is_grey  and complex_ and portrait:                  cat,sub,tags="Architecture","Building",["building","urban"]
+    elif is_grey  and complex_ and landscape:                 cat,sub,tags="Architecture","Cityscape",["city","urban"]
+    elif bright   and complex_ and portrait:                  cat,sub,tags="Architecture","Structure",["building","outdoor"]
+    elif is_grey  and landscape and simple:                   cat,sub,tags="Vehicles","Car",["vehicle","grey"]
+    elif dark     and landscape and complex_:                 cat,sub,tags="Vehicles","Transport",["vehicle","dark"]
+    elif dark     and complex_  and is_blue:                  cat,sub,tags="Technology","Electronics",["tech","screen"]
+    elif is_grey  and simple    and landscape:                cat,sub,tags="Technology","Device",["device","minimal"]
+    elif colorful and complex_  and not bright:               cat,sub,tags="Art","Painting",["art","colorful"]
+    elif colorful and simple:                                 cat,sub,tags="Art","Abstract",["art","abstract"]
+    elif is_green and landscape and complex_:                 cat,sub,tags="Sports","Outdoor",["sports","field"]
+    elif simple:                                              cat,sub,tags="Abstract","Minimal",["minimal","pattern"]
+    return {"category":cat,"subcategory":sub,"tags":tags,
+            "description":f"{'Bright' if bright else 'Dark'}, {'colorful' if colorful else 'muted'} {sub.lower()}."}
+
+def classify_image(src) -> dict:
+    try: feat = extract_features(src)
+    except Exception as e: feat = e
+    return _classified(feat)
+
+def _classified(feat) -> dict:
+    # feature record → classification; an extraction error → "Unclassified"
+    if isinstance(feat, Exception):
+        return {"category":"Unclassified","subcategory":"Unknown","tags":[],"description":str(feat)}
+    return classify_features(feat)
+
+def decode_agreement(srcs, target: int = DECODE_TARGET_PX) -> dict:
+    # reduced vs full decode over srcs (paths / bytes) → agreement rates
+    n = same_hash = near_hash = same_cat = same_sub = worst = 0
+    for src in srcs:
+        try:
+            full = extract_features(src, target=0)
+            red  = extract_features(src, target=target)
+        except Exception: continue
+        d = _hamming_distance(full["hash"], red["hash"]); worst = max(worst, d)
+        cf, cr = classify_features(full), classify_features(red)
+        n += 1; same_hash += d == 0; near_hash += d <= _HASH_THRESHOLD_REAL
+        same_cat += cf["category"] == cr["category"]; same_sub += cf["subcategory"] == cr["subcategory"]
+    rate = lambda k: round(k / n, 4) if n else None
+    return {"images": n, "target_px": target, "hash_exact": rate(same_hash),
+            "hash_within_threshold": rate(near_hash), "max_hash_dist": worst,
+            "category": rate(same_cat), "subcategory": rate(same_sub)}
+
+# ════════════════════════════════════════════════════════════════════════════════
+# FEATURE POOL — decoding and feature math on worker processes, so extraction
+# uses every core instead of sharing one GIL. Workers are spawned once, load
+# Pillow's plugins once (_pool_init) and stay warm for the life of the app.
+# Work goes out in chunks of up to FEATURE_POOL_CHUNK images — one
+# extract_features_batch call per chunk — and comes back as feature records
+# (a few numbers plus the 1 KB 32×32 plane), never as PIL images.
+#
+# A job under FEATURE_POOL_MIN_ITEMS images runs in-thread unless the pool is
+# already warm: starting processes would cost more than it saves. processes=0
+# (or SEGREGATOR_PROCESSES=0) turns the pool off. A pool that dies or is
+# replaced mid-job makes its callers fall back to in-thread extraction.
+# ════════════════════════════════════════════════════════════════════════════════
+FEATURE_PROCESSES      = int(os.environ.get("SEGREGATOR_PROCESSES", str(max(1, (os.cpu_count() or 2) - 1))))
+FEATURE_POOL_CHUNK     = 8
+FEATURE_POOL_MIN_ITEMS = 64
+FEATURE_POOL_LINGER    = 0.02       # seconds a partial chunk waits for more images
+
+
+def _pool_init():
+    PILImage.init()
+
+def _extract_chunk(srcs, placeholder):
+    # runs in a worker process: bytes / paths in, (records (or the exception), stage seconds) out
+    with profiled(0) as prof: out = extract_features_batch(srcs, placeholder)
+    return out, prof.totals()
+
+def _settle(part, fut):
+    # the chunk's stage times are shared evenly among its images' profiles
+    try: res, spent = fut.result()
+    except Exception as e: res, spent = [e] * len(part), {}
+    if _metrics().enabled:
+        for stage, (sec, calls) in spent.items(): _record_stage(stage, sec / max(1, calls), calls=calls)
+    for (_, _, f, prof, key), r in zip(part, res):
+        if prof is not None:
+            for stage, (sec, _) in spent.items(): prof.add(stage, sec / len(part), key=key)
+        if isinstance(r, Exception): f.set_exception(r)
+        else: f.set_result(r)
+
+
+class FeaturePool:
+    def __init__(self, processes: int, chunk: int = FEATURE_POOL_CHUNK):
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        self.processes, self.chunk, self._closed = processes, chunk, False
+        self.slots = processes * chunk * 2      # two chunks per process in flight keeps every core fed
+        self._ex = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=_pool_init)
+        self._q = queue.Queue()
+        threading.Thread(target=self._dispatch, daemon=True).start()
+
+    def submit(self, src, placeholder: bool = False) -> Future:
+        # src = bytes or a path; the future's result is the feature record
+        fut = Future(); self._q.put((src, bool(placeholder), fut, _profile.get(), _item.get()))
+        return fut
+
+    def extract(self, src, placeholder: bool = False) -> dict:
+        return self.submit(src, placeholder).result()
+
+    @property
+    def alive(self) -> bool:
+        return not self._closed and not getattr(self._ex, "_broken", False)
+
+    def close(self) -> None:
+        # queued work still finishes; anything submitted later fails over to in-thread
+        self._closed = True
+        self._ex.shutdown(wait=False)
+
+    def _dispatch(self):
+        while True:
+            batch = [self._q.get()]
+            _metrics().set("queue_depth", self._q.qsize(), queue="feature_pool")
+            deadline = time.monotonic() + FEATURE_POOL_LINGER
+            while len(batch) < self.chunk:
+                try: batch.append(self._q.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty: break
+            for ph in {b[1] for b in batch}:
+                part = [b for b in batch if b[1] == ph]
+                try: fut = self._ex.submit(_extract_chunk, [b[0] for b in part], ph)
+                except Exception as e:
+                    for b in part: b[2].set_exception(e)
+                    continue
+                fut.add_done_callback(functools.partial(_settle, part))
+
+
+_pool, _pool_lock = None, threading.Lock()
+
+def feature_pool(n_items: int = 0, processes: int = None):
+    # → the shared pool, started if a job of n_items is worth it; None = extract in-thread
+    global _pool
+    processes = FEATURE_PROCESSES if processes is None else int(processes)
+    with _pool_lock:
+        if _pool is not None and (_pool.processes != processes or not _pool.alive):
+            _pool.close(); _pool = None
+        if _pool is None and processes > 0 and n_items >= FEATURE_POOL_MIN_ITEMS:
+            _pool = FeaturePool(processes)
+        return _pool
+
+def extract_on_pool(src, placeholder: bool = False) -> dict:
+    # extract_features on the warm pool if one is running, else in this thread
+    pool = _pool
+    if pool is not None:
+        if not isinstance(src, (bytes, str)):
+            src.seek(0); data = src.read(); src.seek(0)
+        else: data = src
+        try: return pool.extract(data, placeholder)
+        except RuntimeError: pass       # pool shut down or broken (BrokenProcessPool)
+    return extract_features(src, placeholder)
+
+def extract_many(srcs, placeholder: bool = False, processes: int = None):
+    # → a feature record or the exception for each src, in order
+    srcs = list(srcs)
+    pool = feature_pool(len(srcs), processes)
+    if pool is None:
+        for src in srcs:
+            try: yield extract_features(src, placeholder)
+            except Exception as e: yield e
+        return
+    futs = [pool.submit(src, placeholder) for src in srcs]
+    for src, fut in zip(srcs, futs):
+        e = fut.exception()
+        if isinstance(e, RuntimeError):
+            try: yield extract_features(src, placeholder)
+            except Exception as e2: yield e2
+        else: yield e or fut.result()
+
+# ════════════════════════════════════════════════════════════════════════════════
+# FEATURE CACHE — SQLite store of feature records, keyed by
+# (bucket, key, object_version). An unchanged object never needs to be
+# downloaded or analysed twice, across engines, grouping modes and restarts.
+#
+# Rows hold the feature record (hash, HSV/edge stats, 32×32 plane), the
+# classification and the placeholder verdict (NULL = never computed).
+# Least-recently-used rows are evicted once the stored bytes pass max_bytes.
+# Moves and deletes call invalidate() for the keys they touch.
+# ════════════════════════════════════════════════════════════════════════════════
+FEATURE_CACHE_FILE      = "segregator_feature_cache.sqlite"
+FEATURE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+
+class FeatureCache:
+    _EVICT_EVERY = 500          # puts between size checks
+
+    def __init__(self, path: str = FEATURE_CACHE_FILE, max_bytes: int = FEATURE_CACHE_MAX_BYTES):
+        self.path, self.max_bytes = path, max_bytes
+        self._lock = threading.Lock()
+        self._puts = 0
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS features (
+            bucket TEXT, key TEXT, version TEXT,
+            width INTEGER, height INTEGER, hue REAL, sat REAL, val REAL, edge REAL,
+            hash TEXT, px32 BLOB, placeholder INTEGER, info TEXT,
+            nbytes INTEGER, accessed REAL,
+            PRIMARY KEY (bucket, key))""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS features_accessed ON features(accessed)")
+        self._db.commit()
+
+    def get(self, bucket: str, key: str, version: str, placeholder: bool = False):
+        # → feature record (+ "info") or None. placeholder=True also treats a
+        # row whose placeholder verdict was never computed as a miss.
+        with self._lock:
+            row = self._db.execute(
+                "SELECT width,height,hue,sat,val,edge,hash,px32,placeholder,info FROM features "
+                "WHERE bucket=? AND key=? AND version=?", (bucket, key, version)).fetchone()
+            if row is None:
+                _metrics().inc("cache_requests_total", cache="feature", result="miss"); return None
+            self._db.execute("UPDATE features SET accessed=? WHERE bucket=? AND key=?",
+                             (datetime.datetime.now().timestamp(), bucket, key))
+            self._db.commit()
+        hit = not (placeholder and row[8] is None)
+        _metrics().inc("cache_requests_total", cache="feature", result="hit" if hit else "miss")
+        if not hit: return None
+        return {
+            "width": row[0], "height": row[1], "hue": row[2], "sat": row[3], "val": row[4],
+            "edge": row[5], "hash": int(row[6], 16), "px32": bytes(row[7]),
+            "placeholder": None if row[8] is None else bool(row[8]),
+            "info": json.loads(row[9]) if row[9] else None,
+        }
+
+    def put(self, bucket: str, key: str, version: str, feat: dict) -> None:
+        info_js = json.dumps(classify_features(feat))
+        nbytes  = len(feat["px32"]) + len(info_js) + len(key) + 96
+        with self._lock:
+            ph = feat.get("placeholder")
+            if ph is None:      # keep a verdict computed earlier for this same version
+                prev = self._db.execute(
+                    "SELECT placeholder FROM features WHERE bucket=? AND key=? AND version=?",
+                    (bucket, key, version)).fetchone()
+                ph = prev[0] if prev else None
+            self._db.execute(
+                "INSERT OR REPLACE INTO features VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                (bucket, key, version, feat["width"], feat["height"], feat["hue"], feat["sat"],
+                 feat["val"], feat["edge"], format(feat["hash"], "x"), feat["px32"],
+                 None if ph is None else int(bool(ph)), info_js, nbytes,
+                 datetime.datetime.now().timestamp()))
+            self._db.commit()
+            self._puts += 1
+            if self._puts % self._EVICT_EVERY == 0: self._evict()
+
+    def invalidate(self, bucket: str, keys) -> None:
+        keys = list(keys)
+        if not keys: return
+        with self._lock:
+            self._db.executemany("DELETE FROM features WHERE bucket=? AND key=?",
+                                 [(bucket, k) for k in keys])
+            self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            n, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(nbytes),0) FROM features").fetchone()
+        return {"entries": n, "bytes": size, "max_bytes": self.max_bytes}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM features"); self._db.commit()
+            self._db.execute("VACUUM")
+
+    def _evict(self) -> None:
+        # caller holds the lock — drop oldest rows until back under 90 % of max
+        total = self._db.execute("SELECT COALESCE(SUM(nbytes),0) FROM features").fetchone()[0]
+        if total <= self.max_bytes: return
+        target, freed = total - int(self.max_bytes * 0.9), 0
+        doomed = []
+        for bkt, k, nb in self._db.execute(
+                "SELECT bucket, key, nbytes FROM features ORDER BY accessed"):
+            doomed.append((bkt, k)); freed += nb
+            if freed >= target: break
+        self._db.executemany("DELETE FROM features WHERE bucket=? AND key=?", doomed)
+        self._db.commit()
+
+
+@functools.lru_cache(maxsize=None)
+def _feature_cache() -> FeatureCache:
+    return FeatureCache()
+
+# ════════════════════════════════════════════════════════════════════════════════
+# HASH INDEX — persistent near-neighbour index over _perceptual_hash values
+# (multi-index hashing). The 72-bit hash space is split into 4 × 18-bit
+# chunks, each an indexed column. If two hashes are within Hamming radius r,
+# at least one chunk differs in ≤ r // 4 bits (pigeonhole), so a radius query
+# only probes the few chunk values near the query's own chunks and verifies
+# the candidates exactly — no pass over every stored hash.
+# ════════════════════════════════════════════════════════════════════════════════
+HASH_INDEX_FILE = "segregator_hash_index.sqlite"
+
+
+@functools.lru_cache(maxsize=None)
+def _flip_masks(bits: int, r: int) -> tuple:
+    # every `bits`-wide XOR mask with popcount ≤ r
+    masks = [0]
+    for w in range(1, r + 1):
+        masks += [sum(1 << b for b in combo) for combo in itertools.combinations(range(bits), w)]
+    return tuple(masks)
+
+
+class HashIndex:
+    CHUNKS, CHUNK_BITS = 4, 18
+    _MASK = (1 << CHUNK_BITS) - 1
+
+    def __init__(self, path: str = HASH_INDEX_FILE):
+        self._lock  = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS hashes (
+            bucket TEXT, key TEXT, hash TEXT, c0 INTEGER, c1 INTEGER, c2 INTEGER, c3 INTEGER,
+            PRIMARY KEY (bucket, key))""")
+        for c in range(self.CHUNKS):
+            self._db.execute(f"CREATE INDEX IF NOT EXISTS hashes_c{c} ON hashes(bucket, c{c})")
+        self._db.commit()
+
+    def _chunks(self, h: int) -> list:
+        return [(h >> (c * self.CHUNK_BITS)) & self._MASK for c in range(self.CHUNKS)]
+
+    def insert_many(self, bucket: str, items, replace: bool = True) -> None:
+        # items = [(key, hash), …]; replace=False keeps an existing row untouched
+        rows = [(bucket, k, format(h, "x"), *self._chunks(h)) for k, h in items]
+        if not rows: return
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        with self._lock:
+            self._db.executemany(f"{verb} INTO hashes VALUES (?,?,?,?,?,?,?)", rows)
+            self._db.commit()
+
+    def insert(self, bucket: str, key: str, h: int, replace: bool = True) -> None:
+        self.insert_many(bucket, [(key, h)], replace)
+
+    def delete(self, bucket: str, keys) -> None:
+        keys = list(keys)
+        if not keys: return
+        with self._lock:
+            self._db.executemany("DELETE FROM hashes WHERE bucket=? AND key=?", [(bucket, k) for k in keys])
+            self._db.commit()
+
+    def copy(self, bucket: str, src_key: str, dest_key: str) -> None:
+        # dest is a byte-for-byte copy of src → same hash
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO hashes SELECT bucket, ?, hash, c0, c1, c2, c3 FROM hashes "
+                "WHERE bucket=? AND key=?", (dest_key, bucket, src_key))
+            self._db.commit()
+
+    def query(self, bucket: str, h: int, radius: int, prefix: str = "", limit: int = 0) -> list:
+        # → [(key, hamming distance), …] nearest first, every key within radius
+        per_chunk = radius // self.CHUNKS
+        masks     = _flip_masks(self.CHUNK_BITS, per_chunk)
+        found     = {}
+        with self._lock:
+            for c, val in enumerate(self._chunks(h)):
+                probes = [val ^ m for m in masks]
+                for s in range(0, len(probes), 500):
+                    part = probes[s:s + 500]
+                    sql  = (f"SELECT key, hash FROM hashes WHERE bucket=? AND c{c} IN "
+                            f"({','.join('?' * len(part))})")
+                    args = [bucket, *part]
+                    if prefix:
+                        sql += " AND substr(key, 1, ?) = ?"; args += [len(prefix), prefix]
+                    for k, hx in self._db.execute(sql, args):
+                        if k not in found:
+                            found[k] = _hamming_distance(h, int(hx, 16))
+        hits = sorted(((k, d) for k, d in found.items() if d <= radius), key=lambda kd: (kd[1], kd[0]))
+        return hits[:limit] if limit else hits
+
+    def count(self, bucket: str = None) -> int:
+        with self._lock:
+            if bucket is None: return self._db.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+            return self._db.execute("SELECT COUNT(*) FROM hashes WHERE bucket=?", (bucket,)).fetchone()[0]
+
+
+@functools.lru_cache(maxsize=None)
+def _hash_index() -> HashIndex:
+    return HashIndex()
+
+# ════════════════════════════════════════════════════════════════════════════════
+# IN-MEMORY DOWNLOADS — get_object streams straight into an ObjectBuffer that
+# the decoder reads directly; nothing is written to disk unless one object is
+# larger than SPOOL_MAX_BYTES. The bytes held by all live buffers are capped
+# by a process-wide ByteBudget, so download workers wait instead of piling up
+# memory when extraction falls behind. Closing a buffer returns its bytes.
+# ════════════════════════════════════════════════════════════════════════════════
+INFLIGHT_MAX_BYTES = 256 * 1024 * 1024   # all object bytes held between download and write
+SPOOL_MAX_BYTES    = 32 * 1024 * 1024    # a single object past this spills to a temp file
+
+
+class ByteBudget:
+    def __init__(self, cap: int = INFLIGHT_MAX_BYTES):
+        self.cap, self.used = cap, 0
+        self._cv = threading.Condition()
+
+    def acquire(self, n: int) -> int:
+        # blocks until n bytes fit; an object bigger than the cap waits for an empty budget
+        n = min(max(0, int(n)), self.cap)
+        with self._cv:
+            while self.used and self.used + n > self.cap: self._cv.wait()
+            self.used += n
+        return n
+
+    def release(self, n: int) -> None:
+        with self._cv:
+            self.used -= n
+            self._cv.notify_all()
+
+
+@functools.lru_cache(maxsize=None)
+def _inflight_budget() -> ByteBudget:
+    return ByteBudget()
+
+
+class ObjectBuffer(tempfile.SpooledTemporaryFile):
+    # one downloaded object; close() gives its bytes back to the budget
+    def __init__(self, budget: ByteBudget, held: int):
+        super().__init__(max_size=SPOOL_MAX_BYTES)
+        self._budget, self._held = budget, held
+
+    def close(self):
+        if self._held: self._budget.release(self._held); self._held = 0
+        super().close()
+
+    def __exit__(self, *exc):     # SpooledTemporaryFile.__exit__ skips close()
+        self.close()
+
+
+def get_object_buffer(s3, bucket, key) -> ObjectBuffer:
+    with _stage("download") as st:
+        body, size = storage_for(s3).get(bucket, key)
+        budget = _inflight_budget()
+        try:
+            buf = ObjectBuffer(budget, budget.acquire(size))
+            try:
+                shutil.copyfileobj(body, buf, 1024 * 1024); st["bytes"] = buf.tell(); buf.seek(0)
+            except BaseException:
+                buf.close(); raise
+        finally:
+            close = getattr(body, "close", None)
+            if close: close()
+    return buf
+
+def release_payload(item, payload) -> None:
+    # run_pipeline hook: a payload that leaves the pipeline frees its buffer
+    close = getattr(payload, "close", None)
+    if close: close()
+
+def fetch_or_cached(s3, bucket, key, version, placeholder=False):
+    # download stage: the cached feature record when there is one, else an ObjectBuffer
+    hit = _feature_cache().get(bucket, key, version, placeholder)
+    if hit is not None: return hit
+    return get_object_buffer(s3, bucket, key)
+
+def features_for(bucket, key, version, payload, placeholder=False) -> dict:
+    # extract stage: payload from fetch_or_cached → feature record (stored on a miss)
+    if isinstance(payload, dict):
+        _hash_index().insert(bucket, key, payload["hash"], replace=False)
+        return payload
+    feat = extract_on_pool(payload, placeholder)
+    _feature_cache().put(bucket, key, version, feat)
+    _hash_index().insert(bucket, key, feat["hash"])
+    return feat
+
+# ════════════════════════════════════════════════════════════════════════════════
+# HELPERS
+# ════════════════════════════════════════════════════════════════════════════════
+def sanitize(n): return re.sub(r'[\\/:*?"<>|\x00-\x1f]','_',n).strip() or "Unknown"
+
+def get_group(info,mode):
+    if mode=="category":    return sanitize(info.get("category","Unclassified"))
+    if mode=="subcategory": return sanitize(info.get("category","Unk"))+"/"+sanitize(info.get("subcategory","Unk"))
+    tags=info.get("tags",[]); return sanitize(tags[0]) if tags else "Untagged"
+
+def r2_key_from_input(url_or_key,bucket):
+    if not url_or_key.startswith("http"): return url_or_key.strip().lstrip("/")
+    path=urllib.parse.urlparse(url_or_key).path.lstrip("/")
+    if bucket and path.startswith(bucket+"/"): path=path[len(bucket)+1:]
+    return path
+
+_dest_lock = threading.Lock()
+
+def list_taken(s3,bucket,prefix):
+    # one listing of the destination prefix at job start → set of existing keys.
+    # Errors propagate: a job must not guess at collisions.
+    with _stage("listing"): return {o["Key"] for o in list_sharded(s3,bucket,prefix.lstrip("/"))}
+
+def safe_dest_key(folder,filename,idx,taken):
+    # taken = list_taken() of the destination, plus every key this job has
+    # claimed so far. The first free name is claimed under the lock, so two
+    # concurrent writers of the same filename can never get the same key.
+    dk=f"{folder}/{filename}"; stem,ext=Path(filename).stem,Path(filename).suffix
+    with _dest_lock:
+        if dk in taken: dk=f"{folder}/{stem}_{idx}{ext}"
+        n=1
+        while dk in taken: dk=f"{folder}/{stem}_{idx}_{n}{ext}"; n+=1
+        taken.add(dk)
+    return dk
+
+def _content_type(name):
+    return {".jpg":"image/jpeg",".jpeg":"image/jpeg",".png":"image/png",".gif":"image/gif",
+            ".webp":"image/webp",".bmp":"image/bmp",".tiff":"image/tiff",".tif":"image/tiff"
+            }.get(Path(name).suffix.lower(),"application/octet-stream")
+
+def upload_r2(s3,bucket,local,dest_key):
+    # local = file path or an open binary file object (e.g. an ObjectBuffer)
+    size=os.path.getsize(local) if isinstance(local,str) else local.seek(0,os.SEEK_END)
+    with _stage("upload",size): storage_for(s3).put(bucket,dest_key,local,_content_type(local if isinstance(local,str) else dest_key))
+    _listing_cache().invalidate(bucket,[dest_key])
+
+def copy_r2(s3,bucket,src_key,dest_key,local=None):
+    # server-side copy — bytes never leave the store. Only a store without
+    # server-side copy (NotImplementedError) gets an upload from `local` (path
+    # or buffer), or a fresh get; any other copy error is raised.
+    try:
+        with _stage("copy"): storage_for(s3).copy(bucket,src_key,dest_key)
+    except NotImplementedError:
+        if local: upload_r2(s3,bucket,local,dest_key)
+        else:
+            with get_object_buffer(s3,bucket,src_key) as buf: upload_r2(s3,bucket,buf,dest_key)
+    _listing_cache().invalidate(bucket,[dest_key])
+    _hash_index().copy(bucket,src_key,dest_key)
+
+def delete_r2(s3,bucket,key):
+    with _stage("delete"): errs=storage_for(s3).delete(bucket,[key])
+    if errs: raise RuntimeError(f"delete `{key}` failed: {errs[key]}")
+    _feature_cache().invalidate(bucket,[key]); _hash_index().delete(bucket,[key])
+    _listing_cache().discard(bucket,[key]); _presign_cache().discard(bucket,[key])
+
+DELETE_BATCH_SIZE = 1000     # DeleteObjects accepts at most 1000 keys
+
+def delete_r2_many(s3,bucket,keys,workers=None,progress=None):
+    # Storage.delete (S3: DeleteObjects) in DELETE_BATCH_SIZE batches, sent in parallel.
+    # progress(done,total) is called on the calling thread after each batch.
+    # Returns (deleted_keys, {key: error}) — a request that fails outright
+    # marks every key of its batch.
+    keys=list(dict.fromkeys(keys)); deleted,errors=[],{}
+    if not keys: return deleted,errors
+    batches=[keys[i:i+DELETE_BATCH_SIZE] for i in range(0,len(keys),DELETE_BATCH_SIZE)]
+    store=storage_for(s3)
+    def _one(batch):
+        with _stage("delete"): return store.delete(bucket,batch)
+    n=max(1,min(len(batches),int(workers or PIPELINE_WORKERS["write"])))
+    with ThreadPoolExecutor(max_workers=n) as ex:
+        futs={ex.submit(_in_context(_one),b):b for b in batches}
+        for fut in as_completed(futs):
+            b=futs[fut]
+            try: errs=fut.result()
+            except Exception as e: errs={k:str(e) for k in b}
+            errors.update(errs); deleted+=[k for k in b if k not in errs]
+            if progress: progress(len(deleted)+len(errors),len(keys))
+    _feature_cache().invalidate(bucket,deleted); _hash_index().delete(bucket,deleted)
+    _listing_cache().discard(bucket,deleted); _presign_cache().discard(bucket,deleted)
+    return deleted,errors
+
+def move_r2(s3,bucket,src_key,dest_key,local=None):
+    copy_r2(s3,bucket,src_key,dest_key,local); delete_r2(s3,bucket,src_key)
+
+def move_r2_many(s3,bucket,keys,dest_for,workers=None,flush=200,copied=None):
+    # dest_for(i,key) -> dest key; claimed up front in key order, so the
+    # names are the same however the moves finish. Copies run in parallel;
+    # sources are removed with delete_r2_many every `flush` copies, and a key
+    # counts as moved once its source delete succeeded. copied([(i,key,dest_key)])
+    # is called on the calling thread just before each batch of deletes.
+    # Yields (i,key,dest_key,error) in completion order.
+    n=max(1,int(workers or PIPELINE_WORKERS["write"])); pending=[]
+    def _drain():
+        if copied and pending: copied(list(pending))
+        _,errs=delete_r2_many(s3,bucket,[k for _,k,_ in pending],workers)
+        for i,k,dk in pending:
+            yield i,k,dk,(RuntimeError(f"copied to {dk} but source delete failed: {errs[k]}") if k in errs else None)
+        pending.clear()
+    with ThreadPoolExecutor(max_workers=n) as ex:
+        futs={}
+        for i,k in enumerate(keys,1):
+            dk=dest_for(i,k); futs[ex.submit(_in_context(copy_r2),s3,bucket,k,dk)]=(i,k,dk)
+        for fut in as_completed(futs):
+            i,k,dk=futs[fut]; err=fut.exception()
+            if err: yield i,k,None,err; continue
+            pending.append((i,k,dk))
+            if len(pending)>=flush: yield from _drain()
+    yield from _drain()
+
+def find_local(folder):
+    paths=[]
+    for root,_,files in os.walk(folder):
+        for f in files:
+            if Path(f).suffix.lower() in SUPPORTED: paths.append(os.path.join(root,f))
+    return sorted(paths)
+
+# ════════════════════════════════════════════════════════════════════════════════
+# PIPELINE — download → extract → write, each stage on its own worker threads,
+# joined by bounded queues so downloads never run more than PIPELINE_QUEUE_SIZE
+# items ahead of feature extraction.
+#
+# Stage callables run on worker threads and must NOT call the Reporter —
+# every outcome is handed back to the calling thread through the generator,
+# which is where progress and messages are reported.
+# workers["processes"] sizes the feature pool. When a job uses the pool, the
+# extract stage gets at least pool.slots threads — they only wait on it.
+# Workers run in a copy of the caller's context, so its RunProfile sees every
+# stage call; workers["slowest"] sizes that profile's slowest-images list.
+# ════════════════════════════════════════════════════════════════════════════════
+PIPELINE_WORKERS    = {"download": 8, "extract": 4, "write": 8, "processes": FEATURE_PROCESSES,
+                       "slowest": PROFILE_SLOWEST}
+PIPELINE_QUEUE_SIZE = 64
+PIPELINE_OBSERVERS  = []    # callables (stage, seconds), run on the worker thread after every stage call
+_STAGE_DONE = object()
+
+
+def _observe(stage, seconds):
+    prof = _profile.get()
+    if prof is not None: prof.step(stage, seconds, _item.get())
+    _metrics().observe("pipeline_stage_seconds", seconds, stage=stage)
+    for ob in PIPELINE_OBSERVERS: ob(stage, seconds)
+
+def _item_key(item):
+    # the object key of a pipeline item — items are a key or an (index, key, …) tuple
+    return item[1] if isinstance(item, tuple) and len(item) > 1 else item
+
+
+def run_pipeline(items, download, extract, write, workers=None,
+                 queue_size: int = PIPELINE_QUEUE_SIZE, release=release_payload):
+    """
+    download(item)                -> payload
+    extract(item, payload)        -> features
+    write(item, payload, features)-> result
+    Yields (item, result, error, stage) in completion order — `stage` is the
+    stage that raised ("download" / "extract" / "write"), or None on success.
+    release(item, payload) runs once for every downloaded payload as its item
+    leaves the pipeline — finished, failed or cancelled.
+    """
+    items   = list(items)
+    workers = {**PIPELINE_WORKERS, **(workers or {})}
+    pool    = feature_pool(len(items), workers["processes"])
+    if pool: workers["extract"] = max(int(workers["extract"]), pool.slots)
+    stages  = [("download", download), ("extract", extract), ("write", write)]
+    queues  = [queue.Queue(maxsize=queue_size) for _ in stages]
+    done_q  = queue.Queue()
+    cancel  = threading.Event()
+
+    def _put(q, v):
+        while not cancel.is_set():
+            try: q.put(v, timeout=0.2); return True
+            except queue.Full: continue
+        return False
+
+    def _leave(item, args, outcome=None):
+        if release and args:
+            try: release(item, args[0])
+            except Exception: pass
+        if outcome: done_q.put(outcome)
+
+    def _worker(si, remaining, lock):
+        name, fn = stages[si]
+        in_q     = queues[si]
+        out_q    = queues[si + 1] if si + 1 < len(stages) else None
+        while True:
+            try: job = in_q.get(timeout=0.2)
+            except queue.Empty:
+                if cancel.is_set(): return
+                continue
+            if job is _STAGE_DONE:
+                _metrics().set("queue_depth", 0, queue=name); break
+            _metrics().set("queue_depth", in_q.qsize(), queue=name)
+            item, args = job
+            _item.set(_item_key(item))
+            t0 = time.perf_counter()
+            try:
+                out = fn(item, *args)
+            except Exception as e:
+                _observe(name, time.perf_counter() - t0)
+                _leave(item, args, (item, None, e, name)); continue
+            _observe(name, time.perf_counter() - t0)
+            if out_q is None: _leave(item, args, (item, out, None, None))
+            elif not _put(out_q, (item, args + (out,))): _leave(item, args + (out,))
+        # last worker of this stage to finish tells the next stage to stop
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last and out_q is not None:
+            for _ in range(max(1, int(workers[stages[si + 1][0]]))): _put(out_q, _STAGE_DONE)
+
+    for si, (name, _) in enumerate(stages):
+        n = max(1, int(workers[name]))
+        remaining, lock = [n], threading.Lock()
+        for _ in range(n):
+            threading.Thread(target=_in_context(_worker), args=(si, remaining, lock), daemon=True).start()
+
+    def _feed():
+        for item in items: _put(queues[0], (item, ()))
+        for _ in range(max(1, int(workers["download"]))): _put(queues[0], _STAGE_DONE)
+
+    threading.Thread(target=_feed, daemon=True).start()
+    engine = _engine.get() or "other"
+    try:
+        for _ in range(len(items)):
+            outcome = done_q.get()
+            _metrics().inc("images_processed_total", engine=engine,
+                           status="ok" if outcome[2] is None else f"{outcome[3]}_error")
+            yield outcome
+    finally:
+        cancel.set()
+        for q in queues:    # payloads stranded in the queues by an early exit
+            while True:
+                try: job = q.get_nowait()
+                except queue.Empty: break
+                if job is not _STAGE_DONE: _leave(*job)
+
+# ════════════════════════════════════════════════════════════════════════════════
+# INCREMENTAL RUNS — per (bucket, prefix, job) record of what a copy engine
+# has placed. A job is the engine plus everything that decides where an image
+# lands (output prefix, grouping mode / reference class), so two different
+# sorts of one prefix never share state. Every run records its placements;
+# incremental=True then skips what is already placed.
+#
+# Each placed key keeps the version (ETag) and LastModified it was placed at;
+# the job's watermark is the newest LastModified placed by a finished run.
+# The listing is filtered by it: a placed object at or before the watermark
+# is skipped outright (every write gets a new LastModified), and only newer
+# ones have their ETag compared — an identical re-upload is skipped. An
+# object that failed last time (never placed) is retried whatever its age.
+# ════════════════════════════════════════════════════════════════════════════════
+WATERMARK_FILE = "segregator_watermarks.sqlite"
+
+
+class Watermarks:
+    def __init__(self, path: str = WATERMARK_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS runs (
+            bucket TEXT, prefix TEXT, job TEXT, watermark TEXT, finished REAL,
+            PRIMARY KEY (bucket, prefix, job))""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS placed (
+            bucket TEXT, prefix TEXT, job TEXT, key TEXT, version TEXT,
+            last_modified TEXT, dest TEXT, grp TEXT,
+            PRIMARY KEY (bucket, prefix, job, key))""")
+        self._db.commit()
+
+    def last_run(self, bucket: str, prefix: str, job: str):
+        # → {"watermark", "finished", "placed"} or None if the job never finished a run
+        with self._lock:
+            row = self._db.execute("SELECT watermark, finished FROM runs WHERE bucket=? AND prefix=? AND job=?",
+                                   (bucket, prefix, job)).fetchone()
+            if row is None: return None
+            n = self._db.execute("SELECT COUNT(*) FROM placed WHERE bucket=? AND prefix=? AND job=?",
+                                 (bucket, prefix, job)).fetchone()[0]
+        return {"watermark": row[0], "finished": row[1], "placed": n}
+
+    def placed(self, bucket: str, prefix: str, job: str) -> dict:
+        # key → (version, dest, group)
+        with self._lock:
+            return {k: (v, d, g) for k, v, d, g in self._db.execute(
+                "SELECT key, version, dest, grp FROM placed WHERE bucket=? AND prefix=? AND job=?",
+                (bucket, prefix, job))}
+
+    def record(self, bucket: str, prefix: str, job: str, rows) -> None:
+        # rows: (key, version, last_modified, dest, group)
+        rows = [(bucket, prefix, job, k, v, _iso(lm), d, g) for k, v, lm, d, g in rows]
+        if not rows: return
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO placed VALUES (?,?,?,?,?,?,?,?)", rows)
+            self._db.commit()
+
+    def finish(self, bucket: str, prefix: str, job: str) -> str:
+        # the run succeeded for everything it recorded — advance the watermark
+        with self._lock:
+            wm = self._db.execute("SELECT MAX(last_modified) FROM placed WHERE bucket=? AND prefix=? AND job=?",
+                                  (bucket, prefix, job)).fetchone()[0] or ""
+            self._db.execute("INSERT OR REPLACE INTO runs VALUES (?,?,?,?,?)",
+                             (bucket, prefix, job, wm, datetime.datetime.now().timestamp()))
+            self._db.commit()
+        return wm
+
+    def summary(self, bucket: str, prefix: str, job: str) -> dict:
+        # group → [file name], the whole grouping built up by every run
+        out = {}
+        with self._lock:
+            for k, g in self._db.execute("SELECT key, grp FROM placed WHERE bucket=? AND prefix=? AND job=? "
+                                         "ORDER BY key", (bucket, prefix, job)):
+                out.setdefault(g, []).append(Path(k).name)
+        return out
+
+    def forget(self, bucket: str, prefix: str, job: str) -> None:
+        with self._lock:
+            for t in ("runs", "placed"):
+                self._db.execute(f"DELETE FROM {t} WHERE bucket=? AND prefix=? AND job=?", (bucket, prefix, job))
+            self._db.commit()
+
+
+def _iso(ts) -> str:
+    return ts.isoformat() if hasattr(ts, "isoformat") else str(ts or "")
+
+def _parse_iso(text: str):
+    try: return datetime.datetime.fromisoformat(text) if text else None
+    except ValueError: return None
+
+
+@functools.lru_cache(maxsize=None)
+def _watermarks() -> Watermarks:
+    return Watermarks()
+
+
+def _incremental_keys(bucket, prefix, job, img_keys, meta, out_prefix, report):
+    # → (keys to process, {key: (version, dest, group)} placed by earlier runs, keys skipped).
+    # Keys under the output prefix are our own copies, never sources.
+    out  = out_prefix.rstrip("/") + "/"
+    prev = _watermarks().placed(bucket, prefix, job)
+    src  = [k for k in img_keys if not k.startswith(out)]
+    last = _watermarks().last_run(bucket, prefix, job)
+    wm   = _parse_iso(last["watermark"]) if last else None
+    def _newer(k):
+        lm = meta.get(k, {}).get("last_modified")
+        try: return wm is None or lm > wm
+        except TypeError: return True       # no LastModified, or naive vs aware
+    todo = [k for k in src if k not in prev or (_newer(k) and prev[k][0] != _version(meta, k))]
+    since = f"since `{last['watermark'] or '—'}`" if last else "— no earlier run, processing everything"
+    report.info(f"⏩ Incremental: **{len(todo)}** new or changed {since}; "
+                f"**{len(src) - len(todo)}** already placed")
+    return todo, prev, len(src) - len(todo)
+
+
+def _record_placements(bucket, prefix, job, prev, rows, stale, flush=False):
+    # rows: (key, version, last_modified, dest, group) placed this run; an
+    # earlier copy of the same key that landed elsewhere (its group changed)
+    # is queued in stale
+    if flush or len(rows) >= 200:
+        stale += [prev[r[0]][1] for r in rows if r[0] in prev and prev[r[0]][1] != r[3]]
+        _watermarks().record(bucket, prefix, job, rows); rows.clear()
+
+
+# ════════════════════════════════════════════════════════════════════════════════
+# JOB JOURNAL — durable per-key state of every copy/move job, so a job cut off
+# by a dropped session or a restart carries on where it stopped when it is run
+# again with the same inputs. Each key goes
+#     pending (destination claimed) → copied → deleted (moves only)
+# and each state is written only after that step happened. Repeating a step
+# is safe: a pending key is copied again onto the SAME destination (no `_idx`
+# duplicate), a copied key's source delete is sent again (deleting a missing
+# key succeeds). pending and copied are committed per key as they happen —
+# a commit is tiny next to a transfer. A move's copied/deleted states are
+# written per batch of source deletes, so a crash repeats at most one batch.
+# A job that ends without failures is dropped from the journal.
+# ════════════════════════════════════════════════════════════════════════════════
+JOURNAL_FILE  = "segregator_jobs.sqlite"
+JOURNAL_BATCH = 200          # "deleted" marks written per commit by the move engines
+
+
+class JobJournal:
+    def __init__(self, path: str = JOURNAL_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")   # durable across app crashes; fsync at checkpoints
+        self._db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            job TEXT PRIMARY KEY, kind TEXT, bucket TEXT, label TEXT, started REAL, updated REAL)""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS steps (
+            job TEXT, key TEXT, state TEXT, dest TEXT, grp TEXT,
+            PRIMARY KEY (job, key))""")
+        self._db.commit()
+
+    def open(self, job: str, kind: str, bucket: str, label: str = "") -> dict:
+        # starts the job, or resumes it → key → (state, dest, group) already journaled
+        now = datetime.datetime.now().timestamp()
+        with self._lock:
+            self._db.execute("INSERT OR IGNORE INTO jobs VALUES (?,?,?,?,?,?)",
+                             (job, kind, bucket, label, now, now))
+            self._db.commit()
+            return {k: (st, d, g) for k, st, d, g in self._db.execute(
+                "SELECT key, state, dest, grp FROM steps WHERE job=?", (job,))}
+
+    def mark(self, job: str, rows) -> None:
+        # rows: (key, state, dest, group) — one commit for the lot
+        rows = [(job, k, st, d, g) for k, st, d, g in rows]
+        if not rows: return
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO steps VALUES (?,?,?,?,?)", rows)
+            self._db.execute("UPDATE jobs SET updated=? WHERE job=?",
+                             (datetime.datetime.now().timestamp(), job))
+            self._db.commit()
+
+    def finish(self, job: str) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM steps WHERE job=?", (job,))
+            self._db.execute("DELETE FROM jobs WHERE job=?", (job,))
+            self._db.commit()
+
+    def unfinished(self) -> list:
+        # → [{"job", "kind", "bucket", "label", "started", "updated", "states": {state: n}}]
+        with self._lock:
+            jobs = [dict(zip(("job", "kind", "bucket", "label", "started", "updated"), r))
+                    for r in self._db.execute("SELECT * FROM jobs ORDER BY started")]
+            for j in jobs:
+                j["states"] = dict(self._db.execute(
+                    "SELECT state, COUNT(*) FROM steps WHERE job=? GROUP BY state", (j["job"],)).fetchall())
+        return jobs
+
+
+@functools.lru_cache(maxsize=None)
+def _journal() -> JobJournal:
+    return JobJournal()
+
+
+def _claim(steps, key, group, new_dest, prev=None):
+    # destination for key: the one an interrupted run already claimed for the
+    # same group, else the one an earlier incremental run placed it at in the
+    # same group (a changed object is overwritten in place), else new_dest()
+    for prior in (steps.get(key), (prev or {}).get(key)):
+        if prior and prior[2] == group: return prior[1]
+    return new_dest()
+
+
+def _flush_marks(jid, marks, flush=False):
+    if marks and (flush or len(marks) >= JOURNAL_BATCH):
+        _journal().mark(jid, marks); marks.clear()
+
+
+def _end_job(jid, failed, report):
+    if not failed: _journal().finish(jid)
+    else: report.warning(f"⚠️ {failed} image(s) failed — run the same job again to retry them; "
+                         "finished images are not transferred twice.")
+
+
+# ════════════════════════════════════════════════════════════════════════════════
+# SEGREGATION ENGINES — each calls log_session_event with correct extra fields
+# ════════════════════════════════════════════════════════════════════════════════
+@_timed_engine
+def seg_r2_full(s3,bucket,prefix,out_prefix,mode,report,workers=None,incremental=False,log=True):
+    # incremental=True: only objects new or changed since this job's last run;
+    # the returned summary is then the job's whole grouping.
+    # s3 may be any Storage (see seg_local_full); log=False leaves logging to the caller.
+    meta={}; img_keys,_,_=scan_bucket(s3,bucket,prefix,meta=meta,report=report,refresh=incremental)
+    if not img_keys:
+        report.error("❌ No images found. Use the **Bucket Scanner** above — click ⚡ Quick Scan to see all keys.")
+        return {}
+    try: taken=list_taken(s3,bucket,f"{out_prefix.rstrip('/')}/")
+    except Exception as e: report.error(f"❌ Listing output prefix failed: {e}"); return {}
+    src=prefix.strip().lstrip("/"); job=f"r2_full|{out_prefix.rstrip('/')}|{mode}"; skipped=0
+    if incremental: img_keys,prev,skipped=_incremental_keys(bucket,src,job,img_keys,meta,out_prefix,report)
+    else: _watermarks().forget(bucket,src,job); prev={}
+    jid=f"{bucket}|{src}|{job}"; steps=_journal().open(jid,"r2_full",bucket,f"{src or '(root)'} → {out_prefix}")
+    taken.update(d for _,d,_ in steps.values())
+    resumed={k for k in img_keys if steps.get(k,("",))[0]=="copied"}
+    total=len(img_keys); failed=0; placed={}; rows=[]; stale=[]
+    if total: report.success(f"✅ Found **{total}** images — processing now…")
+    else:     report.success("✅ Nothing new or changed — the grouping is up to date.")
+    if resumed: report.info(f"↩️ Resuming an interrupted run — **{len(resumed)}** image(s) already copied")
+    for i,key in enumerate(img_keys,1):
+        if key not in resumed: continue
+        _,dk,group=steps[key]; placed[i]=(group,Path(key).name)
+        rows.append((key,_version(meta,key),meta.get(key,{}).get("last_modified"),dk,group))
+    def _download(job):
+        i,key=job; return fetch_or_cached(s3,bucket,key,_version(meta,key))
+    def _extract(job,payload):
+        try: info=classify_features(features_for(bucket,job[1],_version(meta,job[1]),payload))
+        except Exception as e: info={"category":"Unclassified","subcategory":"Unknown","tags":[],"description":str(e)}
+        return info,get_group(info,mode)
+    def _write(job,payload,feat):
+        (i,key),(info,group)=job,feat; local=None if isinstance(payload,dict) else payload
+        dk=_claim(steps,key,group,lambda: safe_dest_key(f"{out_prefix.rstrip('/')}/{group}",Path(key).name,i,taken),prev)
+        _journal().mark(jid,[(key,"pending",dk,group)])
+        copy_r2(s3,bucket,key,dk,local); _journal().mark(jid,[(key,"copied",dk,group)]); return (*feat,dk)
+    todo=[(i,k) for i,k in enumerate(img_keys,1) if k not in resumed]
+    for done,((i,key),res,err,stage) in enumerate(
+            run_pipeline(todo,_download,_extract,_write,workers),len(resumed)+1):
+        name=Path(key).name; report.progress(done/total,text=f"[{done}/{total}] {name}")
+        if stage=="download": report.warning(f"⚠️ Download `{key}`: {err}"); failed+=1; continue
+        if err: report.error(f"❌ Upload `{name}`: {err}"); failed+=1; continue
+        info,group,dk=res
+        report.write(f"✅ `{name}` → 📁 **{group}** `({info['category']} / {info['subcategory']})`")
+        placed[i]=(group,name)
+        if key in steps and steps[key][1]!=dk: stale.append(steps[key][1])
+        rows.append((key,_version(meta,key),meta.get(key,{}).get("last_modified"),dk,group))
+        _record_placements(bucket,src,job,prev,rows,stale)
+    _record_placements(bucket,src,job,prev,rows,stale,flush=True)
+    if stale: delete_r2_many(s3,bucket,stale)
+    watermark=_watermarks().finish(bucket,src,job)
+    _end_job(jid,failed,report)
+    summary={}
+    for i in sorted(placed): summary.setdefault(placed[i][0],[]).append(placed[i][1])
+    report.progress(1.0,text="Complete!")
+    moved_n = sum(len(v) for v in summary.values())
+    if log: log_session_event(
+        "r2_full", bucket=bucket, source_prefix=prefix,
+        output_prefix=out_prefix, mode=mode, summary=summary,
+        extra={
+            "moved":           moved_n,
+            "unchanged_count": 0,
+            "total_processed": total,
+            "failed":          failed,
+            **({"incremental": True, "skipped": skipped, "watermark": watermark} if incremental else {}),
+            **_timings(),
+        }
+    )
+    return _watermarks().summary(bucket,src,job) if incremental else summary
+
+@_timed_engine
+def seg_r2_ref(s3,bucket,ref_input,prefix,out_prefix,report,workers=None,incremental=False,
+               ref_info=None,log=True):
+    # ref_info: the reference's classification, when the caller already has it
+    if ref_info is None:
+        try:
+            with get_object_buffer(s3,bucket,r2_key_from_input(ref_input,bucket)) as buf: ref_info=classify_image(buf)
+        except Exception as e: report.error(f"❌ Reference failed: {e}"); return {}
+    ref_cat=ref_info["category"].lower(); ref_sub=ref_info["subcategory"].lower()
+    ref_tags={t.lower() for t in ref_info.get("tags",[])}
+    group_nm=sanitize(f"{ref_cat}_{ref_sub}") or "Similar"
+    report.info(f"Reference → **{ref_cat} / {ref_sub}**  |  tags: `{', '.join(ref_tags)}`")
+    meta={}; img_keys,_,_=scan_bucket(s3,bucket,prefix,meta=meta,report=report,refresh=incremental)
+    if not img_keys: report.error("❌ No images found."); return {}
+    try: taken=list_taken(s3,bucket,f"{out_prefix.rstrip('/')}/")
+    except Exception as e: report.error(f"❌ Listing output prefix failed: {e}"); return {}
+    src=prefix.strip().lstrip("/"); skipped=0
+    job=f"r2_reference|{out_prefix.rstrip('/')}|{ref_cat}|{ref_sub}|{','.join(sorted(ref_tags))}"
+    if incremental: img_keys,prev,skipped=_incremental_keys(bucket,src,job,img_keys,meta,out_prefix,report)
+    else: _watermarks().forget(bucket,src,job); prev={}
+    jid=f"{bucket}|{src}|{job}"; steps=_journal().open(jid,"r2_reference",bucket,f"{src or '(root)'} → {out_prefix}")
+    taken.update(d for _,d,_ in steps.values())
+    resumed={k for k in img_keys if steps.get(k,("",))[0]=="copied"}
+    total=len(img_keys); failed=0; placed={}; rows=[]; stale=[]
+    if resumed: report.info(f"↩️ Resuming an interrupted run — **{len(resumed)}** image(s) already copied")
+    for i,key in enumerate(img_keys,1):
+        if key not in resumed: continue
+        _,dk,folder=steps[key]; placed[i]=(folder,Path(key).name)
+        rows.append((key,_version(meta,key),meta.get(key,{}).get("last_modified"),dk,folder))
+    def _download(job):
+        i,key=job; return fetch_or_cached(s3,bucket,key,_version(meta,key))
+    def _extract(job,payload):
+        try: info=classify_features(features_for(bucket,job[1],_version(meta,job[1]),payload))
+        except Exception as e: info={"category":"Unclassified","subcategory":"Unknown","tags":[],"description":str(e)}
+        cat=info["category"].lower(); sub=info["subcategory"].lower()
+        tags={t.lower() for t in info.get("tags",[])}
+        return (cat==ref_cat) or (sub==ref_sub) or bool(tags&ref_tags)
+    def _write(job,payload,similar):
+        (i,key)=job; folder=group_nm if similar else "Other"; local=None if isinstance(payload,dict) else payload
+        dk=_claim(steps,key,folder,lambda: safe_dest_key(f"{out_prefix.rstrip('/')}/{folder}",Path(key).name,i,taken),prev)
+        _journal().mark(jid,[(key,"pending",dk,folder)])
+        copy_r2(s3,bucket,key,dk,local); _journal().mark(jid,[(key,"copied",dk,folder)]); return folder,dk
+    todo=[(i,k) for i,k in enumerate(img_keys,1) if k not in resumed]
+    for done,((i,key),res,err,stage) in enumerate(
+            run_pipeline(todo,_download,_extract,_write,workers),len(resumed)+1):
+        name=Path(key).name; report.progress(done/total,text=f"[{done}/{total}] {name}")
+        if stage=="download": report.warning(f"⚠️ {err}"); failed+=1; continue
+        if err: report.error(f"❌ `{name}`: {err}"); failed+=1; continue
+        folder,dk=res
+        label="✅ SIMILAR" if folder==group_nm else "➡️ Other"
+        report.write(f"{label} `{name}` → `{folder}/`"); placed[i]=(folder,name)
+        if key in steps and steps[key][1]!=dk: stale.append(steps[key][1])
+        rows.append((key,_version(meta,key),meta.get(key,{}).get("last_modified"),dk,folder))
+        _record_placements(bucket,src,job,prev,rows,stale)
+    _record_placements(bucket,src,job,prev,rows,stale,flush=True)
+    if stale: delete_r2_many(s3,bucket,stale)
+    watermark=_watermarks().finish(bucket,src,job)
+    _end_job(jid,failed,report)
+    if incremental and not total: report.success("✅ Nothing new or changed — the grouping is up to date.")
+    summary={}
+    for i in sorted(placed): summary.setdefault(placed[i][0],[]).append(placed[i][1])
+    report.progress(1.0,text="Complete!")
+    moved_n     = len(summary.get(group_nm, []))
+    unchanged_n = len(summary.get("Other",   []))
+    if log: log_session_event(
+        "r2_reference", bucket=bucket, source_prefix=prefix,
+        output_prefix=out_prefix, reference_image=ref_input, summary=summary,
+        extra={
+            "ref_category":    ref_cat,
+            "ref_subcategory": ref_sub,
+            "moved":           moved_n,
+            "unchanged_count": unchanged_n,
+            "total_processed": total,
+            **({"incremental": True, "skipped": skipped, "watermark": watermark} if incremental else {}),
+            **_timings(),
+        }
+    )
+    return _watermarks().summary(bucket,src,job) if incremental else summary
+
+def _local_layout(source,output):
+    # both folders as one LocalStorage "bucket" → (store, bucket, source prefix, output prefix):
+    # their common root, or — on different drives, where there is none — the
+    # two folders mounted side by side as source/ and output/
+    src,out=os.path.abspath(source),os.path.abspath(output)
+    try: root=os.path.commonpath([src,out])
+    except ValueError: return LocalStorage(mounts={"source":src,"output":out}),f"{src}|{out}","source/","output"
+    rel=lambda p:"" if p==root else Path(os.path.relpath(p,root)).as_posix()
+    return LocalStorage(),root,(rel(src)+"/" if rel(src) else ""),rel(out)
+
+@_timed_engine
+def seg_local_full(source,output,mode,report,workers=None):
+    # the R2 engine on the local-directory backend — same pipeline, journal and caches
+    images=find_local(source)
+    if not images: report.error(f"❌ No images in `{source}`"); return {}
+    summary=seg_r2_full(*_local_layout(source,output),mode,report,workers,log=False)
+    total=len(images)
+    moved_n = sum(len(v) for v in summary.values())
+    log_session_event(
+        "local_full", source_prefix=source, output_prefix=output,
+        mode=mode, summary=summary,
+        extra={
+            "moved":           moved_n,
+            "unchanged_count": total - moved_n,
+            "total_processed": total,
+            **_timings(),
+        }
+    )
+    return summary
+
+@_timed_engine
+def seg_local_ref(s3,bucket,ref_input,source,output,report,workers=None):
+    # reference = local file, or an R2 key/URL in `bucket`
+    try:
+        if os.path.isfile(ref_input): ref_info=classify_image(ref_input)
+        else:
+            with get_object_buffer(s3,bucket,r2_key_from_input(ref_input,bucket)) as buf: ref_info=classify_image(buf)
+    except Exception as e: report.error(f"❌ Reference failed: {e}"); return {}
+    images=find_local(source)
+    if not images: report.error(f"❌ No images in `{source}`"); return {}
+    store,root,pfx,out=_local_layout(source,output)
+    summary=seg_r2_ref(store,root,ref_input,pfx,out,report,workers,ref_info=ref_info,log=False)
+    group_nm=sanitize(f"{ref_info['category'].lower()}_{ref_info['subcategory'].lower()}") or "Similar"
+    total=len(images)
+    moved_n     = len(summary.get(group_nm, []))
+    unchanged_n = len(summary.get("Other",   []))
+    log_session_event(
+        "local_reference", source_prefix=source, output_prefix=output,
+        reference_image=ref_input, summary=summary,
+        extra={
+            "moved":           moved_n,
+            "unchanged_count": unchanged_n,
+            "total_processed": total,
+            **_timings(),
+        }
+    )
+    return summary
+
+
+# ════════════════════════════════════════════════════════════════════════════════
+# PRESIGNED URLS — memoized per (signer, bucket, key, expires). A URL is
+# handed out again until fewer than PRESIGN_MARGIN seconds of its validity
+# are left, so a Streamlit rerun re-signs nothing and the browser sees the
+# same URL — and can use its cached image — for most of the URL's life.
+# Deletes drop their keys. At most PRESIGN_MAX_ENTRIES URLs, oldest out first.
+# The signer is the boto3 client behind an S3Storage (storage_for() wraps it
+# afresh on every call), else the Storage itself; a weak reference makes sure
+# a URL is only reused by the very object that signed it, so two clients for
+# different accounts or endpoints never share URLs.
+# ════════════════════════════════════════════════════════════════════════════════
+PRESIGN_MARGIN      = 60
+PRESIGN_MAX_ENTRIES = 10000
+
+
+class PresignCache:
+    def __init__(self, margin: float = PRESIGN_MARGIN, max_entries: int = PRESIGN_MAX_ENTRIES):
+        self.margin, self.max_entries = margin, max_entries
+        self._lock = threading.Lock()
+        self._urls = collections.OrderedDict()    # (bucket, key) → {(id(signer), expires): (url, good until, ref)}
+
+    def get(self, store: Storage, bucket: str, key: str, expires: int) -> str:
+        signer = getattr(store, "client", store)
+        obj, sig, now = (bucket, key), (id(signer), expires), time.monotonic()
+        with self._lock:
+            hit = self._urls.get(obj, {}).get(sig)
+            if hit and hit[2]() is signer and hit[1] - now > self.margin:
+                _metrics().inc("cache_requests_total", cache="presign", result="hit")
+                return hit[0]
+        _metrics().inc("cache_requests_total", cache="presign", result="miss")
+        with _stage("presign"): url = store.presign(bucket, key, expires)
+        try: ref = weakref.ref(signer)
+        except TypeError: return url        # can't tell this signer apart later — don't keep its URLs
+        if url:
+            with self._lock:
+                self._urls.setdefault(obj, {})[sig] = (url, now + expires, ref)
+                self._urls.move_to_end(obj)
+                while len(self._urls) > self.max_entries: self._urls.popitem(last=False)
+        return url
+
+    def discard(self, bucket: str, keys) -> None:
+        with self._lock:
+            for k in keys: self._urls.pop((bucket, k), None)
+
+    def clear(self) -> None:
+        with self._lock: self._urls.clear()
+
+
+@functools.lru_cache(maxsize=None)
+def _presign_cache() -> PresignCache:
+    return PresignCache()
+
+
+def get_presigned_url(s3, bucket: str, key: str, expires: int = 600) -> str:
+    try:
+        return _presign_cache().get(storage_for(s3), bucket, key, expires)
+    except Exception:
+        return ""
+
+
+# ════════════════════════════════════════════════════════════════════════════════
+# THUMBNAILS — small WebP (JPEG where Pillow lacks WebP) tiles for the gallery,
+# so a page of 48 images doesn't make the browser fetch 48 originals. Made on
+# first view — JPEGs decode through draft(), so a 12 MP photo is never decoded
+# at full size — and kept in a local directory under a name derived from
+# (bucket, key, version, size). A changed object has a new ETag and so a new
+# name; stale tiles age out. Least-recently-viewed files go first once the
+# directory passes THUMB_CACHE_MAX_BYTES. Local rather than a _thumbs/ prefix
+# in the bucket, so they never show up in scans or get sorted themselves.
+# ════════════════════════════════════════════════════════════════════════════════
+THUMB_DIR             = os.environ.get("SEGREGATOR_THUMB_DIR", "segregator_thumbs")
+THUMB_MAX_PX          = 320     # longest side — the gallery shows 100–260 px tiles
+THUMB_QUALITY         = 80
+THUMB_CACHE_MAX_BYTES = 512 * 1024 * 1024
+THUMB_WORKERS         = 8
+
+
+class ThumbnailCache:
+    def __init__(self, path: str = THUMB_DIR, max_bytes: int = THUMB_CACHE_MAX_BYTES):
+        self.path, self.max_bytes = path, max_bytes
+        self._lock  = threading.Lock()
+        self._bytes = self._n = None    # running totals, counted on first use
+        PILImage.init()
+        self.format = "WEBP" if "WEBP" in PILImage.SAVE else "JPEG"
+        self.ext    = ".webp" if self.format == "WEBP" else ".jpg"
+
+    def _file(self, bucket, key, version, max_px) -> str:
+        h = hashlib.sha1(f"{bucket}\0{key}\0{version}\0{max_px}".encode()).hexdigest()
+        return os.path.join(self.path, h[:2], h + self.ext)
+
+    def _files(self):
+        for root, _, files in os.walk(self.path):
+            for f in files:
+                if f.endswith(self.ext):
+                    try: yield os.path.join(root, f), os.stat(os.path.join(root, f))
+                    except FileNotFoundError: pass
+
+    def get(self, bucket: str, key: str, version: str, max_px: int = THUMB_MAX_PX):
+        f = self._file(bucket, key, version, max_px)
+        try:
+            with open(f, "rb") as fh: data = fh.read()
+        except FileNotFoundError:
+            _metrics().inc("cache_requests_total", cache="thumbnail", result="miss"); return None
+        with contextlib.suppress(OSError): os.utime(f)       # mtime = last viewed
+        _metrics().inc("cache_requests_total", cache="thumbnail", result="hit")
+        return data
+
+    def put(self, bucket: str, key: str, version: str, data: bytes, max_px: int = THUMB_MAX_PX) -> None:
+        f = self._file(bucket, key, version, max_px)
+        os.makedirs(os.path.dirname(f), exist_ok=True)
+        tmp = f"{f}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as fh: fh.write(data)
+        os.replace(tmp, f)
+        with self._lock:
+            if self._bytes is None: self._tally()
+            else: self._bytes += len(data); self._n += 1
+            if self._bytes > self.max_bytes: self._evict()
+
+    def _tally(self) -> None:
+        sizes = [st.st_size for _, st in self._files()]
+        self._bytes, self._n = sum(sizes), len(sizes)
+
+    def _evict(self) -> None:
+        # caller holds the lock — oldest-viewed first, down to 90 % of max
+        files = sorted(self._files(), key=lambda fs: fs[1].st_mtime)
+        total, n = sum(st.st_size for _, st in files), len(files)
+        for f, st in files:
+            if total <= self.max_bytes * 0.9: break
+            with contextlib.suppress(OSError): os.remove(f); total -= st.st_size; n -= 1
+        self._bytes, self._n = total, n
+
+    def stats(self) -> dict:
+        with self._lock:
+            if self._bytes is None: self._tally()
+            return {"entries": self._n, "bytes": self._bytes, "max_bytes": self.max_bytes, "format": self.format}
+
+    def clear(self) -> None:
+        with self._lock:
+            for f, _ in list(self._files()):
+                with contextlib.suppress(OSError): os.remove(f)
+            self._bytes = self._n = 0
+
+
+@functools.lru_cache(maxsize=None)
+def _thumb_cache() -> ThumbnailCache:
+    return ThumbnailCache()
+
+
+def make_thumbnail(src, max_px: int = THUMB_MAX_PX, fmt: str = None) -> bytes:
+    # src = bytes / path / file object → encoded thumbnail, longest side ≤ max_px
+    fmt = fmt or _thumb_cache().format
+    img, _ = _decode(src, max_px)          # first frame of an animation
+    img.thumbnail((max_px, max_px), PILImage.LANCZOS)
+    buf = io.BytesIO()
+    img.save(buf, fmt, quality=THUMB_QUALITY, **({"method": 4} if fmt == "WEBP" else {"optimize": True}))
+    return buf.getvalue()
+
+
+def thumbnail(s3, bucket: str, key: str, version: str = "", max_px: int = THUMB_MAX_PX) -> bytes:
+    # the cached tile, made on a miss. Without a version (ETag from a listing)
+    # one HEAD finds it — still far cheaper than fetching the original.
+    if not version:
+        with _stage("head"): obj = storage_for(s3).head(bucket, key)
+        if obj is None: raise FileNotFoundError(key)
+        version = object_version(obj)
+    cache = _thumb_cache()
+    data  = cache.get(bucket, key, version, max_px)
+    if data is None:
+        with get_object_buffer(s3, bucket, key) as buf:
+            with _stage("thumbnail"): data = make_thumbnail(buf, max_px)
+        cache.put(bucket, key, version, data, max_px)
+    return data
+
+
+def thumbnails(s3, bucket: str, keys, versions: dict = None, max_px: int = THUMB_MAX_PX,
+               workers: int = THUMB_WORKERS) -> dict:
+    # a page of tiles in parallel → {key: bytes, or the exception}
+    keys, versions = list(dict.fromkeys(keys)), versions or {}
+    if not keys: return {}
+    one = lambda k: thumbnail(s3, bucket, k, versions.get(k, ""), max_px)
+    out = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(keys)))) as ex:
+        futs = {ex.submit(_in_context(one), k): k for k in keys}
+        for fut in as_completed(futs):
+            e = fut.exception(); out[futs[fut]] = e if e else fut.result()
+    return out
+
+
+# ════════════════════════════════════════════════════════════════════════════════
+# PHASE 1: preview_folder_by_upload — scan only, nothing moved
+# ════════════════════════════════════════════════════════════════════════════════
+@_timed_engine
+def preview_folder_by_upload(s3, bucket: str, folder_prefix: str,
+                              ref_bytes: bytes, ref_suffix: str, report, workers=None) -> dict:
+    ref_feat           = extract_features(ref_bytes, placeholder=True)
+    ref_info           = classify_features(ref_feat)
+    ref_hash           = ref_feat["hash"]
+    ref_is_placeholder = ref_feat["placeholder"]
+
+    ref_cat = ref_info["category"].lower().strip()
+    ref_sub = ref_info["subcategory"].lower().strip()
+
+    if ref_is_placeholder:
+        dest_sub        = "no_image"
+        hash_threshold  = _HASH_THRESHOLD_PLACEHOLDER
+        pixel_threshold = _PIXEL_THRESHOLD_PLACEHOLDER
+    else:
+        dest_sub        = sanitize(f"{ref_cat}_{ref_sub}")
+        hash_threshold  = _HASH_THRESHOLD_REAL
+        pixel_threshold = _PIXEL_THRESHOLD_REAL
+
+    base_pfx = folder_prefix.rstrip("/") + "/" if folder_prefix else ""
+    new_pfx  = base_pfx + dest_sub + "/"
+
+    meta = {}
+    all_img, _, _ = scan_bucket(s3, bucket, folder_prefix, max_keys=0, meta=meta, report=report)
+    direct_keys = [
+        k for k in all_img
+        if "/" not in (k[len(base_pfx):] if base_pfx and k.startswith(base_pfx) else k)
+        and (k[len(base_pfx):] if base_pfx and k.startswith(base_pfx) else k)
+    ]
+
+    if not direct_keys:
+        return {}
+
+    total = len(direct_keys)
+    recs  = {}
+
+    def _download(job):
+        i, key = job
+        return fetch_or_cached(s3, bucket, key, _version(meta, key), ref_is_placeholder)
+
+    def _extract(job, payload):
+        try:
+            feat            = features_for(bucket, job[1], _version(meta, job[1]), payload, ref_is_placeholder)
+            hash_dist       = _hamming_distance(ref_hash, feat["hash"])
+            pixel_sim       = _plane_similarity(ref_feat["px32"], feat["px32"])
+            img_placeholder = bool(feat["placeholder"])
+        except Exception:
+            hash_dist = 999; pixel_sim = 0.0; img_placeholder = False
+        return hash_dist, pixel_sim, img_placeholder
+
+    def _write(job, payload, feat):
+        return feat
+
+    for done, ((i, key), feat, err, stage) in enumerate(
+            run_pipeline(enumerate(direct_keys, 1), _download, _extract, _write, workers), 1):
+        name = Path(key).name
+        report.progress(done / total, text=f"Analysing [{done}/{total}] {name}")
+        if stage == "download":
+            report.warning(f"⚠️ Download `{key}`: {err}"); continue
+        if err:
+            report.error(f"❌ Analyse `{name}` ({stage}): {err}"); continue
+        hash_dist, pixel_sim, img_placeholder = feat
+
+        if ref_is_placeholder:
+            is_similar = hash_dist <= hash_threshold or pixel_sim >= pixel_threshold or img_placeholder
+            reason = ("placeholder_visual" if img_placeholder else
+                      "hash_match" if hash_dist <= hash_threshold else "pixel_match")
+        else:
+            is_similar = hash_dist <= hash_threshold or pixel_sim >= pixel_threshold
+            reason = "hash_match" if hash_dist <= hash_threshold else "pixel_match"
+
+        rec = {"key": key, "filename": name,
+               "hash_dist": hash_dist, "pixel_sim": round(pixel_sim, 4)}
+        if is_similar: rec["reason"] = reason
+        recs[i] = (is_similar, rec)
+
+    to_move = [recs[i][1] for i in sorted(recs) if recs[i][0]]
+    to_stay = [recs[i][1] for i in sorted(recs) if not recs[i][0]]
+
+    # near-duplicates of the reference already indexed elsewhere in the bucket
+    in_folder = set(direct_keys)
+    elsewhere = [{"key": k, "hash_dist": d}
+                 for k, d in _hash_index().query(bucket, ref_hash, hash_threshold)
+                 if k not in in_folder][:50]
+
+    report.progress(1.0, text="Analysis complete!")
+    return {
+        "folder":          folder_prefix or "(root)",
+        "dest_folder":     new_pfx,
+        "reference_type":  "placeholder" if ref_is_placeholder else "real",
+        "reference_class": dest_sub,
+        "total_scanned":   total,
+        "to_move_count":   len(to_move),
+        "to_stay_count":   len(to_stay),
+        "to_move":         to_move,
+        "to_stay":         to_stay,
+        "indexed_elsewhere": elsewhere,
+    }
+
+
+@_timed_engine
+def index_prefix(s3, bucket: str, prefix: str, report, workers=None) -> int:
+    # fills the feature cache + hash index for every image under prefix
+    meta = {}
+    img_keys, _, _ = scan_bucket(s3, bucket, prefix, meta=meta, report=report)
+    if not img_keys: return 0
+    total, indexed = len(img_keys), 0
+    def _download(job):
+        i, key = job
+        return fetch_or_cached(s3, bucket, key, _version(meta, key))
+    def _extract(job, payload):
+        return features_for(bucket, job[1], _version(meta, job[1]), payload)
+    def _write(job, payload, feat):
+        return feat
+    for done, ((i, key), _, err, _) in enumerate(
+            run_pipeline(enumerate(img_keys, 1), _download, _extract, _write, workers), 1):
+        report.progress(done / total, text=f"Indexing [{done}/{total}] {Path(key).name}")
+        if err: report.warning(f"⚠️ `{key}`: {err}")
+        else:   indexed += 1
+    report.progress(1.0, text="Index updated!")
+    return indexed
+
+
+
+
+# ════════════════════════════════════════════════════════════════════════════════
+# NEAR-DUPLICATE CLUSTERS — group a whole prefix into clusters of
+# near-duplicates, no reference image. Candidate pairs come from an in-memory
+# multi-index probe over the same 4 × 18-bit hash chunks as HashIndex, so the
+# work grows with the number of near pairs, not n². A candidate pair is linked
+# when hash_dist ≤ _HASH_THRESHOLD_REAL or pixel_sim ≥ _PIXEL_THRESHOLD_REAL.
+# ════════════════════════════════════════════════════════════════════════════════
+_CLUSTER_CANDIDATE_RADIUS = _HASH_THRESHOLD_PLACEHOLDER   # widest hash gap a pixel match may bridge
+
+
+def _popcount64(a):
+    # element-wise popcount of a uint64 array (np.bitwise_count needs numpy ≥ 2.0)
+    if hasattr(np, "bitwise_count"): return np.bitwise_count(a).astype(np.int64)
+    return _POPCOUNT8[a.view(np.uint8).reshape(-1, 8)].sum(axis=1, dtype=np.int64)
+
+_POPCOUNT8 = np.array([bin(b).count("1") for b in range(256)], dtype=np.uint8) if np is not None else None
+
+
+def cluster_near_duplicates(feats: list) -> list:
+    # feats = feature records → clusters as sorted lists of indices (size ≥ 2)
+    bits, n_ch = HashIndex.CHUNK_BITS, HashIndex.CHUNKS
+    mask   = (1 << bits) - 1
+    radius = _CLUSTER_CANDIDATE_RADIUS
+    masks  = _flip_masks(bits, radius // n_ch)
+    tables = [{} for _ in range(n_ch)]
+    if np is not None:          # occupancy bitmaps + split 64-bit words keep the probe and the distances in C
+        masks    = np.array(masks, dtype=np.int32)
+        occupied = [np.zeros(1 << bits, dtype=bool) for _ in range(n_ch)]
+        lo = np.array([f["hash"] & 0xFFFFFFFFFFFFFFFF for f in feats], dtype=np.uint64)
+        hi = np.array([f["hash"] >> 64 for f in feats], dtype=np.uint64)
+    parent = list(range(len(feats)))
+
+    def _find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]; x = parent[x]
+        return x
+
+    def _candidates(i, h, chunks):
+        # earlier items sharing a chunk within radius//CHUNKS → [(j, hash_dist ≤ radius)]
+        if np is not None:
+            hits = []
+            for c, val in enumerate(chunks):
+                probes = masks ^ val
+                hits  += [tables[c][v] for v in probes[occupied[c][probes]].tolist()]
+            if not hits: return []
+            js = np.unique(np.fromiter(itertools.chain.from_iterable(hits), dtype=np.int64))
+            ds = _popcount64(lo[js] ^ lo[i]) + _popcount64(hi[js] ^ hi[i])
+            ok = ds <= radius
+            return zip(js[ok].tolist(), ds[ok].tolist())
+        seen, out = set(), []
+        for c, val in enumerate(chunks):
+            for v in (val ^ m for m in masks):
+                for j in tables[c].get(v, ()):
+                    if j in seen: continue
+                    seen.add(j)
+                    d = _hamming_distance(h, feats[j]["hash"])
+                    if d <= radius: out.append((j, d))
+        return out
+
+    for i, f in enumerate(feats):
+        h      = f["hash"]
+        chunks = [(h >> (c * bits)) & mask for c in range(n_ch)]
+        for j, d in _candidates(i, h, chunks):
+            ri, rj = _find(i), _find(j)
+            if ri == rj: continue
+            if d <= _HASH_THRESHOLD_REAL or \
+               _plane_similarity(f["px32"], feats[j]["px32"]) >= _PIXEL_THRESHOLD_REAL:
+                parent[ri] = rj
+        for c, val in enumerate(chunks):
+            tables[c].setdefault(val, []).append(i)
+            if np is not None: occupied[c][val] = True
+
+    groups = {}
+    for i in range(len(feats)):
+        groups.setdefault(_find(i), []).append(i)
+    return sorted((g for g in groups.values() if len(g) > 1), key=lambda g: (-len(g), g[0]))
+
+
+@_timed_engine
+def preview_duplicate_clusters(s3, bucket: str, prefix: str, report, workers=None) -> dict:
+    # scan only, nothing moved — one record per near-duplicate cluster under prefix
+    meta = {}
+    img_keys, _, _ = scan_bucket(s3, bucket, prefix, meta=meta, report=report)
+    if not img_keys: return {}
+    total, found = len(img_keys), {}
+
+    def _download(job):
+        i, key = job
+        return fetch_or_cached(s3, bucket, key, _version(meta, key))
+    def _extract(job, payload):
+        return features_for(bucket, job[1], _version(meta, job[1]), payload)
+    def _write(job, payload, feat):
+        return feat
+    for done, ((i, key), feat, err, _) in enumerate(
+            run_pipeline(enumerate(img_keys, 1), _download, _extract, _write, workers), 1):
+        report.progress(done / total, text=f"Analysing [{done}/{total}] {Path(key).name}")
+        if err: report.warning(f"⚠️ `{key}`: {err}"); continue
+        found[i] = (key, feat)
+
+    report.progress(1.0, text="Clustering…")
+    keys  = [found[i][0] for i in sorted(found)]   # listing order, so reruns give the same clusters
+    feats = [found[i][1] for i in sorted(found)]
+    def _rec(j):
+        return {"key": keys[j], "filename": Path(keys[j]).name,
+                "width": feats[j]["width"], "height": feats[j]["height"],
+                "bytes": meta.get(keys[j], {}).get("size", 0)}
+
+    clusters = []
+    for members in cluster_near_duplicates(feats):
+        # keep = highest resolution, then largest file
+        best  = max(members, key=lambda j: (feats[j]["width"] * feats[j]["height"],
+                                            meta.get(keys[j], {}).get("size", 0)))
+        dupes = []
+        for j in members:
+            if j == best: continue
+            rec = _rec(j)
+            rec["hash_dist"] = _hamming_distance(feats[best]["hash"], feats[j]["hash"])
+            rec["pixel_sim"] = round(_plane_similarity(feats[best]["px32"], feats[j]["px32"]), 4)
+            dupes.append(rec)
+        clusters.append({"cluster_id": len(clusters) + 1, "size": len(members),
+                         "keep": _rec(best), "duplicates": dupes})
+
+    report.progress(1.0, text="Analysis complete!")
+    return {
+        "mode":            "duplicate_clusters",
+        "folder":          prefix or "(root)",
+        "total_scanned":   total,
+        "cluster_count":   len(clusters),
+        "duplicate_count": sum(len(c["duplicates"]) for c in clusters),
+        "hash_threshold":  _HASH_THRESHOLD_REAL,
+        "pixel_threshold": _PIXEL_THRESHOLD_REAL,
+        "clusters":        clusters,
+    }
+
+
+# ════════════════════════════════════════════════════════════════════════════════
+# PHASE 2: seg_folder_by_upload — execute move (uses preview_data if supplied)
+# ════════════════════════════════════════════════════════════════════════════════
+@_timed_engine
+def seg_folder_by_upload(s3, bucket: str, folder_prefix: str,
+                         ref_bytes: bytes, ref_suffix: str, report,
+                         preview_data: dict = None, workers=None) -> dict:
+
+    # ── LEGACY path (no preview_data) ────────────────────────────────────────
+    if preview_data is None:
+        ref_feat           = extract_features(ref_bytes, placeholder=True)
+        ref_info           = classify_features(ref_feat)
+        ref_hash           = ref_feat["hash"]
+        ref_is_placeholder = ref_feat["placeholder"]
+
+        ref_cat  = ref_info["category"].lower().strip()
+        ref_sub  = ref_info["subcategory"].lower().strip()
+        ref_tags = {t.lower() for t in ref_info.get("tags", [])}
+
+        if ref_is_placeholder:
+            dest_sub        = "no_image"
+            hash_threshold  = _HASH_THRESHOLD_PLACEHOLDER
+            pixel_threshold = _PIXEL_THRESHOLD_PLACEHOLDER
+            report.info(f"📎 Reference detected as **placeholder**\n\n"
+                    f"✅ Matches → `{folder_prefix.rstrip('/')}/{dest_sub}/`\n\n"
+                    f"➡️ All OTHER images stay exactly where they are.")
+        else:
+            dest_sub        = sanitize(f"{ref_cat}_{ref_sub}")
+            hash_threshold  = _HASH_THRESHOLD_REAL
+            pixel_threshold = _PIXEL_THRESHOLD_REAL
+            report.info(f"📎 Reference → **{ref_info['category']} / {ref_info['subcategory']}**\n\n"
+                    f"✅ Similar → `{folder_prefix.rstrip('/')}/{dest_sub}/`\n\n"
+                    f"➡️ All OTHER images stay exactly where they are.")
+
+        base_pfx = folder_prefix.rstrip("/") + "/" if folder_prefix else ""
+        new_pfx  = base_pfx + dest_sub + "/"
+
+        meta = {}
+        all_img, _, _ = scan_bucket(s3, bucket, folder_prefix, max_keys=0, meta=meta, report=report)
+        direct_keys = [
+            k for k in all_img
+            if "/" not in (k[len(base_pfx):] if base_pfx and k.startswith(base_pfx) else k)
+            and (k[len(base_pfx):] if base_pfx and k.startswith(base_pfx) else k)
+        ]
+
+        if not direct_keys:
+            report.error("❌ No direct images found in this folder.")
+            return {}
+
+        total = len(direct_keys)
+        report.info(f"Scanning **{total}** images in `{folder_prefix or '(root)'}`…")
+        result = {"moved": [], "unchanged": []}
+        moved_at, stayed_at = {}, {}
+        try:
+            taken = list_taken(s3, bucket, new_pfx)
+        except Exception as e:
+            report.error(f"❌ Listing `{new_pfx}` failed: {e}"); return {}
+
+        # journaled: a key moved by an interrupted run with this reference has
+        # left the folder already — count it, and finish its delete if needed
+        jid   = f"upload|{bucket}|{new_pfx}|{ref_hash:x}"
+        steps = _journal().open(jid, "r2_folder_upload", bucket, f"{folder_prefix or '(root)'} → {new_pfx}")
+        taken.update(d for _, d, _ in steps.values())
+        listed = set(direct_keys)
+        gone   = sorted(k for k, (st, _, _) in steps.items() if st in ("copied", "deleted") and k not in listed)
+        if gone:
+            report.info(f"↩️ Resuming an interrupted run — **{len(gone)}** image(s) already moved")
+            delete_r2_many(s3, bucket, [k for k in gone if steps[k][0] == "copied"])
+            moved_at.update({-len(gone) + n: Path(k).name for n, k in enumerate(gone)})
+        marks, failed = [], 0
+
+        def _download(job):
+            i, key = job
+            return fetch_or_cached(s3, bucket, key, _version(meta, key), ref_is_placeholder)
+
+        def _extract(job, payload):
+            try:
+                feat            = features_for(bucket, job[1], _version(meta, job[1]), payload,
+                                               ref_is_placeholder)
+                hash_dist       = _hamming_distance(ref_hash, feat["hash"])
+                pixel_sim       = _plane_similarity(ref_feat["px32"], feat["px32"])
+                img_placeholder = bool(feat["placeholder"])
+            except Exception:
+                hash_dist = 999; pixel_sim = 0.0; img_placeholder = False
+            if ref_is_placeholder:
+                is_similar = (hash_dist <= hash_threshold or
+                              pixel_sim >= pixel_threshold or img_placeholder)
+            else:
+                is_similar = (hash_dist <= hash_threshold or pixel_sim >= pixel_threshold)
+            return is_similar, hash_dist, pixel_sim, img_placeholder
+
+        def _write(job, payload, feat):
+            i, key = job
+            if not feat[0]: return feat
+            dest_key = _claim(steps, key, dest_sub,
+                              lambda: safe_dest_key(new_pfx.rstrip("/"), Path(key).name, i, taken))
+            _journal().mark(jid, [(key, "pending", dest_key, dest_sub)])
+            copy_r2(s3, bucket, key, dest_key, local=None if isinstance(payload, dict) else payload)
+            _journal().mark(jid, [(key, "copied", dest_key, dest_sub)])
+            return (*feat, dest_key)
+
+        # sources go in delete_r2_many batches, as in move_r2_many; a key
+        # counts as moved once its delete succeeded
+        copied = []
+        def _drain():
+            nonlocal failed
+            _, errs = delete_r2_many(s3, bucket, [k for _, k, _, _ in copied])
+            for i, key, dest_key, label in copied:
+                name = Path(key).name
+                if key in errs:
+                    report.error(f"❌ Move failed `{name}`: copied to {dest_key} but source delete failed: {errs[key]}")
+                    failed += 1; continue
+                report.write(f"{label}  `{name}` → `{new_pfx}`")
+                moved_at[i] = name
+                marks.append((key, "deleted", dest_key, dest_sub))
+            _flush_marks(jid, marks); copied.clear()
+
+        for done, ((i, key), feat, err, stage) in enumerate(
+                run_pipeline(enumerate(direct_keys, 1), _download, _extract, _write, workers), 1):
+            name = Path(key).name
+            report.progress(done / total, text=f"[{done}/{total}] {name}")
+            if stage == "download":
+                report.warning(f"⚠️ Download `{key}`: {err}"); failed += 1; continue
+            if err:
+                report.error(f"❌ Move failed `{name}`: {err}"); failed += 1; continue
+            is_similar, hash_dist, pixel_sim, img_placeholder = feat[:4]
+            if is_similar:
+                label = ("🚫 PLACEHOLDER" if ref_is_placeholder and img_placeholder
+                         else "🔁 SIMILAR-PLACEHOLDER" if ref_is_placeholder
+                         else "✅ MOVED")
+                copied.append((i, key, feat[4], label))
+                if len(copied) >= 200: _drain()
+            else:
+                report.write(f"➡️ STAYS  `{name}`  (hash dist: {hash_dist} | pixel sim: {pixel_sim:.2f})")
+                stayed_at[i] = name
+        if copied: _drain()
+        _flush_marks(jid, marks, True)
+        _end_job(jid, failed, report)
+
+        result["moved"]     = [moved_at[i]  for i in sorted(moved_at)]
+        result["unchanged"] = [stayed_at[i] for i in sorted(stayed_at)]
+        report.progress(1.0, text="Complete!")
+        moved_n     = len(result.get("moved", []))
+        unchanged_n = len(result.get("unchanged", []))
+        log_session_event(
+            "r2_folder_upload", bucket=bucket, source_prefix=folder_prefix,
+            output_prefix=new_pfx, reference_image="<uploaded>",
+            summary={dest_sub: result.get("moved", [])},
+            extra={
+                "is_placeholder":  ref_is_placeholder,
+                "dest_sub":        dest_sub,
+                "moved":           moved_n,
+                "unchanged_count": unchanged_n,
+                "total_processed": moved_n + unchanged_n,
+                **_timings(),
+            }
+        )
+        return result
+
+    # ── PHASE 2: execute from preview_data ───────────────────────────────────
+    keys_to_move = [rec["key"] for rec in preview_data.get("to_move", [])]
+    new_pfx      = preview_data["dest_folder"]
+    dest_sub     = preview_data["reference_class"]
+
+    if not keys_to_move:
+        report.warning("No images to move based on preview.")
+        return {"moved": [], "unchanged": []}
+
+    total  = len(keys_to_move)
+    result = {"moved": [], "unchanged": []}
+    report.info(f"Moving **{total}** matched images → `{new_pfx}`")
+
+    try:
+        taken = list_taken(s3, bucket, new_pfx)
+    except Exception as e:
+        report.error(f"❌ Listing `{new_pfx}` failed: {e}"); return {}
+
+    # journaled: keys already moved by an interrupted run of this same preview
+    # are skipped, half-moved ones finish onto the destination they claimed
+    digest = hashlib.sha1("\n".join(sorted(keys_to_move)).encode()).hexdigest()[:16]
+    jid    = f"move|{bucket}|{new_pfx}|{digest}"
+    steps  = _journal().open(jid, "r2_folder_upload", bucket, f"{total} image(s) → {new_pfx}")
+    taken.update(d for _, d, _ in steps.values())
+    order  = {k: i for i, k in enumerate(keys_to_move, 1)}
+    state  = lambda k: steps.get(k, ("",))[0]
+    rest   = [k for k in keys_to_move if state(k) not in ("copied", "deleted")]
+    dests  = {k: _claim(steps, k, dest_sub,
+                        lambda: safe_dest_key(new_pfx.rstrip("/"), Path(k).name, order[k], taken)) for k in rest}
+    _journal().mark(jid, [(k, "pending", dests[k], dest_sub) for k in rest if state(k) != "pending"])
+
+    moved_at, marks, failed = {}, [], 0
+    moved_at.update({order[k]: Path(k).name for k in keys_to_move if state(k) == "deleted"})
+    half = [k for k in keys_to_move if state(k) == "copied"]
+    if moved_at or half:
+        report.info(f"↩️ Resuming an interrupted run — **{len(moved_at) + len(half)}** image(s) already copied")
+    if half:
+        deleted, errs = delete_r2_many(s3, bucket, half)
+        _journal().mark(jid, [(k, "deleted", steps[k][1], dest_sub) for k in deleted])
+        moved_at.update({order[k]: Path(k).name for k in deleted})
+        for k, e in errs.items():
+            report.error(f"❌ Move failed `{Path(k).name}`: {e}"); failed += 1
+
+    on_copied = lambda batch: _journal().mark(jid, [(k, "copied", dk, dest_sub) for _, k, dk in batch])
+    for done, (_, key, dk, err) in enumerate(
+            move_r2_many(s3, bucket, rest, lambda i, k: dests[k], (workers or {}).get("write"),
+                         copied=on_copied), total - len(rest) + 1):
+        name = Path(key).name
+        report.progress(done / total, text=f"Moving [{done}/{total}] {name}")
+        if err:
+            report.error(f"❌ Move failed `{name}`: {err}"); failed += 1; continue
+        report.write(f"✅ MOVED  `{name}` → `{new_pfx}`")
+        moved_at[order[key]] = name
+        marks.append((key, "deleted", dk, dest_sub)); _flush_marks(jid, marks)
+    _flush_marks(jid, marks, True)
+    _end_job(jid, failed, report)
+
+    result["moved"]     = [moved_at[i] for i in sorted(moved_at)]
+    result["unchanged"] = [rec["filename"] for rec in preview_data.get("to_stay", [])]
+    report.progress(1.0, text="Segregation complete!")
+
+    moved_n     = len(result.get("moved", []))
+    unchanged_n = len(result.get("unchanged", []))
+    log_session_event(
+        "r2_folder_upload", bucket=bucket,
+        source_prefix=preview_data.get("folder", ""),
+        output_prefix=new_pfx, reference_image="<uploaded>",
+        summary={dest_sub: result.get("moved", [])},
+        extra={
+            "is_placeholder":  preview_data.get("reference_type") == "placeholder",
+            "dest_sub":        dest_sub,
+            "moved":           moved_n,
+            "unchanged_count": unchanged_n,
+            "total_processed": preview_data.get("total_scanned", 0),
+            **_timings(),
+        }
+    )
+    return result
+
+
+def segregation_result(bucket: str, source_folder: str, preview: dict, result: dict,
+                       key_prefix: str = None) -> dict:
+    # the "segregation_complete" JSON written after executing a preview;
+    # key_prefix = where unchanged files live (defaults to source_folder)
+    key_prefix = source_folder if key_prefix is None else key_prefix
+    return {
+        "event":           "segregation_complete",
+        "timestamp":       datetime.datetime.now().isoformat(),
+        "bucket":          bucket,
+        "source_folder":   source_folder,
+        "dest_folder":     preview.get("dest_folder"),
+        "reference_type":  preview.get("reference_type"),
+        "reference_class": preview.get("reference_class"),
+        "moved_count":     len(result.get("moved", [])),
+        "unchanged_count": len(result.get("unchanged", [])),
+        "total_scanned":   preview.get("total_scanned", 0),
+        "moved_files": [
+            {"r2_key": preview["dest_folder"] + fn, "filename": fn}
+            for fn in result.get("moved", [])
+        ],
+        "unchanged_files": [
+            {"r2_key": key_prefix + fn, "filename": fn}
+            for fn in result.get("unchanged", [])
+        ],
+    }
+
+
+# ════════════════════════════════════════════════════════════════════════════════
+# UI HOOKS — what app.py reads and resets of the caches, the hash index, the
+# job journal and the metrics, so the UI doesn't reach into the private
+# singletons. Cache names: "features", "thumbnails", "listings".
+# ════════════════════════════════════════════════════════════════════════════════
+HASH_RADIUS = _HASH_THRESHOLD_REAL      # default radius of a similar-image search
+_CACHES     = {"features": _feature_cache, "thumbnails": _thumb_cache, "listings": _listing_cache}
+
+
+def cache_stats(name: str) -> dict:
+    return _CACHES[name]().stats()
+
+
+def clear_cache(name: str, bucket: str = None) -> None:
+    # bucket only narrows the listing cache
+    if name == "listings": _listing_cache().clear(bucket)
+    else: _CACHES[name]().clear()
+
+
+def indexed_count(bucket: str) -> int:
+    return _hash_index().count(bucket)
+
+
+def search_similar(bucket: str, h: int, radius: int = HASH_RADIUS, prefix: str = "") -> list:
+    # → [(key, distance)], nearest first
+    return _hash_index().query(bucket, h, radius, prefix=prefix)
+
+
+def unfinished_jobs() -> list:
+    return _journal().unfinished()
+
+
+def discard_job(job: str) -> None:
+    _journal().finish(job)
+
+
+def count_metric(name: str, value: float = 1, **labels) -> None:
+    _metrics().inc(name, value, **labels)
+
+
+# ════════════════════════════════════════════════════════════════════════════════
+# CLI — same engines, same JSON files as the UI's download buttons.
+# Messages and progress go to stderr; JSON goes to -o FILE or stdout.
+# Exit status: 0 ok, 1 engine reported nothing to do / failed, 2 bad usage.
+# ════════════════════════════════════════════════════════════════════════════════
+class ConsoleReporter(Reporter):
+    def __init__(self, quiet: bool = False):
+        self.quiet, self._last = quiet, -1
+
+    def _say(self, tag: str, msg: str) -> None:
+        print(f"{tag} {msg.replace('**', '').replace('`', '')}", file=sys.stderr)
+
+    def progress(self, frac: float, text: str = "") -> None:
+        pct = int(frac * 100)
+        if not self.quiet and pct != self._last and (pct % 10 == 0 or frac >= 1):
+            self._last = pct; self._say(f"[{pct:3d}%]", text)
+
+    def write(self, msg):   self.quiet or self._say("  ", msg)
+    def info(self, msg):    self._say("[info]", msg)
+    def success(self, msg): self._say("[ok]", msg)
+    def warning(self, msg): self._say("[warn]", msg)
+    def error(self, msg):   self._say("[error]", msg)
+
+
+def _emit(data, out: str) -> None:
+    text = json.dumps(data, indent=2, ensure_ascii=False, default=str)
+    if out:
+        with open(out, "w", encoding="utf-8") as f: f.write(text)
+    else:
+        print(text)
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(prog="segregator", description="AI Image Segregator — headless engines")
+    ap.add_argument("-q", "--quiet", action="store_true", help="no per-image lines")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    def _cmd(name, help):
+        p = sub.add_parser(name, help=help)
+        p.add_argument("--bucket", required=True, help="R2 bucket, or a directory with --storage local")
+        p.add_argument("--storage", default="r2", choices=["r2", "local"])
+        p.add_argument("-o", "--out", default="", help="write JSON here instead of stdout")
+        p.add_argument("--workers", default="", help="pipeline workers, e.g. download=16,extract=4,write=8,processes=15")
+        return p
+
+    p = _cmd("scan", "list images and folders under a prefix")
+    p.add_argument("--prefix", default="")
+    p.add_argument("--max-keys", type=int, default=0)
+    p = _cmd("preview", "preview an upload-by-reference sort (nothing moved)")
+    p.add_argument("--prefix", default="")
+    p.add_argument("--ref", required=True, help="local reference image")
+    p = _cmd("execute", "move the images listed in a preview JSON")
+    p.add_argument("--preview", required=True)
+    p = _cmd("full-segregate", "classify every image and copy it into <out-prefix>/<group>/")
+    p.add_argument("--prefix", default="")
+    p.add_argument("--out-prefix", required=True)
+    p.add_argument("--mode", default="category", choices=["category", "subcategory", "tags"])
+    p.add_argument("--incremental", action="store_true",
+                   help="only objects new or changed since the last run of this job")
+    a = ap.parse_args(argv)
+
+    try:
+        workers = {k: int(v) for k, v in (kv.split("=") for kv in a.workers.split(",") if kv)} or None
+    except ValueError:
+        ap.error("--workers expects stage=N pairs")
+    report = ConsoleReporter(a.quiet)
+    start_metrics()         # SEGREGATOR_METRICS_FILE gets written on exit
+    try:
+        s3 = LocalStorage() if a.storage == "local" else make_s3_client()
+    except RuntimeError as e:
+        report.error(str(e)); return 2
+
+    if a.cmd == "scan":
+        imgs, keys, folders = scan_bucket(s3, a.bucket, a.prefix, a.max_keys, report=report)
+        _emit({"bucket": a.bucket, "prefix": a.prefix, "total_keys": len(keys),
+               "image_count": len(imgs), "folders": folders, "images": imgs}, a.out)
+        return 0
+    if a.cmd == "preview":
+        with open(a.ref, "rb") as f: ref_bytes = f.read()
+        pv = preview_folder_by_upload(s3, a.bucket, a.prefix, ref_bytes, Path(a.ref).suffix or ".jpg",
+                                      report, workers)
+        if not pv: report.error("No direct images found in this folder."); return 1
+        _emit(pv, a.out); return 0
+    if a.cmd == "execute":
+        with open(a.preview, "r", encoding="utf-8") as f: pv = json.load(f)
+        src = "" if pv.get("folder") in (None, "(root)") else pv["folder"]
+        res = seg_folder_by_upload(s3, a.bucket, src, b"", "", report, preview_data=pv, workers=workers)
+        if not res: return 1
+        base = src.rstrip("/") + "/" if src else ""
+        _emit(segregation_result(a.bucket, base, pv, res), a.out); return 0
+    if a.cmd == "full-segregate":
+        summary = seg_r2_full(s3, a.bucket, a.prefix, a.out_prefix, a.mode, report, workers,
+                              a.incremental)
+        if not summary: return 1
+        _emit({"bucket": a.bucket, "source_prefix": a.prefix, "output_prefix": a.out_prefix,
+               "mode": a.mode, "groups": summary,
+               "moved_count": sum(len(v) for v in summary.values())}, a.out)
+        return 0
+    return 2
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    sys.exit(main())
@@ -0,0 +1,53 @@
+import io
+import os
+import random
+import sys
+
+import pytest
+from PIL import Image, ImageDraw, ImageFilter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SEGREGATOR_PROCESSES", "0")      # extraction in-thread, no worker pool
+
+import segregator as sg
+
+
+@pytest.fixture(autouse=True)
+def isolated(tmp_path, monkeypatch):
+    # every test gets its own working directory (caches, logs, journals,
+    # thumbnails are created relative to it) and fresh module singletons
+    monkeypatch.chdir(tmp_path)
+    singletons = [f for f in vars(sg).values() if callable(getattr(f, "cache_clear", None))]
+    for f in singletons: f.cache_clear()
+    yield tmp_path
+    for f in singletons: f.cache_clear()
+
+
+def photo(seed: int, size=(1600, 1200), mode: str = "RGB") -> Image.Image:
+    # gradient sky, a few blurred shapes — enough structure for hashes and HSV stats
+    rng = random.Random(seed)
+    w, h = size
+    top, bottom = [rng.randrange(256) for _ in range(3)], [rng.randrange(256) for _ in range(3)]
+    img = Image.new("RGB", size)
+    d = ImageDraw.Draw(img)
+    for y in range(h):
+        t = y / max(1, h - 1)
+        d.line([(0, y), (w, y)], fill=tuple(int(a + (b - a) * t) for a, b in zip(top, bottom)))
+    for _ in range(rng.randint(3, 7)):
+        x0, y0 = rng.randrange(w), rng.randrange(h)
+        box = [x0, y0, x0 + rng.randint(w // 10, w // 2), y0 + rng.randint(h // 10, h // 2)]
+        fill = tuple(rng.randrange(256) for _ in range(3))
+        (d.ellipse if rng.random() < 0.5 else d.rectangle)(box, fill=fill)
+    img = img.filter(ImageFilter.GaussianBlur(max(1, w // 400)))
+    return img.convert(mode) if mode != "RGB" else img
+
+
+def encode(img: Image.Image, fmt: str = "JPEG", **kw) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, fmt, **({"quality": 88} if fmt == "JPEG" and not kw else kw))
+    return buf.getvalue()
+
+
+@pytest.fixture
+def fake():
+    return sg.FakeStorage()
@@ -0,0 +1,63 @@
+import json
+import os
+
+import pytest
+
+import segregator as sg
+from conftest import encode, photo
+
+
+@pytest.fixture
+def bucket(isolated):
+    # a LocalStorage "bucket": shop/ holds 3 copies of one photo and 3 others
+    ref = encode(photo(1, (640, 480)))
+    os.makedirs("bk/shop/old")
+    for i in range(3):
+        with open(f"bk/shop/ref_{i}.jpg", "wb") as f: f.write(ref)
+        with open(f"bk/shop/other_{i}.jpg", "wb") as f: f.write(encode(photo(50 + i, (640, 480))))
+    with open("bk/shop/old/keep.png", "wb") as f: f.write(encode(photo(9, (320, 240)), "PNG"))
+    with open("ref.jpg", "wb") as f: f.write(ref)
+    return "bk"
+
+
+def _run(*argv):
+    return sg.main(["-q", *argv])
+
+
+def test_scan_writes_images_and_folders(bucket):
+    assert _run("scan", "--bucket", bucket, "--storage", "local", "--prefix", "shop/", "-o", "scan.json") == 0
+    out = json.load(open("scan.json"))
+    assert out["image_count"] == 7 and out["folders"] == ["shop/old/"]
+
+
+def test_preview_then_execute_moves_only_the_matches(bucket):
+    assert _run("preview", "--bucket", bucket, "--storage", "local", "--prefix", "shop/",
+                "--ref", "ref.jpg", "-o", "pv.json") == 0
+    pv = json.load(open("pv.json"))
+    assert sorted(r["filename"] for r in pv["to_move"]) == ["ref_0.jpg", "ref_1.jpg", "ref_2.jpg"]
+    assert _run("execute", "--bucket", bucket, "--storage", "local", "--preview", "pv.json", "-o", "res.json") == 0
+    res = json.load(open("res.json"))
+    assert len(res["moved_files"]) == 3
+    left = sorted(os.listdir("bk/shop"))
+    assert [n for n in left if n.endswith(".jpg")] == ["other_0.jpg", "other_1.jpg", "other_2.jpg"]
+    assert len(os.listdir(os.path.join("bk", pv["dest_folder"]))) == 3
+
+
+def test_full_segregate_copies_every_image(bucket):
+    assert _run("full-segregate", "--bucket", bucket, "--storage", "local", "--prefix", "shop/",
+                "--out-prefix", "sorted/", "-o", "full.json") == 0
+    out = json.load(open("full.json"))
+    assert out["moved_count"] == 7
+    copied = [os.path.join(r, f) for r, _, fs in os.walk("bk/sorted") for f in fs]
+    assert len(copied) == 7 and len(os.listdir("bk/shop")) == 7
+
+
+def test_preview_of_an_empty_folder_fails(bucket):
+    os.makedirs("bk/empty")
+    assert _run("preview", "--bucket", bucket, "--storage", "local", "--prefix", "empty/", "--ref", "ref.jpg") == 1
+
+
+def test_bad_workers_is_a_usage_error(bucket):
+    with pytest.raises(SystemExit) as e:
+        _run("scan", "--bucket", bucket, "--storage", "local", "--workers", "download")
+    assert e.value.code == 2
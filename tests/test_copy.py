@@ -0,0 +1,44 @@
+import io
+
+import pytest
+
+import segregator as sg
+
+
+def _requests(fake, op):
+    return fake.stats().get(op, {}).get("requests", 0)
+
+
+def _listed(fake):
+    return sg.scan_bucket(fake, "b", "")[0]
+
+
+def test_copy_is_server_side(fake):
+    fake.add("b", "a.jpg", b"abc")
+    assert _listed(fake) == ["a.jpg"]                               # now cached
+    sg.copy_r2(fake, "b", "a.jpg", "out/a.jpg")
+    assert _requests(fake, "copy") == 1
+    assert _requests(fake, "get") == _requests(fake, "put") == 0
+    assert _listed(fake) == ["a.jpg", "out/a.jpg"]
+
+
+def test_store_without_copy_falls_back_to_upload():
+    fake = sg.FakeStorage(copy=False)
+    fake.add("b", "a.jpg", b"abc")
+    assert _listed(fake) == ["a.jpg"]
+    sg.copy_r2(fake, "b", "a.jpg", "out/a.jpg")
+    assert _requests(fake, "get") == _requests(fake, "put") == 1
+    sg.copy_r2(fake, "b", "a.jpg", "out/b.jpg", local=io.BytesIO(b"abc"))   # bytes at hand: no get
+    assert _requests(fake, "get") == 1 and _requests(fake, "put") == 2
+    assert _listed(fake) == ["a.jpg", "out/a.jpg", "out/b.jpg"]
+    assert fake.get("b", "out/a.jpg")[0].read() == b"abc"
+
+
+def test_other_copy_errors_are_raised():
+    fake = sg.FakeStorage(error_rate=1.0, fail_ops=("copy",))
+    fake.add("b", "a.jpg", b"abc")
+    with pytest.raises(sg.FakeStorageError):
+        sg.copy_r2(fake, "b", "a.jpg", "out/a.jpg", local=io.BytesIO(b"abc"))
+    with pytest.raises(sg.FakeStorageError):
+        sg.copy_r2(sg.FakeStorage(), "b", "missing.jpg", "out/missing.jpg")
+    assert _requests(fake, "put") == 0
@@ -0,0 +1,37 @@
+import pytest
+
+import segregator as sg
+from conftest import encode, photo
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    # JPEGs take the draft() path; PNG / palette / RGBA / TIFF take reduce()
+    imgs  = [encode(photo(i, (1600, 1200))) for i in range(8)]
+    imgs += [encode(photo(10 + i, (1200, 900)), "PNG") for i in range(4)]
+    imgs += [encode(photo(20, (1000, 800), "P"), "PNG"), encode(photo(21, (1000, 800), "RGBA"), "PNG"),
+             encode(photo(22, (2000, 1500)), "TIFF")]
+    return imgs
+
+
+def test_reduced_decode_agrees_with_full_decode(corpus):
+    r = sg.decode_agreement(corpus)
+    assert r["images"] == len(corpus)
+    # dHash bits near a threshold may flip; every pair must stay a near-duplicate
+    assert r["hash_within_threshold"] == 1.0
+    assert r["max_hash_dist"] <= sg._HASH_THRESHOLD_REAL
+    assert r["category"] == 1.0
+    assert r["subcategory"] >= 0.9
+
+
+@pytest.mark.parametrize("mode", ["RGB", "RGBA", "L", "P"])
+def test_non_jpeg_is_reduced_before_conversion(mode):
+    img, size = sg._decode(encode(photo(3, (1920, 1080), mode), "PNG"), 240)
+    assert size == (1920, 1080)
+    assert img.mode == "RGB"
+    assert 240 <= min(img.size) < 2 * 240
+
+
+def test_small_images_decode_at_full_size():
+    img, size = sg._decode(encode(photo(4, (300, 200)), "PNG"), 240)
+    assert img.size == size == (300, 200)
@@ -0,0 +1,41 @@
+import segregator as sg
+from conftest import encode, photo
+
+
+def test_delete_r2_many_sends_one_request_per_batch(fake):
+    keys = [f"d/{i:05d}.jpg" for i in range(2500)]
+    for k in keys: fake.add("b", k, b"x")
+    deleted, errors = sg.delete_r2_many(fake, "b", keys + keys[:10])     # duplicates are sent once
+    assert sorted(deleted) == keys and errors == {}
+    assert fake.stats()["delete"]["requests"] == 3
+    assert list(fake.list("b", "d/")) == []
+
+
+def test_delete_r2_many_reports_every_key_of_a_failed_batch():
+    fake = sg.FakeStorage(error_rate=1.0, fail_ops=("delete",))
+    for i in range(5): fake.add("b", f"{i}.jpg", b"x")
+    deleted, errors = sg.delete_r2_many(fake, "b", [f"{i}.jpg" for i in range(5)])
+    assert deleted == [] and set(errors) == {f"{i}.jpg" for i in range(5)}
+    assert len(list(fake.list("b"))) == 5
+
+
+def test_move_r2_many_batches_source_deletes(fake):
+    keys = [f"src/{i:03d}.jpg" for i in range(450)]
+    for k in keys: fake.add("b", k, k.encode())
+    out = list(sg.move_r2_many(fake, "b", keys, lambda i, k: "dst/" + k[4:], flush=200))
+    assert sorted(k for _, k, _, err in out if err is None) == keys
+    assert fake.stats()["delete"]["requests"] == 3                      # 200 + 200 + 50
+    assert [o["Key"] for o in fake.list("b", "src/")] == []
+    assert fake.get("b", "dst/007.jpg")[0].read() == b"src/007.jpg"
+
+
+def test_legacy_upload_sort_deletes_in_batches(fake):
+    ref = encode(photo(1, (640, 480)))
+    for i in range(5): fake.add("b", f"shop/ref_{i}.jpg", ref)
+    for i in range(4): fake.add("b", f"shop/other_{i}.jpg", encode(photo(100 + i, (640, 480))))
+    res = sg.seg_folder_by_upload(fake, "b", "shop/", ref, ".jpg", sg.Reporter(), workers={"slowest": 0})
+    assert sorted(res["moved"]) == [f"ref_{i}.jpg" for i in range(5)]
+    assert fake.stats()["delete"]["requests"] == 1
+    left = {o["Key"] for o in fake.list("b", "shop/")}
+    assert {k for k in left if "/" not in k[5:]} == {f"shop/other_{i}.jpg" for i in range(4)}
+    assert len([k for k in left if k.count("/") == 2]) == 5
@@ -0,0 +1,40 @@
+import pytest
+
+import segregator as sg
+from conftest import encode, photo
+
+
+@pytest.fixture
+def pool():
+    # a real two-process pool for the test, torn down after it
+    p = sg.feature_pool(sg.FEATURE_POOL_MIN_ITEMS, processes=2)
+    yield p
+    with sg._pool_lock:
+        if sg._pool is not None: sg._pool.close(); sg._pool = None
+
+
+def _summary(rec):
+    return rec["hash"], rec["width"], rec["height"], sg.classify_features(rec)["category"]
+
+
+def test_pool_records_match_in_thread_extraction(pool):
+    srcs = [encode(photo(i, (400, 300))) for i in range(12)] + [b"not an image"]
+    out  = list(sg.extract_many(srcs, processes=2))
+    assert isinstance(out[-1], Exception)
+    for src, rec in zip(srcs, out[:-1]):
+        assert _summary(rec) == _summary(sg.extract_features(src))
+    assert sg.feature_pool(sg.FEATURE_POOL_MIN_ITEMS, processes=2) is pool      # warm, reused
+
+
+def test_small_jobs_and_processes_0_stay_in_thread():
+    assert sg.feature_pool(sg.FEATURE_POOL_MIN_ITEMS - 1, processes=2) is None
+    assert sg.feature_pool(10_000, processes=0) is None
+
+
+def test_closed_pool_falls_back_in_thread(pool):
+    pool.close()
+    src = encode(photo(1, (400, 300)))
+    assert _summary(sg.extract_on_pool(src)) == _summary(sg.extract_features(src))
+    rec, = sg.extract_many([src], processes=2)
+    assert _summary(rec) == _summary(sg.extract_features(src))
+    assert sg._pool is not pool                                  # a dead pool is replaced
@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+import segregator as sg
+
+KEYS = ["top.jpg", "a/1.jpg", "a/2.jpg", "a/b/3.jpg", "a/c/4.jpg", "a0.jpg",
+        "b/5.jpg", "c.jpg", "d/e/f/6.jpg", "z.jpg"]
+
+
+class Paginator:
+    # list_objects_v2 with Delimiter, `size` entries a page
+    def __init__(self, keys, size):
+        self.keys, self.size = sorted(keys), size
+
+    def paginate(self, Bucket, Prefix="", Delimiter=None, PaginationConfig=None, StartAfter=""):
+        entries = {}
+        for k in self.keys:
+            if not k.startswith(Prefix) or k <= StartAfter: continue
+            rest = k[len(Prefix):]
+            if Delimiter and Delimiter in rest: entries.setdefault(Prefix + rest.split(Delimiter, 1)[0] + "/", None)
+            else: entries[k] = {"Key": k, "Size": 1}
+        entries = sorted(entries.items())
+        for i in range(0, max(1, len(entries)), self.size):
+            page = entries[i:i + self.size]
+            yield {"CommonPrefixes": [{"Prefix": k} for k, o in page if o is None],
+                   "Contents": [o for _, o in page if o is not None],
+                   "IsTruncated": i + self.size < len(entries)}
+
+
+class Client:
+    def __init__(self, keys, size=1000):
+        self.paginator = Paginator(keys, size)
+
+    def get_paginator(self, name):
+        return self.paginator
+
+
+class RolledUp(sg.FakeStorage):
+    list_dir = sg.Storage.list_dir
+
+
+def _stores(tmp_path):
+    fake, rolled = sg.FakeStorage(), RolledUp()
+    for k in KEYS:
+        fake.add("b", k, b"x"); rolled.add("b", k, b"x")
+        path = tmp_path / "b" / k
+        path.parent.mkdir(parents=True, exist_ok=True); path.write_bytes(b"x")
+    return {"fake": (fake, "b"), "rolled": (rolled, "b"), "local": (sg.LocalStorage(), str(tmp_path / "b")),
+            "s3": (sg.S3Storage(Client(KEYS)), "b"), "s3-paged": (sg.S3Storage(Client(KEYS, 3)), "b")}
+
+
+def _level(store, bucket, prefix, max_keys):
+    folders, objs, truncated = store.list_dir(bucket, prefix, max_keys)
+    return folders, [o["Key"] for o in objs], truncated
+
+
+@pytest.mark.parametrize("prefix", ["", "a/", "d/"])
+@pytest.mark.parametrize("max_keys", [0, 1, 3, 4, 6, 7, 100])
+def test_backends_agree_on_one_level(tmp_path, prefix, max_keys):
+    stores = _stores(tmp_path)
+    want = _level(*stores.pop("fake"), prefix, max_keys)
+    assert len(want[0]) + len(want[1]) <= (max_keys or len(KEYS))
+    for name, (store, bucket) in stores.items():
+        assert _level(store, bucket, prefix, max_keys) == want, name
+
+
+def test_truncated_only_when_entries_were_left_out(tmp_path):
+    for name, (store, bucket) in _stores(tmp_path).items():
+        n = sum(map(len, store.list_dir(bucket, "")[:2]))
+        assert store.list_dir(bucket, "", n)[2] is False, name
+        assert store.list_dir(bucket, "", n - 1)[2] is True, name
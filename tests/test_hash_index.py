@@ -0,0 +1,62 @@
+import random
+
+import pytest
+
+import segregator as sg
+
+BITS = sg.HashIndex.CHUNKS * sg.HashIndex.CHUNK_BITS
+
+
+def _near(rng, h, d):
+    # h with d distinct random bits flipped
+    for b in rng.sample(range(BITS), d): h ^= 1 << b
+    return h
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    # clusters around a few seeds at every distance, plus unrelated noise
+    rng   = random.Random(5)
+    seeds = [rng.getrandbits(BITS) for _ in range(6)]
+    items = [(f"c{s}/{i}.jpg", _near(rng, seeds[s], rng.randint(0, 16))) for s in range(6) for i in range(60)]
+    items += [(f"noise/{i}.jpg", rng.getrandbits(BITS)) for i in range(400)]
+    return seeds, items
+
+
+def _brute(items, h, radius, prefix=""):
+    hits = [(k, sg._hamming_distance(h, x)) for k, x in items if k.startswith(prefix)]
+    return sorted(((k, d) for k, d in hits if d <= radius), key=lambda kd: (kd[1], kd[0]))
+
+
+@pytest.mark.parametrize("radius", [0, 3, 4, 8, 12, 15])
+def test_query_matches_a_brute_force_scan(corpus, radius):
+    seeds, items = corpus
+    idx = sg.HashIndex("h.sqlite")
+    idx.insert_many("b", items)
+    rng = random.Random(radius)
+    for h in seeds + [_near(rng, s, 5) for s in seeds] + [items[7][1], items[-1][1]]:
+        assert idx.query("b", h, radius) == _brute(items, h, radius)
+    assert idx.query("b", seeds[0], radius, prefix="c0/") == _brute(items, seeds[0], radius, "c0/")
+    assert idx.query("b", seeds[0], radius, limit=3) == _brute(items, seeds[0], radius)[:3]
+
+
+def test_writes_follow_the_bucket(corpus):
+    _, items = corpus
+    idx = sg.HashIndex("h.sqlite")
+    idx.insert_many("b", items[:10])
+    k, h = items[0]
+    idx.insert("b", k, h ^ 1, replace=False)                       # existing row kept
+    assert idx.query("b", h, 0) == [(k, 0)]
+    idx.copy("b", k, "copy.jpg")
+    assert idx.query("b", h, 0) == [(k, 0), ("copy.jpg", 0)]
+    idx.delete("b", [k])
+    assert idx.query("b", h, 0) == [("copy.jpg", 0)]
+    assert idx.query("other", h, 0) == [] and idx.count("b") == 10
+
+
+def test_index_persists_across_opens(corpus):
+    _, items = corpus
+    sg.HashIndex("h.sqlite").insert_many("b", items)
+    again = sg.HashIndex("h.sqlite")
+    assert again.count("b") == len(items)
+    assert again.query("b", items[3][1], 8) == _brute(items, items[3][1], 8)
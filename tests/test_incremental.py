@@ -0,0 +1,66 @@
+import datetime
+
+import segregator as sg
+from conftest import encode, photo
+
+
+def _copies(fake):
+    return fake.stats().get("copy", {}).get("requests", 0)
+
+
+def _run(fake):
+    before = _copies(fake)
+    summary = sg.seg_r2_full(fake, "b", "in/", "sorted/", "category", sg.Reporter(), incremental=True)
+    return summary, _copies(fake) - before
+
+
+def _seed(fake, n=6):
+    for i in range(n): fake.add("b", f"in/{i}.jpg", encode(photo(i, (320, 240))))
+
+
+def test_second_run_copies_nothing(fake):
+    _seed(fake)
+    summary, n = _run(fake)
+    assert n == 6 and sum(len(v) for v in summary.values()) == 6
+    assert _run(fake)[1] == 0
+
+
+def test_only_new_and_changed_objects_are_processed(fake):
+    _seed(fake)
+    _run(fake)
+    fake.add("b", "in/new.jpg", encode(photo(40, (320, 240))))
+    fake.add("b", "in/1.jpg", encode(photo(41, (320, 240))))                  # changed content
+    fake.add("b", "in/2.jpg", fake.get("b", "in/2.jpg")[0].read())            # identical re-upload
+    summary, n = _run(fake)
+    assert n == 2
+    assert sum(len(v) for v in summary.values()) == 7                          # merged into the grouping
+
+
+def test_watermark_filters_placed_objects(fake):
+    _seed(fake)
+    _run(fake)
+    assert sg.session_log.latest(1)[0]["extra"]["watermark"]
+    # a placed object listed at or before the watermark is not compared again
+    data, _, lm = fake._objs[("b", "in/3.jpg")]
+    fake._objs[("b", "in/3.jpg")] = (data, "changed-etag", lm)
+    assert _run(fake)[1] == 0
+
+
+def test_never_placed_objects_are_retried_whatever_their_age(fake):
+    _seed(fake)
+    _run(fake)
+    old = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+    data = encode(photo(60, (320, 240)))
+    fake._objs[("b", "in/failed_before.jpg")] = (data, "etag-x", old)
+    assert _run(fake)[1] == 1
+
+
+def test_changed_object_in_the_same_group_keeps_its_destination(fake):
+    _seed(fake)
+    _run(fake)
+    dests = sorted(o["Key"] for o in fake.list("b", "sorted/"))
+    img = photo(2, (320, 240))
+    for quality in (70, 60):                        # new bytes, same picture, same group
+        fake.add("b", "in/2.jpg", encode(img, quality=quality))
+        assert _run(fake)[1] == 1
+        assert sorted(o["Key"] for o in fake.list("b", "sorted/")) == dests
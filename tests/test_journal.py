@@ -0,0 +1,68 @@
+import segregator as sg
+from conftest import encode, photo
+
+
+class Flaky(sg.FakeStorage):
+    # copies of the keys in `refuse` fail, as if the job were cut off there
+    refuse = set()
+
+    def copy(self, bucket, src_key, dest_key):
+        if src_key in self.refuse: raise sg.FakeStorageError("connection lost")
+        super().copy(bucket, src_key, dest_key)
+
+
+def _seed(store):
+    # same file names in two folders: every second copy needs an `_idx` name
+    for i in range(4):
+        data = encode(photo(i, (320, 240)))
+        for folder in "ab": store.add("b", f"in/{folder}/{i}.jpg", data)
+
+
+def _run(store):
+    before = store.stats().get("copy", {}).get("requests", 0)
+    sg.seg_r2_full(store, "b", "in/", "sorted/", "category", sg.Reporter())
+    return store.stats().get("copy", {}).get("requests", 0) - before
+
+
+def _out(store):
+    return sorted(o["Key"] for o in store.list("b", "sorted/"))
+
+
+def test_interrupted_job_resumes_without_duplicates():
+    store = Flaky()
+    _seed(store)
+    store.refuse = {"in/a/2.jpg", "in/b/3.jpg"}
+    assert _run(store) == 6
+    (job,) = sg._journal().unfinished()
+    assert job["states"] == {"copied": 6, "pending": 2}
+    claimed = {k: d for k, (st, d, _) in sg._journal().open(job["job"], "", "").items()}
+
+    store.refuse = set()
+    assert _run(store) == 2                                   # only the two that never landed
+    out = _out(store)
+    assert len(out) == 8 and set(out) == set(claimed.values())
+    assert sg._journal().unfinished() == []
+
+
+def test_uninterrupted_job_leaves_no_journal(fake):
+    _seed(fake)
+    assert _run(fake) == 8 and len(_out(fake)) == 8
+    assert sg._journal().unfinished() == []
+
+
+def test_journal_states_survive_a_reopen():
+    j = sg.JobJournal("jobs.sqlite")
+    assert j.open("job", "r2_full", "b", "in → out") == {}
+    j.mark("job", [("k1", "pending", "out/k1", "g"), ("k2", "copied", "out/k2", "g")])
+    j.mark("job", [("k1", "copied", "out/k1", "g")])
+    again = sg.JobJournal("jobs.sqlite")
+    assert again.open("job", "r2_full", "b") == {"k1": ("copied", "out/k1", "g"), "k2": ("copied", "out/k2", "g")}
+    assert again.unfinished()[0]["states"] == {"copied": 2}
+    again.finish("job")
+    assert again.unfinished() == [] and again.open("job", "r2_full", "b") == {}
+
+
+def test_claim_reuses_the_destination_of_the_same_group():
+    steps = {"k": ("pending", "out/g/k.jpg", "g")}
+    assert sg._claim(steps, "k", "g", lambda: "new") == "out/g/k.jpg"
+    assert sg._claim(steps, "k", "other", lambda: "new") == "new"
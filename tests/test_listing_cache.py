@@ -0,0 +1,74 @@
+import pytest
+
+import segregator as sg
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(sg.time, "monotonic", lambda: now[0])
+    return now
+
+
+def _lists(fake):
+    return fake.stats().get("list", {}).get("requests", 0)
+
+
+def _scan(fake, prefix="", **kw):
+    return sg.scan_bucket(fake, "b", prefix, **kw)[0]
+
+
+def _seed(fake):
+    for k in ["p/a/1.jpg", "p/a/2.jpg", "p/b/3.jpg", "q/4.jpg"]: fake.add("b", k, b"x")
+
+
+def test_listing_is_reused_until_the_ttl_runs_out(fake, clock):
+    _seed(fake)
+    assert _scan(fake, "p/") == ["p/a/1.jpg", "p/a/2.jpg", "p/b/3.jpg"]
+    fake.add("b", "p/outside.jpg", b"x")                # written behind our back
+    clock[0] += sg.LISTING_TTL - 1
+    assert "p/outside.jpg" not in _scan(fake, "p/") and _lists(fake) == 1
+    assert "p/outside.jpg" in _scan(fake, "p/", refresh=True) and _lists(fake) == 2
+    clock[0] += sg.LISTING_TTL
+    assert "p/outside.jpg" in _scan(fake, "p/") and _lists(fake) == 3
+
+
+def test_sub_prefix_is_served_from_a_parent_listing(fake, clock):
+    _seed(fake)
+    _scan(fake)
+    assert _scan(fake, "p/a/") == ["p/a/1.jpg", "p/a/2.jpg"]
+    assert _lists(fake) == 1
+    clock[0] += sg.LISTING_TTL
+    _scan(fake, "p/a/")
+    assert _lists(fake) == 2
+
+
+def test_own_writes_and_deletes_keep_it_current(fake, clock):
+    _seed(fake)
+    _scan(fake, "p/")
+    sg.delete_r2(fake, "b", "p/a/1.jpg")
+    assert _scan(fake, "p/") == ["p/a/2.jpg", "p/b/3.jpg"] and _lists(fake) == 1     # patched, not relisted
+    sg.copy_r2(fake, "b", "q/4.jpg", "p/b/4.jpg")
+    assert _scan(fake, "p/") == ["p/a/2.jpg", "p/b/3.jpg", "p/b/4.jpg"] and _lists(fake) == 2
+    sg.copy_r2(fake, "b", "q/4.jpg", "r/4.jpg")                                     # elsewhere: entry kept
+    _scan(fake, "p/")
+    assert _lists(fake) == 2
+
+
+def test_listing_raced_by_a_write_is_not_stored(clock):
+    cache = sg.ListingCache(ttl=60)
+    gen = cache.generation("b")
+    cache.invalidate("b", ["p/new.jpg"])
+    cache.put("b", "p/", [("p/old.jpg", "v", 1, None)], True, gen)
+    assert cache.get("b", "p/") is None
+    cache.put("b", "p/", [("p/old.jpg", "v", 1, None)], True, cache.generation("b"))
+    assert cache.get("b", "p/") == [("p/old.jpg", "v", 1, None)]
+    clock[0] += 60
+    assert cache.get("b", "p/") is None
+
+
+def test_ttl_zero_turns_it_off(fake, monkeypatch):
+    monkeypatch.setattr(sg, "_listing_cache", lambda: sg.ListingCache(ttl=0))
+    _seed(fake)
+    _scan(fake); _scan(fake)
+    assert _lists(fake) == 2
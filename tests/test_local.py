@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+import segregator as sg
+from conftest import encode, photo
+
+
+@pytest.fixture
+def folders(isolated):
+    os.makedirs("in/sub")
+    for i in range(4):
+        with open(f"in/{i}.jpg", "wb") as f: f.write(encode(photo(i, (320, 240))))
+    with open("in/sub/x.png", "wb") as f: f.write(encode(photo(9, (320, 240)), "PNG"))
+    return os.path.abspath("in"), os.path.abspath("out")
+
+
+def _copied(out):
+    return sorted(f for _, _, fs in os.walk(out) for f in fs)
+
+
+def test_local_full_copies_and_logs_the_baseline_fields(folders):
+    src, out = folders
+    summary = sg.seg_local_full(src, out, "category", sg.Reporter())
+    assert sum(len(v) for v in summary.values()) == 5
+    assert _copied(out) == ["0.jpg", "1.jpg", "2.jpg", "3.jpg", "x.png"]
+    ev = sg.session_log.latest(1)[0]
+    assert ev["event_type"] == "local_full" and ev["source_prefix"] == src
+    assert set(ev["extra"]) == {"moved", "unchanged_count", "total_processed", "timings"}
+    assert ev["extra"]["unchanged_count"] == ev["extra"]["total_processed"] - ev["extra"]["moved"]
+
+
+def test_local_reference_logs_the_baseline_fields(folders):
+    src, out = folders
+    summary = sg.seg_local_ref(None, "", os.path.join(src, "0.jpg"), src, out, sg.Reporter())
+    assert sum(len(v) for v in summary.values()) == 5
+    ev = sg.session_log.latest(1)[0]
+    assert ev["event_type"] == "local_reference"
+    assert set(ev["extra"]) == {"moved", "unchanged_count", "total_processed", "timings"}
+
+
+def test_folders_without_a_common_root(folders, monkeypatch):
+    # os.path.commonpath raises ValueError for paths on different Windows drives
+    def _no_common(paths): raise ValueError("Paths don't have the same drive")
+    monkeypatch.setattr(sg.os.path, "commonpath", _no_common)
+    src, out = folders
+    summary = sg.seg_local_full(src, out, "category", sg.Reporter())
+    assert sum(len(v) for v in summary.values()) == 5
+    assert _copied(out) == ["0.jpg", "1.jpg", "2.jpg", "3.jpg", "x.png"]
+    assert len(_copied(src)) == 5
+
+
+def test_mounted_local_storage(folders):
+    src, out = folders
+    st = sg.LocalStorage(mounts={"source": src, "output": out})
+    assert [o["Key"] for o in st.list("", "source/sub/")] == ["source/sub/x.png"]
+    assert len(list(st.list("", ""))) == 5
+    assert st.list_dir("", "") == (["output/", "source/"], [], False)
+    st.copy("", "source/0.jpg", "output/a/0.jpg")
+    assert os.path.exists(os.path.join(out, "a", "0.jpg"))
+    assert [o["Key"] for o in st.list("", "out")] == ["output/a/0.jpg"]
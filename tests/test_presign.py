@@ -0,0 +1,64 @@
+import segregator as sg
+
+
+class Client:
+    # the part of a boto3 client that presigning uses
+    def __init__(self, endpoint):
+        self.endpoint, self.signed = endpoint, 0
+
+    def generate_presigned_url(self, op, Params, ExpiresIn):
+        self.signed += 1
+        return f"{self.endpoint}/{Params['Bucket']}/{Params['Key']}?n={self.signed}&e={ExpiresIn}"
+
+
+def test_urls_are_reused_per_client():
+    a = Client("https://a.example")
+    url = sg.get_presigned_url(a, "b", "k.jpg")
+    assert sg.get_presigned_url(a, "b", "k.jpg") == url         # new S3Storage wrapper, same client
+    assert a.signed == 1
+    assert sg.get_presigned_url(a, "b", "k.jpg", expires=60) != url
+    assert a.signed == 2
+
+
+def test_clients_never_share_urls():
+    a, b = Client("https://a.example"), Client("https://b.example")
+    ua, ub = sg.get_presigned_url(a, "bk", "k.jpg"), sg.get_presigned_url(b, "bk", "k.jpg")
+    assert ua.startswith("https://a.example") and ub.startswith("https://b.example")
+    assert a.signed == b.signed == 1
+
+
+def test_a_reused_object_id_does_not_inherit_urls():
+    a = Client("https://a.example")
+    sg.get_presigned_url(a, "b", "k.jpg")
+    del a
+    for _ in range(50):                 # whatever lands on the freed id must sign for itself
+        c = Client("https://c.example")
+        assert sg.get_presigned_url(c, "b", "k.jpg").startswith("https://c.example")
+
+
+def test_urls_close_to_expiry_are_signed_again(monkeypatch):
+    a = Client("https://a.example")
+    sg.get_presigned_url(a, "b", "k.jpg", expires=600)
+    now = sg.time.monotonic()
+    monkeypatch.setattr(sg.time, "monotonic", lambda: now + 600 - sg.PRESIGN_MARGIN + 1)
+    sg.get_presigned_url(a, "b", "k.jpg", expires=600)
+    assert a.signed == 2
+
+
+def test_deletes_drop_their_urls(fake):
+    fake.add("b", "k.jpg", b"x")
+    calls = []
+    orig = fake.presign
+    fake.presign = lambda *a, **kw: calls.append(a) or orig(*a, **kw)
+    sg.get_presigned_url(fake, "b", "k.jpg"); sg.get_presigned_url(fake, "b", "k.jpg")
+    sg.delete_r2_many(fake, "b", ["k.jpg"])
+    sg.get_presigned_url(fake, "b", "k.jpg")
+    assert len(calls) == 2
+
+
+def test_oldest_urls_go_first():
+    cache, a = sg.PresignCache(max_entries=3), Client("https://a.example")
+    store = sg.storage_for(a)
+    for k in "wxyz": cache.get(store, "b", k, 600)
+    cache.get(store, "b", "w", 600)
+    assert a.signed == 5                                         # w was evicted by z
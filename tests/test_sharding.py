@@ -0,0 +1,78 @@
+import itertools
+import random
+
+import segregator as sg
+
+
+def keys(it):
+    return [o["Key"] for o in it]
+
+
+def listed(fake, prefix="", shards=8):
+    # (keys, list requests) for one walk; shards=1 is the plain list()
+    before = fake.stats().get("list", {}).get("requests", 0)
+    out = keys(sg.list_sharded(fake, "b", prefix, shards))
+    return out, fake.stats()["list"]["requests"] - before
+
+
+def test_small_prefix_is_one_request(fake):
+    for i in range(300): fake.add("b", f"p/{i % 7}/{i:04d}.jpg", b"x")
+    out, requests = listed(fake, "p/")
+    assert out == keys(fake.list("b", "p/")) and requests == 1
+
+
+def test_many_tiny_folders_cost_what_a_plain_listing_does(fake):
+    for i in range(3000):
+        for j in range(2): fake.add("b", f"shop/{i:04d}/{j}.jpg", b"x")
+    plain, plain_requests = listed(fake, "shop/", shards=1)
+    out, requests = listed(fake, "shop/")
+    assert out == plain and len(out) == 6000
+    assert requests == plain_requests == 6
+
+
+def test_flat_prefix_is_listed_page_by_page(fake):
+    for i in range(4500): fake.add("b", f"flat/{i:05d}.jpg", b"x")
+    out, requests = listed(fake, "flat/")
+    assert out == keys(fake.list("b", "flat/")) and requests == 5
+
+
+def test_large_folders_are_split_into_at_most_shards_ranges(fake):
+    for a in "abcd":
+        for s in range(3):
+            for i in range(1000): fake.add("b", f"p/{a}/{s}/{i:04d}.jpg", b"x")
+    with sg.ThreadPoolExecutor(4) as pool:
+        plan = sg._shard_plan(fake, "b", "p/", 8, pool)
+    assert 1 < len(plan) <= 8
+    assert plan[0][0] == "" and plan[-1][1] is None
+    out, requests = listed(fake, "p/")
+    assert out == keys(fake.list("b", "p/"))
+    # first page + 1 + 4 delimiter listings + at most one straddling page per range
+    assert requests <= 12 + 1 + 5 + 8
+
+
+def test_uneven_tree_keeps_key_order(fake):
+    rng = random.Random(7)
+    for i in range(6000):
+        depth = rng.choice([1, 2, 2, 3, 4])
+        parts = [rng.choice(["a", "a.b", "a-b", "a0", "b", "zz"]) for _ in range(depth)]
+        fake.add("b", "/".join(["root"] + parts + [f"{i}.jpg"]), b"x")
+    for marker in ["root/a/", "root/a.b/", "root/zz/a/"]: fake.add("b", marker, b"")
+    fake.add("b", "root/a", b"x")                   # an object sorting next to its namesake folder
+    for prefix, shards in [("root/", 8), ("root/a", 3), ("root/zz/", 2), ("", 5)]:
+        out, _ = listed(fake, prefix, shards)
+        assert out == keys(fake.list("b", prefix)), (prefix, shards)
+
+
+def test_start_after_skips_keys(fake):
+    for k in ["a/1", "a/2", "a/3", "b/1"]: fake.add("b", k, b"x")
+    assert keys(fake.list("b", "a/", start_after="a/1")) == ["a/2", "a/3"]
+    assert keys(fake.list("b", "", start_after="a/" + "\U0010ffff")) == ["b/1"]
+
+
+def test_closing_early_stops_the_walk(fake):
+    for a in range(10):
+        for i in range(1500): fake.add("b", f"p/{a}/{i:04d}.jpg", b"x")
+    it = sg.list_sharded(fake, "b", "p/", 4)
+    head = [o["Key"] for o in itertools.islice(it, 1200)]
+    it.close()
+    assert head == keys(fake.list("b", "p/"))[:1200]
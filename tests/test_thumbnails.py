@@ -0,0 +1,53 @@
+import io
+import os
+
+from PIL import Image
+
+import segregator as sg
+from conftest import encode, photo
+
+
+def _gets(fake):
+    return fake.stats().get("get", {}).get("requests", 0)
+
+
+def test_tiles_are_made_once_per_version(fake):
+    fake.add("b", "p/a.jpg", encode(photo(1, (1600, 1200))))
+    v = sg.object_version(fake.head("b", "p/a.jpg"))
+    tile = sg.thumbnail(fake, "b", "p/a.jpg", v)
+    img = Image.open(io.BytesIO(tile))
+    assert max(img.size) <= sg.THUMB_MAX_PX and img.format == sg._thumb_cache().format
+    assert len(tile) < len(fake.get("b", "p/a.jpg")[0].read()) / 5
+    n = _gets(fake)
+    assert sg.thumbnail(fake, "b", "p/a.jpg", v) == tile and _gets(fake) == n
+    fake.add("b", "p/a.jpg", encode(photo(2, (1600, 1200))))                  # new content, new ETag
+    sg.thumbnail(fake, "b", "p/a.jpg", sg.object_version(fake.head("b", "p/a.jpg")))
+    assert _gets(fake) == n + 1
+
+
+def test_without_a_version_one_head_finds_it(fake):
+    fake.add("b", "a.png", encode(photo(3, (800, 600)), "PNG"))
+    sg.thumbnail(fake, "b", "a.png")
+    heads, gets = fake.stats()["head"]["requests"], _gets(fake)
+    sg.thumbnail(fake, "b", "a.png")
+    assert fake.stats()["head"]["requests"] == heads + 1 and _gets(fake) == gets
+
+
+def test_a_page_of_tiles_reports_failures_per_key(fake):
+    for i in range(6): fake.add("b", f"{i}.jpg", encode(photo(i, (640, 480))))
+    out = sg.thumbnails(fake, "b", [f"{i}.jpg" for i in range(6)] + ["missing.jpg"])
+    assert all(isinstance(out[f"{i}.jpg"], bytes) for i in range(6))
+    assert isinstance(out["missing.jpg"], Exception)
+    assert sg.cache_stats("thumbnails")["entries"] == 6
+
+
+def test_least_recently_viewed_tiles_are_evicted(isolated):
+    cache = sg.ThumbnailCache(path="tiles", max_bytes=350)
+    for n, k in enumerate("abc"):
+        cache.put("b", k, "v", b"x" * 100)
+        os.utime(cache._file("b", k, "v", sg.THUMB_MAX_PX), (1000 * (n + 1),) * 2)
+    assert cache.get("b", "a", "v")                 # viewed → newest
+    cache.put("b", "d", "v", b"x" * 100)            # 400 > 350: evict down to 90 %
+    assert cache.get("b", "b", "v") is None
+    assert all(cache.get("b", k, "v") for k in "acd")
+    assert cache.stats()["entries"] == 3 and cache.stats()["bytes"] == 300